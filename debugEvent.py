@@ -21,23 +21,29 @@
 # along with pyOBD; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 ###########################################################################
-try:
-    import wx
-    
-    EVT_DEBUG_ID = 1010
-    
-    def debug_display(window, position, message):
-            print message
-            wx.PostEvent(window, DebugEvent([position, message]))
-       
-    class DebugEvent(wx.PyEvent):
-        """Simple event to carry arbitrary result data."""
-        def __init__(self, data):
-            """Init Result Event."""
-            wx.PyEvent.__init__(self)
-            self.SetEventType(EVT_DEBUG_ID)
-            self.data = data
-except ImportError as e:
-    def debug_display(window, position, message):
-        print message
-    
+EVT_DEBUG_ID = 1010
+
+# The event class is created on first use, so wx is only imported when there is a window to post to
+DebugEvent = None
+
+def debug_display(window, position, message):
+    print message
+    if window is None:
+        return
+    try:
+        import wx
+    except ImportError:
+        return
+    wx.PostEvent(window, getDebugEventClass(wx)([position, message]))
+
+def getDebugEventClass(wx):
+    global DebugEvent
+    if DebugEvent is None:
+        class DebugEvent(wx.PyEvent):
+            """Simple event to carry arbitrary result data."""
+            def __init__(self, data):
+                """Init Result Event."""
+                wx.PyEvent.__init__(self)
+                self.SetEventType(EVT_DEBUG_ID)
+                self.data = data
+    return DebugEvent
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# This file defines the acquisition layer, which polls channels on one or more ports (adapters) at once.
+# Channels are split across the ports by rate and priority, e.g. fast channels on one adapter and slow ones on the
+# other. Each port is polled by its own thread, and their samples are merged into one stream in timestamp order.
+
+import heapq
+import threading
+import time
+import Queue
+
+from obd_scheduler import ChannelScheduler
+
+# Time (in seconds) samples are held back so that samples from slower ports can be merged in timestamp order. Samples
+# are also held back while an older one may still come from a request in flight (see Acquisition.getSamples).
+MERGE_WINDOW = 0.2
+
+# Splits channels into count shards. The channels are ordered by priority and rate, fastest first, then cut into
+# contiguous shards of roughly equal load (polls per second), so the fast channels share an adapter.
+def shardChannels(channels, count):
+    ordered = sorted(channels, key=lambda channel: (-channel.priority, -channel.rate))
+    totalLoad = sum([channel.rate for channel in channels])
+    shards = [[] for i in range(count)]
+    shard = 0
+    load = 0.0
+    for channel in ordered:
+        # Move on when this shard has its share, keeping at least one channel for each shard left
+        remaining = len(ordered) - sum([len(s) for s in shards])
+        if shard < count - 1 and shards[shard] and \
+           (load + channel.rate / 2.0 > totalLoad * (shard + 1) / count or remaining <= count - 1 - shard):
+            shard += 1
+        shards[shard].append(channel)
+        load += channel.rate
+    return shards
+
+# A sample is (timestamp, sensor short name, value, port index)
+class AcquisitionWorker(threading.Thread):
+    """ Polls one port's channels as they fall due, putting new samples on the output queue"""
+    def __init__(self, port, channels, output, index, onSample=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.port = port
+        self.scheduler = ChannelScheduler(channels)
+        self.output = output
+        self.index = index
+        self.onSample = onSample
+        self.running = False
+
+        # Time the request in flight was sent, or None between requests. Its sample is timed after this.
+        self.requestStart = None
+
+    def run(self):
+        self.running = True
+        while self.running:
+            now = time.time()
+            channel = self.scheduler.nextDue(now)
+            if channel is None:
+                time.sleep(min(self.scheduler.timeUntilNext(now), 0.1))
+                continue
+
+            sensor = channel.sensor
+            previous = sensor.timestamp
+            self.requestStart = time.time()
+            self.port.updateSensor(sensor)
+            self.scheduler.done(channel)
+            if sensor.timestamp != previous:
+                sample = (sensor.timestamp, sensor.shortname, sensor.value, self.index)
+                if self.onSample is not None:
+                    self.onSample(sample)
+                self.output.put(sample)
+            self.requestStart = None
+
+    def stop(self):
+        self.running = False
+
+class Acquisition:
+    """ Polls channels across one or more ports, merging their samples into one timestamped stream.
+    onSample, if given, is called with every sample as soon as it arrives (from the port's thread),
+    for consumers that want the latest values rather than an ordered stream."""
+    def __init__(self, ports, channels, onSample=None):
+        self.ports = ports
+        self.queue = Queue.Queue()
+        self.pending = []
+
+        # Each sensor must only be polled by one port, as its value isn't locked
+        self.shards = shardChannels(channels, len(ports))
+        self.workers = []
+        for i in range(len(ports)):
+            # With fewer channels than ports, the ports left over have nothing to poll
+            if self.shards[i]:
+                self.workers.append(AcquisitionWorker(ports[i], self.shards[i], self.queue, i, onSample))
+
+    def getScheduler(self, shortname):
+        """Returns the scheduler polling a channel, for changing its rate"""
+        for worker in self.workers:
+            if worker.scheduler.get(shortname) is not None:
+                return worker.scheduler
+        return None
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join()
+
+    def close(self):
+        self.stop()
+        for port in self.ports:
+            port.close()
+
+    def getSamples(self, timeout=0.1, flush=False):
+        """Returns the merged samples in timestamp order, waiting up to timeout seconds for new ones.
+        Samples newer than MERGE_WINDOW, or than the start of a request in flight, are held back
+        unless flush is set, as a slower port may still deliver older ones."""
+        # Worked out before the queue is read, so the sample of a request that finishes in between is already on it
+        cutoff = time.time() - MERGE_WINDOW
+        for worker in self.workers:
+            requestStart = worker.requestStart
+            if requestStart is not None:
+                cutoff = min(cutoff, requestStart)
+
+        try:
+            heapq.heappush(self.pending, self.queue.get(True, timeout))
+            while 1:
+                heapq.heappush(self.pending, self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+
+        samples = []
+        while self.pending and (flush or self.pending[0][0] <= cutoff):
+            samples.append(heapq.heappop(self.pending))
+        return samples
@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+# This file defines a non-blocking OBD port, driven by a single select() based event loop, so the scheduler, logger,
+# telemetry and features can share one thread instead of each blocking on the serial port.
+#
+# The interface follows asyncio (futures with done callbacks, call_soon/call_later, add_reader), which isn't available
+# to Python 2. OBDPort still opens and initialises the adapter; AsyncOBDPort then takes over its serial port.
+
+import os
+import select
+import string
+import time
+import heapq
+from collections import deque
+
+import obd_sensors
+from obd_io import GET_DTC_COMMAND, CLEAR_DTC_COMMAND, GET_FREEZE_DTC_COMMAND, RESYNC_TIMEOUT, ABORT_CHARACTER
+from obd_timing import splitCommand
+
+# Time (in seconds) an event loop with no file descriptors, timers or callbacks sleeps before looking again
+IDLE_SLEEP = 0.1
+
+class CancelledError(Exception):
+    pass
+
+class RequestTimeout(Exception):
+    pass
+
+# The result of an operation that hasn't necessarily finished yet
+class Future:
+    def __init__(self, loop):
+        self.loop = loop
+        self.callbacks = []
+        self.isDone = False
+        self.isCancelled = False
+        self.value = None
+        self.error = None
+
+        # Called when the future is cancelled before it is done
+        self.onCancel = None
+
+    def done(self):
+        return self.isDone
+
+    def cancelled(self):
+        return self.isCancelled
+
+    def result(self):
+        if self.isCancelled:
+            raise CancelledError()
+        if not self.isDone:
+            raise RuntimeError("Result is not ready")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self):
+        if self.isCancelled:
+            raise CancelledError()
+        return self.error
+
+    def add_done_callback(self, callback):
+        if self.isDone:
+            self.loop.call_soon(callback, self)
+        else:
+            self.callbacks.append(callback)
+
+    def set_result(self, value):
+        self.value = value
+        self.finish()
+
+    def set_exception(self, error):
+        self.error = error
+        self.finish()
+
+    def cancel(self):
+        if self.isDone:
+            return False
+        self.isCancelled = True
+        if self.onCancel is not None:
+            self.onCancel(self)
+        self.finish()
+        return True
+
+    def finish(self):
+        if self.isDone:
+            return
+        self.isDone = True
+        for callback in self.callbacks:
+            self.loop.call_soon(callback, self)
+        self.callbacks = []
+
+# Handle for a callback scheduled with call_later
+class TimerHandle:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.isCancelled = False
+
+    def cancel(self):
+        self.isCancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+class EventLoop:
+    def __init__(self):
+        self.readers = {}
+        self.writers = {}
+        self.timers = []
+        self.ready = deque()
+        self.running = False
+
+    def time(self):
+        return time.time()
+
+    def call_soon(self, callback, *args):
+        self.ready.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        handle = TimerHandle(self.time() + delay, callback, args)
+        heapq.heappush(self.timers, handle)
+        return handle
+
+    def add_reader(self, fd, callback, *args):
+        self.readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def add_writer(self, fd, callback, *args):
+        self.writers[fd] = (callback, args)
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+
+    # Waits up to timeout seconds (None = until something happens) for file descriptors and timers, then
+    # runs the callbacks that are ready
+    def run_once(self, timeout=None):
+        while self.timers and self.timers[0].isCancelled:
+            heapq.heappop(self.timers)
+        if self.timers:
+            untilTimer = max(0, self.timers[0].when - self.time())
+            if timeout is None or untilTimer < timeout:
+                timeout = untilTimer
+        if self.ready:
+            timeout = 0
+
+        if self.readers or self.writers:
+            readable, writable, _ = select.select(self.readers.keys(), self.writers.keys(), [], timeout)
+            for fd in readable:
+                if fd in self.readers:
+                    callback, args = self.readers[fd]
+                    callback(*args)
+            for fd in writable:
+                if fd in self.writers:
+                    callback, args = self.writers[fd]
+                    callback(*args)
+        elif timeout is None:
+            # Nothing to wait for, so only a signal handler or another thread can give the loop work
+            time.sleep(IDLE_SLEEP)
+        elif timeout > 0:
+            time.sleep(timeout)
+
+        now = self.time()
+        while self.timers and self.timers[0].when <= now:
+            handle = heapq.heappop(self.timers)
+            if not handle.isCancelled:
+                handle.callback(*handle.args)
+
+        # Only the callbacks ready now, the ones they schedule run next time round
+        for i in range(len(self.ready)):
+            callback, args = self.ready.popleft()
+            callback(*args)
+
+    def run_forever(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def run_until_complete(self, future):
+        while not future.done():
+            self.run_once()
+        return future.result()
+
+    def stop(self):
+        self.running = False
+
+# Returns a future for the list of results of all the futures, which fails with the first error
+def gather(loop, futures):
+    gathered = Future(loop)
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+
+    def onDone(index, future):
+        if gathered.done():
+            return
+        if future.cancelled():
+            gathered.cancel()
+        elif future.exception() is not None:
+            gathered.set_exception(future.exception())
+        else:
+            results[index] = future.result()
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                gathered.set_result(results)
+
+    for i in range(len(futures)):
+        futures[i].add_done_callback(lambda future, index=i: onDone(index, future))
+    if len(futures) == 0:
+        gathered.set_result(results)
+    return gathered
+
+# A request waiting to be sent or in flight
+class Request:
+    def __init__(self, cmd, future, timeout):
+        self.cmd = cmd
+        self.future = future
+        self.timeout = timeout
+        self.timer = None
+
+        # Times the command was written to the adapter and its answer arrived, once they have
+        self.sendTime = None
+        self.answerTime = None
+
+class AsyncOBDPort:
+    """ Non-blocking OBD port. Requests are queued and sent one at a time, each with its own
+    timeout, and return futures that can be cancelled."""
+    def __init__(self, loop, obdPort):
+        self.loop = loop
+        self.obdPort = obdPort
+        self.timing = obdPort.timing
+        self.requestTimeout = obdPort.requestTimeout
+
+        self.fd = obdPort.port.fileno()
+        self.queue = deque()
+        self.current = None
+        self.buffer = ""
+
+        # While resynchronising after an aborted request, input is discarded up to the next prompt
+        self.resyncing = False
+        self.resyncTimer = None
+
+        obdPort.flush_input()
+        self.loop.add_reader(self.fd, self.onReadable)
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        while self.queue:
+            self.queue.popleft().future.cancel()
+        if self.current is not None:
+            self.current.future.cancel()
+        self.obdPort.close()
+
+    # Sends a command, returning a future for the list of response lines
+    def request(self, cmd, timeout=None):
+        return self.enqueue(cmd, timeout).future
+
+    # Queues a command to be sent, returning its Request. An urgent command goes ahead of the others queued.
+    def enqueue(self, cmd, timeout=None, urgent=False):
+        if timeout is None:
+            timeout = self.requestTimeout
+        future = Future(self.loop)
+        request = Request(cmd, future, timeout)
+        future.onCancel = lambda f: self.onCancel(request)
+        if urgent:
+            self.queue.appendleft(request)
+        else:
+            self.queue.append(request)
+        self.sendNext()
+        return request
+
+    def sendNext(self):
+        if self.current is not None or self.resyncing:
+            return
+        while self.queue:
+            request = self.queue.popleft()
+            if request.future.done():
+                continue
+            self.current = request
+            self.buffer = ""
+            os.write(self.fd, request.cmd + "\r")
+            request.sendTime = self.loop.time()
+            request.timer = self.loop.call_later(request.timeout, self.onTimeout, request)
+            return
+
+    def onReadable(self):
+        try:
+            data = os.read(self.fd, 1024)
+        except OSError:
+            return
+        self.buffer = self.buffer + data
+        prompt = self.buffer.find(">")
+        while prompt >= 0:
+            response = self.buffer[:prompt]
+            self.buffer = self.buffer[prompt + 1:]
+            if self.resyncing:
+                self.endResync()
+            else:
+                request = self.current
+                self.current = None
+                if request is not None:
+                    request.answerTime = self.loop.time()
+                    request.timer.cancel()
+                    lines = [line for line in string.split(response, "\r") if string.strip(line) != ""]
+                    request.future.set_result(lines)
+                self.sendNext()
+            prompt = self.buffer.find(">")
+
+    def onTimeout(self, request):
+        if request is self.current:
+            self.obdPort.timeoutCount += 1
+            request.future.set_exception(RequestTimeout(request.cmd))
+            self.abort()
+
+    def onCancel(self, request):
+        if request is self.current:
+            request.timer.cancel()
+            self.abort()
+
+    # Aborts the request in flight. Any character sent to a busy ELM327 stops it, after which it returns a prompt.
+    def abort(self):
+        self.current = None
+        self.resyncing = True
+        self.buffer = ""
+        os.write(self.fd, ABORT_CHARACTER)
+        self.resyncTimer = self.loop.call_later(RESYNC_TIMEOUT, self.endResync)
+
+    def endResync(self):
+        if self.resyncTimer is not None:
+            self.resyncTimer.cancel()
+            self.resyncTimer = None
+        self.resyncing = False
+        self.sendNext()
+
+    # Gets the latest value of a sensor, returning a future for the sensor. On failure the
+    # sensor keeps its last value (and goes stale) and the future holds the error.
+    def update_sensor(self, sensor, timeout=None):
+        future = Future(self.loop)
+        request = self.enqueue(self.obdPort.request_command(sensor.cmd), timeout)
+        lines = request.future
+
+        def onResponse(lines):
+            if lines.cancelled():
+                future.cancel()
+                return
+            if lines.exception() is not None:
+                self.timing_miss(sensor.cmd)
+                future.set_exception(lines.exception())
+                return
+            data = self.obdPort.interpret_lines(sensor.cmd, lines.result())
+            if data == "NODATA":
+                self.timing_miss(sensor.cmd, False)
+            else:
+                # Timed at the middle of sending the command and the answer, when the ECU sampled the value
+                sensor.update(data, (request.sendTime + request.answerTime) / 2.0)
+                if self.obdPort.targetEcu is None:
+                    base = splitCommand(sensor.cmd)[0]
+                    payloads = [payload for ecu, payload in self.obdPort.get_answers(base, lines.result())]
+                    # Timed from when the command was sent, not queued, so waiting behind other requests isn't counted
+                    self.timing.record(sensor.cmd, payloads, request.answerTime - request.sendTime)
+            future.set_result(sensor)
+
+        future.onCancel = lambda f: lines.cancel()
+        lines.add_done_callback(onResponse)
+        return future
+
+    # Updates a list of sensors, returning a future for the list
+    def update_sensors(self, sensors, timeout=None):
+        futures = [self.update_sensor(sensor, timeout) for sensor in sensors]
+        gathered = gather(self.loop, futures)
+        gathered.onCancel = lambda f: [future.cancel() for future in futures]
+        return gathered
+
+    # Returns a future for the list of [status, DTC code] pairs, stored (mode 03) and freeze frame (mode 07)
+    def get_dtc(self, timeout=None):
+        modes = [(GET_DTC_COMMAND, "Active"), (GET_FREEZE_DTC_COMMAND, "Passive")]
+        requests = [self.request(cmd, timeout) for cmd, status in modes]
+        future = Future(self.loop)
+
+        def onResponses(responses):
+            if responses.cancelled():
+                future.cancel()
+                return
+            if responses.exception() is not None:
+                future.set_exception(responses.exception())
+                return
+            DTCCodes = []
+            for i in range(len(modes)):
+                DTCCodes.extend(self.obdPort.decode_dtc_answers(modes[i][0], responses.result()[i], modes[i][1]))
+            future.set_result(DTCCodes)
+
+        gathered = gather(self.loop, requests)
+        future.onCancel = lambda f: [request.cancel() for request in requests]
+        gathered.add_done_callback(onResponses)
+        return future
+
+    def clear_dtc(self, timeout=None):
+        return self.request(CLEAR_DTC_COMMAND, timeout)
+
+    # Falls back to safe timing after a request got no answer, like OBDPort.timing_miss. The adapter timeout is sent
+    # ahead of the queued requests, so they aren't sent with the tuned timeout that was too short.
+    def timing_miss(self, cmd, timedOut=True):
+        if self.timing.miss(cmd, timedOut):
+            self.set_adapter_timeout(self.timing.timeout, True)
+
+    # Sets the adapter timeout (AT ST), in units of 4 ms, returning a future for the response lines
+    def set_adapter_timeout(self, timeout, urgent=False):
+        return self.enqueue("at st %02X" % timeout, None, urgent).future
+
+class BlockingOBDPort:
+    """ The blocking OBDPort sensor API as a thin wrapper around AsyncOBDPort, running
+    the event loop until each call completes"""
+    def __init__(self, asyncPort):
+        self.asyncPort = asyncPort
+        self.loop = asyncPort.loop
+
+    def updateSensor(self, sensor):
+        try:
+            self.loop.run_until_complete(self.asyncPort.update_sensor(sensor))
+        except RequestTimeout:
+            # The sensor keeps its last value, which ages until it is flagged as stale
+            pass
+
+    def updateSensorByIndex(self, sensor_index):
+        self.updateSensor(obd_sensors.SENSORS[sensor_index])
+
+    def getSensorTuple(self, sensor_index):
+        sensor = obd_sensors.SENSORS[sensor_index]
+        return sensor.name, sensor.value, sensor.unit
+
+    def getSensorFormatted(self, sensor_index):
+        return obd_sensors.SENSORS[sensor_index].getFormattedValue()
+
+    def get_dtc(self):
+        try:
+            return self.loop.run_until_complete(self.asyncPort.get_dtc())
+        except RequestTimeout:
+            return []
+
+    def clear_dtc(self):
+        try:
+            return string.join(self.loop.run_until_complete(self.asyncPort.clear_dtc()), "")
+        except RequestTimeout:
+            return None
+
+    def close(self):
+        self.asyncPort.close()
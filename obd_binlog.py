@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# This file defines the binary sensor log format, used wherever samples are streamed to disk.
+#
+# A log starts with the MAGIC string and a 4 byte little endian length followed by a JSON header
+# (vehicle id, start time and the names of the logged channels, keyed by their index in obd_sensors.SENSORS).
+# The rest of the file is fixed size records of (timestamp as double, channel index as byte, value as double).
+
+import json
+import struct
+import time
+
+MAGIC = "PGLOG1\n"
+
+RECORD = struct.Struct("<dBd")
+RECORD_SIZE = RECORD.size
+
+# Size of the write buffer. Records are only guaranteed to be on disk after flush() or close().
+WRITE_BUFFER_SIZE = 65536
+
+class BinLogWriter:
+    def __init__(self, filename, channels, vehicleId=None, extra=None):
+        """channels maps channel index to sensor short name. extra is any additional header data."""
+        self.filename = filename
+        self.header = {"vehicle": vehicleId, "start": time.time(), "channels": channels}
+        if extra:
+            self.header.update(extra)
+
+        self.file = open(filename, "wb", WRITE_BUFFER_SIZE)
+        headerData = json.dumps(self.header)
+        self.file.write(MAGIC + struct.pack("<I", len(headerData)) + headerData)
+
+        # Bound once so writing a sample is a single call
+        self.pack = RECORD.pack
+        self.fileWrite = self.file.write
+        self.count = 0
+
+    def write(self, timestamp, channel, value):
+        self.fileWrite(self.pack(timestamp, channel, value))
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+# Truncates a log cut off part way through a record (e.g. by a power cut) to its last whole record. Returns False if it
+# doesn't even have a whole header.
+def repairLog(filename):
+    try:
+        reader = BinLogReader(filename)
+    except (ValueError, struct.error):
+        return False
+    reader.file.seek(0, 2)
+    size = reader.file.tell()
+    reader.close()
+    end = reader.dataOffset + (size - reader.dataOffset) / RECORD_SIZE * RECORD_SIZE
+    if end != size:
+        f = open(filename, "r+b")
+        f.truncate(end)
+        f.close()
+    return True
+
+class BinLogReader:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "rb")
+        if self.file.read(len(MAGIC)) != MAGIC:
+            self.file.close()
+            raise ValueError("Not a PiGaugeOBD binary log: %s" % filename)
+        (length,) = struct.unpack("<I", self.file.read(4))
+        self.header = json.loads(self.file.read(length))
+        self.dataOffset = len(MAGIC) + 4 + length
+
+        # JSON keys are always strings, convert the channel indexes back
+        self.channels = {}
+        for index, shortname in self.header["channels"].items():
+            self.channels[int(index)] = shortname
+
+    # Yields lists of up to count (timestamp, channel, value) records. A truncated last record is ignored.
+    def readChunks(self, count=4096):
+        self.file.seek(self.dataOffset)
+        while 1:
+            data = self.file.read(count * RECORD_SIZE)
+            n = len(data) / RECORD_SIZE
+            if n == 0:
+                break
+            yield [RECORD.unpack_from(data, i * RECORD_SIZE) for i in range(n)]
+
+    def __iter__(self):
+        for chunk in self.readChunks():
+            for record in chunk:
+                yield record
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# This file defines the port broker, which owns the adapter and shares it between local programs, so the dashboard
+# and the diagnostic tool can run at the same time:
+#
+#   python obd_broker.py [serial port]
+#
+# Clients connect to a Unix socket and send requests (one JSON object per line). Requests are passed to the adapter
+# one at a time, highest priority first (the dashboard before diagnostics). A request for a command that is already
+# waiting or in flight isn't sent again, its clients all get the same answer.
+#
+# BrokerPort is the client side. It is an OBDPort whose requests go through the broker, so it has the same API.
+
+import os
+import errno
+import heapq
+import json
+import socket
+import string
+import sys
+import time
+
+import obd_io
+from obd_io import OBDPort, REQUEST_TIMEOUT
+from obd_async import EventLoop, AsyncOBDPort
+from obd_utils import scanSerial, DATA_DIR
+
+BROKER_SOCKET = os.path.join(DATA_DIR, "broker.sock")
+
+# Request priorities, lowest first
+PRIORITY_DASHBOARD = 0
+PRIORITY_DIAGNOSTICS = 1
+PRIORITY_BACKGROUND = 2
+
+# Longest request timeout (in seconds) a client can ask for
+MAX_REQUEST_TIMEOUT = 5.0
+
+# Time (in seconds) a client waits for its request to reach the adapter, on top of the request timeout
+QUEUE_TIMEOUT = 5.0
+
+# Most bytes queued for a client that isn't reading its answers, before it is dropped
+MAX_CLIENT_BACKLOG = 65536
+
+# Adapter commands clients may send. Any other AT command would change the adapter for every client.
+ALLOWED_AT_COMMANDS = ["ATI", "ATRV", "ATDP", "ATDPN"]
+
+# A connected client
+class BrokerClient:
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.name = "unknown"
+        self.priority = PRIORITY_BACKGROUND
+        self.buffer = ""
+
+        # Messages not yet taken by the client's socket
+        self.outgoing = ""
+
+# A command waiting for or being sent to the adapter, and the (client, request id) pairs waiting for its answer
+class PendingRequest:
+    def __init__(self, cmd, priority, timeout):
+        self.cmd = cmd
+        self.priority = priority
+        self.timeout = timeout
+        self.waiters = []
+        self.sent = False
+
+class OBDBroker:
+    def __init__(self, obdPort, path=BROKER_SOCKET):
+        self.obdPort = obdPort
+        self.path = path
+        self.loop = EventLoop()
+        self.asyncPort = AsyncOBDPort(self.loop, obdPort)
+
+        # Queue of (priority, order, request), and the requests waiting or in flight by command
+        self.queue = []
+        self.order = 0
+        self.pending = {}
+        self.current = None
+
+        self.requestCount = 0
+        self.coalescedCount = 0
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Remove the socket left behind by a broker that didn't shut down
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(5)
+        self.server.setblocking(0)
+        self.loop.add_reader(self.server.fileno(), self.onAccept)
+        self.clients = {}
+
+    def onAccept(self):
+        try:
+            sock, address = self.server.accept()
+        except socket.error:
+            return
+        # A slow client must never hold up the adapter, so what its socket can't take is queued
+        sock.setblocking(0)
+        client = BrokerClient(sock)
+        self.clients[client.fd] = client
+        self.loop.add_reader(client.fd, self.onClientReadable, client)
+
+    def onClientReadable(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error:
+            data = ""
+        if not data:
+            self.dropClient(client)
+            return
+
+        lines = string.split(client.buffer + data, "\n")
+        client.buffer = lines.pop()
+        for line in lines:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            self.handleMessage(client, message)
+
+    def handleMessage(self, client, message):
+        if "hello" in message:
+            client.name = message["hello"]
+            client.priority = message.get("priority", PRIORITY_BACKGROUND)
+            print "Client %s connected with priority %d" % (client.name, client.priority)
+            self.send(client, {"elm": self.obdPort.ELMver, "headers": self.obdPort.headers,
+                               "vehicle": self.obdPort.timing.vehicleId})
+            return
+
+        requestId = message.get("id")
+        cmd = string.upper(string.join(string.split(message.get("cmd", "")), ""))
+        if cmd[:2] == "AT" and cmd not in ALLOWED_AT_COMMANDS:
+            # Answered as the adapter answers a command it doesn't know
+            self.send(client, {"id": requestId, "lines": ["?"]})
+            return
+        timeout = min(message.get("timeout", REQUEST_TIMEOUT), MAX_REQUEST_TIMEOUT)
+        self.enqueue(client, requestId, cmd, timeout)
+
+    def enqueue(self, client, requestId, cmd, timeout):
+        request = self.pending.get(cmd)
+        if request is None:
+            request = PendingRequest(cmd, client.priority, timeout)
+            self.pending[cmd] = request
+            self.push(request)
+        else:
+            # The same command is already waiting or in flight, share its answer
+            self.coalescedCount += 1
+            if not request.sent and client.priority < request.priority:
+                request.priority = client.priority
+                self.push(request)
+        request.waiters.append((client, requestId))
+        self.sendNext()
+
+    def push(self, request):
+        self.order += 1
+        heapq.heappush(self.queue, (request.priority, self.order, request))
+
+    def sendNext(self):
+        if self.current is not None:
+            return
+        while self.queue:
+            priority, order, request = heapq.heappop(self.queue)
+            # Skip entries replaced by a higher priority one, and requests nobody is waiting for any more
+            if request.sent or priority != request.priority:
+                continue
+            if len(request.waiters) == 0:
+                del self.pending[request.cmd]
+                continue
+            request.sent = True
+            self.current = request
+            self.requestCount += 1
+            future = self.asyncPort.request(request.cmd, request.timeout)
+            future.add_done_callback(lambda future: self.onResponse(request, future))
+            return
+
+    def onResponse(self, request, future):
+        self.current = None
+        del self.pending[request.cmd]
+        if future.cancelled():
+            reply = {"error": "cancelled"}
+        elif future.exception() is not None:
+            reply = {"error": "timeout"}
+        else:
+            reply = {"lines": future.result()}
+        for client, requestId in request.waiters:
+            reply["id"] = requestId
+            self.send(client, reply)
+        self.sendNext()
+
+    def send(self, client, message):
+        queued = client.outgoing != ""
+        client.outgoing = client.outgoing + json.dumps(message) + "\n"
+        if len(client.outgoing) > MAX_CLIENT_BACKLOG:
+            print "Client %s isn't reading its answers" % client.name
+            self.dropClient(client)
+        elif not queued:
+            self.onClientWritable(client)
+
+    # Sends as much of the client's queued messages as its socket takes, waiting for it to be writable for the rest
+    def onClientWritable(self, client):
+        try:
+            sent = client.sock.send(client.outgoing)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                sent = 0
+            else:
+                self.dropClient(client)
+                return
+        client.outgoing = client.outgoing[sent:]
+        if client.outgoing:
+            self.loop.add_writer(client.fd, self.onClientWritable, client)
+        else:
+            self.loop.remove_writer(client.fd)
+
+    def dropClient(self, client):
+        if self.clients.get(client.fd) is not client:
+            return
+        self.loop.remove_reader(client.fd)
+        self.loop.remove_writer(client.fd)
+        del self.clients[client.fd]
+        client.sock.close()
+        for request in self.pending.values():
+            request.waiters = [waiter for waiter in request.waiters if waiter[0] is not client]
+        print "Client %s disconnected" % client.name
+
+    def run(self):
+        print "Broker listening on " + self.path
+        self.loop.run_forever()
+
+    def stop(self):
+        self.loop.stop()
+
+    def close(self):
+        for client in self.clients.values():
+            self.dropClient(client)
+        self.loop.remove_reader(self.server.fileno())
+        self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.asyncPort.close()
+
+class BrokerPort(OBDPort):
+    """ OBDPort whose requests go through the broker instead of a serial port of its own. The broker
+    owns the adapter's settings, so the target ECU only selects which answer is used. Response counts
+    are learned for this client only, the broker keeps the vehicle's timing file."""
+    def __init__(self, name, priority=PRIORITY_DIAGNOSTICS, path=BROKER_SOCKET, _notify_window=None):
+        self.name = name
+        self.priority = priority
+        self.requestId = 0
+        self.cmd = None
+        self.buffer = ""
+        OBDPort.__init__(self, path, _notify_window, MAX_REQUEST_TIMEOUT, 0, baud=None)
+
+    def open(self, negotiateBaud=False):
+        """Internal use only: connects to the broker, which has set up the adapter already"""
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.portnum)
+            self.sock.settimeout(QUEUE_TIMEOUT)
+            self.sock.sendall(json.dumps({"hello": self.name, "priority": self.priority}) + "\n")
+            hello = self.receive()
+        except socket.error as e:
+            print e
+            self.State = 0
+            return
+        if hello is None:
+            self.State = 0
+            return
+        self.ELMver = str(hello.get("elm", "Unknown"))
+        self.headers = hello.get("headers", True)
+
+    def close(self):
+        if self.State == 1:
+            self.sock.close()
+        self.State = 0
+        self.ELMver = "Unknown"
+
+    def send_command(self, cmd):
+        """Internal use only: the command is sent with its timeout by get_result_lines"""
+        self.cmd = cmd
+        self.sendTime = time.time()
+
+    def get_result_lines(self, timeout=None):
+        """Internal use only: sends the last command to the broker and returns the non-empty lines
+        of the adapter's answer, or None if it timed out"""
+        if self.State == 0 or self.cmd is None:
+            return None
+        if timeout is None:
+            timeout = self.requestTimeout
+        self.requestId += 1
+        try:
+            self.sock.sendall(json.dumps({"id": self.requestId, "cmd": self.cmd, "timeout": timeout}) + "\n")
+            self.cmd = None
+            while 1:
+                reply = self.receive()
+                if reply is None:
+                    self.State = 0
+                    return None
+                # Skip answers to requests that were given up on
+                if reply.get("id") == self.requestId:
+                    break
+        except socket.error as e:
+            print e
+            self.timeoutCount += 1
+            return None
+
+        self.lastLatency = time.time() - self.sendTime
+        self.maxLatency = max(self.maxLatency, self.lastLatency)
+        lines = reply.get("lines")
+        if not lines:
+            self.timeoutCount += 1
+            return None
+        return [str(line) for line in lines]
+
+    def receive(self):
+        """Internal use only: reads the next message from the broker, or None if it has gone"""
+        while "\n" not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            self.buffer = self.buffer + data
+        line, self.buffer = string.split(self.buffer, "\n", 1)
+        return json.loads(line)
+
+    def resync(self):
+        """The broker resynchronises the adapter itself"""
+        pass
+
+    def set_adapter_timeout(self, timeout):
+        """The broker owns the adapter timeout"""
+        pass
+
+    def set_target_ecu(self, ecu):
+        """Prefers the answers of one ECU (0 = engine), or the engine's if ecu is None. Requests
+        still go to every ECU, as the header would change for every client."""
+        self.targetEcu = ecu
+
+    def log(self, sensor_index, filename, duration=None):
+        raise ValueError("Capturing needs the adapter to itself, stop the broker first")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        portnames = [sys.argv[1]]
+    else:
+        portnames = scanSerial()
+
+    port = None
+    for portname in portnames:
+        port = obd_io.OBDPort(portname, None, 2, 2, negotiateBaud=True)
+        if port.State == 1:
+            break
+        port.close()
+        port = None
+    if port is None:
+        print "Not connected"
+        sys.exit(1)
+
+    broker = OBDBroker(port)
+    try:
+        broker.run()
+    except KeyboardInterrupt:
+        pass
+    broker.close()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# This file defines a SocketCAN transport, an alternative to the ELM327 for a CAN interface on the Pi (e.g. a CAN hat).
+# OBD-II requests go straight onto the bus with ISO-TP (ISO 15765-2) framing, avoiding the adapter's command overhead.
+#
+# Python 2 has no AF_CAN support in its socket module, so the raw CAN socket is opened through libc with ctypes.
+
+import os
+import ctypes
+import ctypes.util
+import fcntl
+import select
+import string
+import struct
+import time
+
+import obd_sensors
+from obd_binlog import BinLogWriter
+from obd_io import decode_dtcs, REQUEST_TIMEOUT
+from obd_timing import splitCommand
+from obd_response import OBD_FUNCTIONAL_ID, OBD_REQUEST_ID, OBD_RESPONSE_ID
+
+AF_CAN = 29
+SOCK_RAW = 3
+CAN_RAW = 1
+SOL_CAN_RAW = 101
+CAN_RAW_FILTER = 1
+SIOCGIFINDEX = 0x8933
+
+# struct can_frame: 32 bit id, length, 3 bytes padding, 8 data bytes
+CAN_FRAME = struct.Struct("=IB3x8s")
+
+# Byte used to pad frames to 8 bytes, as ISO 15765-4 requires
+FRAME_PADDING = "\x00"
+
+# Time (in seconds) to wait for more ECUs to answer after a response (ISO 15765-4 P2 timing)
+RESPONSE_GAP_TIMEOUT = 0.05
+
+# Modes whose answers repeat the PID after the mode byte
+PID_MODES = ("\x01", "\x02", "\x09")
+
+# Most PIDs in one mode 01 request (SAE J1979)
+CAPTURE_MAX_PIDS = 6
+
+# ISO-TP frame types (high nibble of the first byte)
+SINGLE_FRAME = 0x0
+FIRST_FRAME = 0x1
+CONSECUTIVE_FRAME = 0x2
+FLOW_CONTROL = 0x3
+
+class sockaddr_can(ctypes.Structure):
+    _fields_ = [("can_family", ctypes.c_ushort),
+                ("can_ifindex", ctypes.c_int),
+                ("rx_id", ctypes.c_uint32),
+                ("tx_id", ctypes.c_uint32)]
+
+class CanSocket:
+    """ Raw CAN socket bound to one interface (e.g. "can0" or "vcan0")"""
+    def __init__(self, interface):
+        self.name = interface
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.fd = self.libc.socket(AF_CAN, SOCK_RAW, CAN_RAW)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not open CAN socket: " + os.strerror(ctypes.get_errno()))
+
+        try:
+            # struct ifreq is the interface name followed by the index
+            ifreq = fcntl.ioctl(self.fd, SIOCGIFINDEX, struct.pack("16si12x", interface, 0))
+            ifindex = struct.unpack("16si12x", ifreq)[1]
+
+            addr = sockaddr_can(AF_CAN, ifindex, 0, 0)
+            if self.libc.bind(self.fd, ctypes.byref(addr), ctypes.sizeof(addr)) < 0:
+                raise OSError(ctypes.get_errno(), "Could not bind to " + interface)
+        except (IOError, OSError):
+            os.close(self.fd)
+            raise
+
+    def fileno(self):
+        return self.fd
+
+    # Only receive frames matching one of the (id, mask) filters
+    def setFilters(self, filters):
+        data = string.join([struct.pack("=II", canId, mask) for canId, mask in filters], "")
+        buf = ctypes.create_string_buffer(data, len(data))
+        if self.libc.setsockopt(self.fd, SOL_CAN_RAW, CAN_RAW_FILTER, buf, len(data)) < 0:
+            raise OSError(ctypes.get_errno(), "Could not set CAN filters")
+
+    def send(self, canId, data):
+        os.write(self.fd, CAN_FRAME.pack(canId, len(data), data))
+
+    # Returns the next (id, data) frame, or None if nothing arrives within timeout seconds
+    def recv(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if not readable:
+            return None
+        canId, length, data = CAN_FRAME.unpack(os.read(self.fd, CAN_FRAME.size))
+        return canId, data[:length]
+
+    # Discards the frames already received, e.g. late answers to an earlier request
+    def drain(self):
+        while self.recv(0) is not None:
+            pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class IsoTp:
+    """ ISO-TP (ISO 15765-2) framing over a CAN socket, for payloads longer than one frame"""
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send(self, txId, payload, flowControlId=None, deadline=None):
+        if len(payload) <= 7:
+            self.sock.send(txId, (chr(len(payload)) + payload).ljust(8, FRAME_PADDING))
+            return True
+
+        # First frame, then consecutive frames at the pace the receiver asks for in its flow control frames
+        self.sock.send(txId, struct.pack(">H", 0x1000 | len(payload)) + payload[:6])
+        sent = 6
+        sequence = 1
+        while sent < len(payload):
+            blockSize, separation = self.waitFlowControl(flowControlId, deadline)
+            if blockSize is None:
+                return False
+            block = 0
+            while sent < len(payload) and (blockSize == 0 or block < blockSize):
+                time.sleep(separation)
+                self.sock.send(txId, (chr(0x20 | sequence) + payload[sent:sent + 7]).ljust(8, FRAME_PADDING))
+                sent += 7
+                sequence = (sequence + 1) & 0x0F
+                block += 1
+        return True
+
+    def waitFlowControl(self, rxId, deadline):
+        while 1:
+            frame = self.sock.recv(deadline - time.time())
+            if frame is None:
+                return None, None
+            canId, data = frame
+            if (rxId is None or canId == rxId) and ord(data[0]) >> 4 == FLOW_CONTROL:
+                flag = ord(data[0]) & 0x0F
+                if flag == 1:
+                    # Wait, another flow control frame follows
+                    continue
+                if flag != 0:
+                    return None, None
+                separation = ord(data[2])
+                if separation <= 0x7F:
+                    separation = separation / 1000.0
+                elif 0xF1 <= separation <= 0xF9:
+                    separation = (separation - 0xF0) / 10000.0
+                else:
+                    separation = 0.127
+                return ord(data[1]), separation
+
+    # Receives whole payloads from the response ids, until deadline or until wanted payloads have arrived.
+    # Returns a list of (id, payload). flowControlIds maps each response id to the id its flow control frames go to.
+    def receive(self, responseIds, flowControlIds, deadline, wanted=None, gapTimeout=None):
+        partial = {}
+        payloads = []
+        while wanted is None or len(payloads) < wanted:
+            timeout = deadline - time.time()
+            if gapTimeout is not None and payloads:
+                timeout = min(timeout, gapTimeout)
+            frame = self.sock.recv(timeout)
+            if frame is None:
+                break
+            canId, data = frame
+            if canId not in responseIds or len(data) == 0:
+                continue
+
+            frameType = ord(data[0]) >> 4
+            if frameType == SINGLE_FRAME:
+                payloads.append((canId, data[1:1 + (ord(data[0]) & 0x0F)]))
+            elif frameType == FIRST_FRAME:
+                length = struct.unpack(">H", data[:2])[0] & 0x0FFF
+                partial[canId] = [length, data[2:], 1]
+                # Clear to send everything, no separation time
+                self.sock.send(flowControlIds[canId], "\x30\x00\x00".ljust(8, FRAME_PADDING))
+            elif frameType == CONSECUTIVE_FRAME and canId in partial:
+                length, received, sequence = partial[canId]
+                if ord(data[0]) & 0x0F != sequence:
+                    # Lost a frame, drop the payload
+                    del partial[canId]
+                    continue
+                received = received + data[1:]
+                if len(received) >= length:
+                    payloads.append((canId, received[:length]))
+                    del partial[canId]
+                else:
+                    partial[canId] = [length, received, (sequence + 1) & 0x0F]
+        return payloads
+
+class CanOBDPort:
+    """ OBD-II over SocketCAN with the same sensor interface as OBDPort. Requests are sent to every ECU
+    (functional addressing) unless a target ECU is set."""
+    def __init__(self, interface, _notify_window, SERTIMEOUT, RECONNATTEMPTS):
+        self.ELMver = "SocketCAN"
+        self.State = 1
+        self.port = None
+        self._notify_window = _notify_window
+        self.requestTimeout = min(REQUEST_TIMEOUT, SERTIMEOUT)
+        self.timeoutCount = 0
+        self.sendTime = None
+        self.lastLatency = 0.0
+        self.maxLatency = 0.0
+
+        # ECU number to send requests to (0 = engine), or None to ask all of them
+        self.targetEcu = None
+
+        try:
+            self.port = CanSocket(interface)
+            self.port.setFilters([(OBD_RESPONSE_ID, 0x7F8)])
+        except (IOError, OSError) as e:
+            print e
+            self.State = 0
+            self.port = None
+            return
+        self.isotp = IsoTp(self.port)
+
+        self.responseIds = range(OBD_RESPONSE_ID, OBD_RESPONSE_ID + 8)
+        self.flowControlIds = {}
+        for i in range(8):
+            self.flowControlIds[OBD_RESPONSE_ID + i] = OBD_REQUEST_ID + i
+
+        # Check something answers
+        if not self.request("\x01\x00"):
+            print "No ECU answered on " + interface
+            self.State = 0
+
+    def close(self):
+        if self.port is not None:
+            self.port.close()
+        self.port = None
+
+    def set_target_ecu(self, ecu):
+        """Sends requests to one ECU only (0 = engine), or to all of them if ecu is None"""
+        self.targetEcu = ecu
+
+    def request(self, payload, allEcus=False, timeout=None):
+        """Sends a request and returns the list of (ECU response id, payload) answers. Unless allEcus
+        is set it returns after the first positive answer."""
+        if timeout is None:
+            timeout = self.requestTimeout
+
+        if self.targetEcu is None:
+            txId = OBD_FUNCTIONAL_ID
+            responseIds = self.responseIds
+        else:
+            txId = OBD_REQUEST_ID + self.targetEcu
+            responseIds = [OBD_RESPONSE_ID + self.targetEcu]
+            allEcus = False
+
+        # Answers to this request start with the mode + 0x40 and the PID, negative responses with 0x7F and the mode.
+        # Anything else is a late answer to an earlier request from a slower ECU.
+        positive = chr(ord(payload[0]) + 0x40)
+        if payload[:1] in PID_MODES:
+            positive = positive + payload[1:2]
+        negative = "\x7F" + payload[:1]
+
+        self.port.drain()
+        start = time.time()
+        deadline = start + timeout
+        self.sendTime = start
+        self.isotp.send(txId, payload, None, deadline)
+
+        answers = []
+        gapDeadline = deadline
+        while time.time() < gapDeadline:
+            if allEcus:
+                received = self.isotp.receive(responseIds, self.flowControlIds, gapDeadline, None,
+                                              RESPONSE_GAP_TIMEOUT)
+            else:
+                received = self.isotp.receive(responseIds, self.flowControlIds, gapDeadline, 1)
+            if not received:
+                break
+            for canId, data in received:
+                if data.startswith(positive) or data.startswith(negative):
+                    answers.append((canId, data))
+            if not allEcus:
+                if [answer for answer in answers if answer[1].startswith(positive)]:
+                    break
+                if answers:
+                    # Only negative responses so far, give the other ECUs a moment to answer
+                    gapDeadline = min(deadline, time.time() + RESPONSE_GAP_TIMEOUT)
+
+        # A negative response (0x7F) is an answer, the ECU saying it has no data (NODATA on the ELM327), so only
+        # silence counts as a timeout. Only the positive answers are returned.
+        if len(answers) == 0:
+            self.timeoutCount += 1
+        else:
+            self.lastLatency = time.time() - start
+            self.maxLatency = max(self.maxLatency, self.lastLatency)
+        return [(canId, data) for canId, data in answers if data.startswith(positive)]
+
+    # get sensor value from command
+    def updateSensor(self, sensor):
+        """Gets the latest value from OBD and updates it"""
+        cmd = splitCommand(sensor.cmd)[0]
+        answers = self.request(cmd.decode("hex"))
+        if answers:
+            # Feed the sensor the same hex data as the ELM327 would, without the mode and PID, timed at the middle of
+            # the request and the answer, when the ECU sampled the value
+            sensor.update(answers[0][1][2:].encode("hex").upper(), self.sendTime + self.lastLatency / 2.0)
+        # Otherwise the sensor keeps its last value, which ages until it is flagged as stale
+
+    def updateSensorByIndex(self, sensor_index):
+        self.updateSensor(obd_sensors.SENSORS[sensor_index])
+
+    def log(self, sensor_index, filename, duration=None):
+        """Captures one or more sensors (an index or list of indexes) as fast as the ECU answers into a
+        binary log (see obd_binlog), for duration seconds or until Ctrl C is pressed. All channels are
+        requested at once, from the first ECU to answer."""
+        if type(sensor_index) != list:
+            sensor_index = [sensor_index]
+        if len(sensor_index) > CAPTURE_MAX_PIDS:
+            raise ValueError("Too many channels to capture at once")
+        sensors = [obd_sensors.SENSORS[i] for i in sensor_index]
+
+        # Request each PID on its own first to find the length of its data
+        pids = {}
+        for i in range(len(sensors)):
+            pid = splitCommand(sensors[i].cmd)[0][2:4].decode("hex")
+            answers = self.request("\x01" + pid)
+            if not answers:
+                raise ValueError("No response from sensor " + sensors[i].shortname)
+            pids[pid] = (len(answers[0][1]) - 2, sensors[i].valueParserFunc, sensor_index[i])
+
+        channels = {}
+        for i in range(len(sensors)):
+            channels[sensor_index[i]] = sensors[i].shortname
+        writer = BinLogWriter(filename, channels, None, {"mode": "capture"})
+
+        payload = "\x01" + string.join([splitCommand(s.cmd)[0][2:4].decode("hex") for s in sensors], "")
+        write = writer.write
+        start = time.time()
+        try:
+            while duration is None or time.time() - start < duration:
+                answers = self.request(payload)
+                if not answers:
+                    continue
+                # The ECU sampled the values between the request and the answer, so they are timed at the middle
+                sampleTime = self.sendTime + self.lastLatency / 2.0
+
+                # Answer is the mode byte, then each PID followed by its data
+                data = answers[0][1]
+                i = 1
+                while i < len(data):
+                    entry = pids.get(data[i])
+                    if entry is None:
+                        break
+                    write(sampleTime, entry[2], entry[1](data[i + 1:i + 1 + entry[0]].encode("hex").upper()))
+                    i += 1 + entry[0]
+        except KeyboardInterrupt:
+            pass
+        finally:
+            elapsed = time.time() - start
+            writer.close()
+
+        print "Captured %d samples in %.1fs: %.1f samples/sec" % (writer.count, elapsed, writer.count / elapsed)
+        return writer.count
+
+    def getSensorTuple(self, sensor_index):
+        sensor = obd_sensors.SENSORS[sensor_index]
+        return sensor.name, sensor.value, sensor.unit
+
+    def getSensorFormatted(self, sensor_index):
+        return obd_sensors.SENSORS[sensor_index].getFormattedValue()
+
+    def sensor_names(self):
+        return [s.name for s in obd_sensors.SENSORS]
+
+    def get_dtc(self):
+        """Returns a list of [status, DTC code] pairs from every ECU, stored (mode 03) and freeze frame (mode 07)"""
+        DTCCodes = []
+        for mode, status in (("\x03", "Active"), ("\x07", "Passive")):
+            for canId, data in self.request(mode, True):
+                # On CAN the response holds a DTC count, then two bytes per DTC
+                codes = data[2:].encode("hex").upper()
+                for i in range(0, len(codes), 12):
+                    chunk = codes[i:i + 12].ljust(12, "0")
+                    line = "43 " + string.join([chunk[j:j + 2] for j in range(0, 12, 2)], " ")
+                    DTCCodes.extend(decode_dtcs(line, status))
+        return DTCCodes
+
+    def clear_dtc(self):
+        """Clears all DTCs and freeze frame data"""
+        answers = self.request("\x04", True)
+        return string.join([data.encode("hex").upper() for canId, data in answers], "\r")
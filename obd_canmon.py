@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# This file defines the passive CAN listener. Many cars broadcast rpm, speed, coolant etc. on the bus without being
+# asked, so configured broadcast frames can be decoded straight into the sensors with no polling at all.
+# Frames come from a SocketCAN interface or an ELM327 in monitor-all mode (AT MA).
+#
+# Broadcast frame ids and layouts are specific to the make and model. They are configured in a signals file with
+# one signal per line: frame id (hex), sensor short name, start byte, length in bytes, scale, offset and optionally
+# the byte order ("be" for big endian, the default, or "le"), e.g.
+#
+#   316 rpm 2 2 0.25 0 le
+#
+# meaning rpm = (bytes 2-3 of frame 0x316 as a little endian number) * 0.25 + 0.
+
+import os
+import errno
+import fcntl
+import re
+import select
+import string
+import struct
+import threading
+import time
+
+import obd_sensors
+from obd_can import CanSocket, CAN_FRAME
+from obd_io import ABORT_CHARACTER
+
+# Most frames read from the source before they are decoded together
+BATCH_SIZE = 256
+
+# Time (in seconds) to wait for frames when none are pending
+BATCH_TIMEOUT = 0.1
+
+# Unsigned formats by length in bytes
+FIELD_FORMATS = {1: "B", 2: "H", 4: "I"}
+
+class BroadcastSignal:
+    def __init__(self, frameId, shortname, start, length, scale=1.0, offset=0.0, bigEndian=True):
+        self.frameId = frameId
+        self.bigEndian = bigEndian
+        self.shortname = shortname
+        self.start = start
+        self.length = length
+        self.scale = scale
+        self.offset = offset
+
+# Reads a signals file (see above). Returns a list of BroadcastSignal. Bad signals are reported and left out.
+def loadSignals(filename):
+    signals = []
+    f = open(filename, "r")
+    lineNumber = 0
+    for line in f:
+        lineNumber += 1
+        fields = string.split(line)
+        if len(fields) == 0 or fields[0][0] == "#":
+            continue
+        bigEndian = len(fields) < 7 or fields[6] != "le"
+        try:
+            signal = BroadcastSignal(int(fields[0], 16), fields[1], int(fields[2]), int(fields[3]), float(fields[4]),
+                                     float(fields[5]), bigEndian)
+        except (ValueError, IndexError):
+            print "%s line %d: bad signal %s" % (filename, lineNumber, string.strip(line))
+            continue
+        if signal.length not in FIELD_FORMATS:
+            print "%s line %d: %s is %d bytes long, only %s are supported" % (
+                filename, lineNumber, signal.shortname, signal.length,
+                string.join([str(length) for length in sorted(FIELD_FORMATS)], ", "))
+            continue
+        if signal.start < 0 or signal.start + signal.length > 8:
+            print "%s line %d: %s doesn't fit in a frame" % (filename, lineNumber, signal.shortname)
+            continue
+        signals.append(signal)
+    f.close()
+    return signals
+
+class BroadcastDecoder:
+    """ Decodes batches of (timestamp, id, data) frames into sensor values. Within a batch only the latest
+    frame of each id is decoded, so a saturated bus costs a dictionary store per frame."""
+    def __init__(self, signals, sensors=None):
+        if sensors is None:
+            sensors = {}
+            for sensor in obd_sensors.SENSORS:
+                sensors[sensor.shortname] = sensor
+
+        # Frame id -> list of (unpack, start, end, scale, offset, sensor), compiled once
+        self.decoders = {}
+        for signal in signals:
+            sensor = sensors.get(signal.shortname)
+            if sensor is None:
+                print "No sensor called " + signal.shortname
+                continue
+            if signal.bigEndian:
+                unpack = struct.Struct(">" + FIELD_FORMATS[signal.length]).unpack
+            else:
+                unpack = struct.Struct("<" + FIELD_FORMATS[signal.length]).unpack
+            self.decoders.setdefault(signal.frameId, []).append(
+                (unpack, signal.start, signal.start + signal.length, signal.scale, signal.offset, sensor))
+
+        self.frameIds = self.decoders.keys()
+        self.shortnames = [signal.shortname for signal in signals if signal.shortname in sensors]
+        self.frameCount = 0
+
+    def decodeBatch(self, frames):
+        latest = {}
+        decoders = self.decoders
+        for frame in frames:
+            if frame[1] in decoders:
+                latest[frame[1]] = frame
+        self.frameCount += len(frames)
+
+        for timestamp, frameId, data in latest.itervalues():
+            for unpack, start, end, scale, offset, sensor in decoders[frameId]:
+                if len(data) >= end:
+                    sensor.setValue(unpack(data[start:end])[0] * scale + offset, timestamp)
+
+class SocketCanSource:
+    """ Reads frames from a SocketCAN interface, with the kernel filtering out everything but the wanted ids"""
+    def __init__(self, interface, frameIds):
+        self.port = CanSocket(interface)
+        self.port.setFilters([(frameId, 0x7FF) for frameId in frameIds])
+        flags = fcntl.fcntl(self.port.fileno(), fcntl.F_GETFL)
+        fcntl.fcntl(self.port.fileno(), fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    # Returns up to BATCH_SIZE frames, waiting up to timeout seconds if none are pending
+    def readBatch(self, timeout):
+        fd = self.port.fileno()
+        readable, _, _ = select.select([fd], [], [], timeout)
+        if not readable:
+            return []
+        now = time.time()
+        unpack = CAN_FRAME.unpack
+        frames = []
+        try:
+            while len(frames) < BATCH_SIZE:
+                canId, length, data = unpack(os.read(fd, CAN_FRAME.size))
+                frames.append((now, canId, data[:length]))
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return frames
+
+    def close(self):
+        self.port.close()
+
+class ElmMonitorSource:
+    """ Reads frames from an ELM327 in monitor-all mode, using an initialised OBDPort. The adapter's
+    receive filter is set to the wanted ids, as it can't forward a saturated bus over the serial link."""
+    def __init__(self, obdPort, frameIds):
+        self.obdPort = obdPort
+        self.port = obdPort.port
+        self.port.timeout = BATCH_TIMEOUT
+        self.buffer = ""
+
+        # Time of the last read, which no frame read after it can be older than, and the times monitoring was restarted
+        self.lastRead = time.time()
+        self.restartCount = 0
+
+        # Headers on, spaces off and CAN auto formatting off so each line is the 3 digit id followed by the data
+        commands = ["ath1", "ats0", "atcaf0"]
+        if frameIds:
+            # Filter on the bits the ids have in common
+            mask = 0x7FF
+            for frameId in frameIds:
+                mask &= ~(frameId ^ frameIds[0])
+            commands += ["atcf %03X" % (frameIds[0] & mask), "atcm %03X" % mask]
+        for cmd in commands:
+            obdPort.send_command(cmd)
+            obdPort.get_result(obdPort.initTimeout)
+        obdPort.send_command("atma")
+
+    # Returns the frames in the lines received so far, waiting up to timeout seconds if nothing is pending. Lines that
+    # arrived in the same read are timed back from the end of the read by the time the bytes after them took on the
+    # serial link, rather than all at the time of the read.
+    def readBatch(self, timeout):
+        if self.port.timeout != timeout:
+            self.port.timeout = timeout
+        data = self.port.read(self.port.inWaiting() or 1)
+        if not data:
+            return []
+        now = time.time()
+        data = self.buffer + data
+
+        # The adapter stops monitoring (after "BUFFER FULL" if it fell behind) and returns to the prompt
+        stopped = ">" in data
+        if stopped:
+            data = data[:data.index(">")]
+            self.buffer = ""
+        else:
+            end = data.rfind("\r") + 1
+            self.buffer = data[end:]
+            data = data[:end]
+
+        byteTime = 10.0 / self.port.baudrate
+        frames = []
+        offset = 0
+        for line in string.split(data, "\r"):
+            offset += len(line) + 1
+            line = string.strip(line)
+            if len(line) < 3 or len(line) % 2 == 0:
+                # Not a frame, e.g. "BUFFER FULL" (odd lengths are the 3 digit id plus whole bytes)
+                continue
+            timestamp = max(now - (len(data) - offset) * byteTime, self.lastRead)
+            try:
+                frames.append((timestamp, int(line[:3], 16), line[3:].decode("hex")))
+            except (ValueError, TypeError):
+                pass
+        self.lastRead = now
+
+        if stopped:
+            print "Monitoring stopped, restarting"
+            self.restartCount += 1
+            self.obdPort.send_command("atma")
+        return frames
+
+    def close(self):
+        # Any character stops monitoring
+        self.port.write(ABORT_CHARACTER)
+        self.obdPort.read_until(">", 1.0)
+        for cmd in ["atcaf1", "ats1", self.obdPort.headers and "ath1" or "ath0", "atcra"]:
+            self.obdPort.send_command(cmd)
+            self.obdPort.get_result(self.obdPort.initTimeout)
+        self.obdPort.close()
+
+# "(1436509052.249713) vcan0 316#0000BC1F" as written by candump -l
+CANDUMP_LOG_LINE = re.compile(r"\((\d+\.\d+)\)\s+\S+\s+([0-9A-Fa-f]+)#([0-9A-Fa-f]*)")
+
+# Reads a candump log file, returning a list of (timestamp, id, data) frames
+def readCandump(filename):
+    frames = []
+    f = open(filename, "r")
+    for line in f:
+        match = CANDUMP_LOG_LINE.match(line)
+        if match:
+            frames.append((float(match.group(1)), int(match.group(2), 16), match.group(3).decode("hex")))
+    f.close()
+    return frames
+
+class PassiveOBDPort:
+    """ Sensor interface (like OBDPort) for the passive listener. Values arrive from the listener thread,
+    so updating a sensor is free. Sensors that aren't broadcast are never updated and show as stale."""
+    def __init__(self, source, decoder):
+        self.ELMver = "Passive"
+        self.State = 1
+        self.source = source
+        self.port = getattr(source, "port", None)
+        self.decoder = decoder
+        self.running = True
+        self.thread = threading.Thread(target=self.listen)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def listen(self):
+        while self.running:
+            self.decoder.decodeBatch(self.source.readBatch(BATCH_TIMEOUT))
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.source.close()
+
+    def updateSensor(self, sensor):
+        pass
+
+    def updateSensorByIndex(self, sensor_index):
+        pass
+
+    def getSensorTuple(self, sensor_index):
+        sensor = obd_sensors.SENSORS[sensor_index]
+        return sensor.name, sensor.value, sensor.unit
+
+    def getSensorFormatted(self, sensor_index):
+        return obd_sensors.SENSORS[sensor_index].getFormattedValue()
+
+    def get_dtc(self):
+        return []
+
+    def clear_dtc(self):
+        return None
@@ -1,12 +1,31 @@
 #!/usr/bin/env python
 
 import obd_io
+import obd_can
+import obd_canmon
 import obd_sensors
+import obd_shm
+import obd_broker
 from datetime import datetime
 import time
+import sys
 
 from obd_utils import scanSerial
 
+# Try to raise the serial link above the ELM327 default of 38400 baud when connecting
+NEGOTIATE_BAUD = True
+
+# "elm" to use an ELM327 adapter on a Bluetooth/USB serial port, "socketcan" to talk directly to the
+# bus through a SocketCAN interface (e.g. a CAN hat), "passive" to only listen to broadcast frames,
+# "shared" to read the values published by the acquisition daemon (pigauge_daemon.py), or "broker" to
+# share an adapter with other programs through the port broker (obd_broker.py)
+TRANSPORT = "elm"
+CAN_INTERFACE = "can0"
+
+# Passive listening: where frames come from ("socketcan" or "elm") and the broadcast signals file (see obd_canmon)
+PASSIVE_SOURCE = "socketcan"
+PASSIVE_SIGNALS_FILE = "broadcast_signals.txt"
+
 class OBD_Capture:
     def __init__(self):
         self.supportedSensorList = []
@@ -15,10 +34,39 @@ class OBD_Capture:
 
     # Connect to available Bluetooth/USB serial port, get ELM version, set CAN mode
     def connect(self):
+        if TRANSPORT == "socketcan":
+            self.port = obd_can.CanOBDPort(CAN_INTERFACE, None, 2, 2)
+            if self.port.State == 0:
+                self.port.close()
+                self.port = None
+            else:
+                print "Connected to " + CAN_INTERFACE
+            return
+
+        if TRANSPORT == "passive":
+            self.connect_passive()
+            return
+
+        if TRANSPORT == "broker":
+            self.port = obd_broker.BrokerPort("dashboard", obd_broker.PRIORITY_DASHBOARD)
+            if self.port.State == 0:
+                self.port = None
+            else:
+                print "Connected to the broker at " + self.port.portnum
+            return
+
+        if TRANSPORT == "shared":
+            self.port = obd_shm.SharedOBDPort()
+            if self.port.State == 0:
+                self.port = None
+            else:
+                print "Reading live values from " + self.port.name
+            return
+
         portnames = scanSerial()
         print portnames
         for port in portnames:
-            self.port = obd_io.OBDPort(port, None, 2, 2)
+            self.port = obd_io.OBDPort(port, None, 2, 2, negotiateBaud=NEGOTIATE_BAUD)
             if self.port.State == 0:
                 self.port.close()
                 self.port = None
@@ -28,6 +76,24 @@ class OBD_Capture:
         if self.port:
             print "Connected to "+self.port.port.name
             
+    # Listen to broadcast frames, through SocketCAN or the first ELM327 found
+    def connect_passive(self):
+        decoder = obd_canmon.BroadcastDecoder(obd_canmon.loadSignals(PASSIVE_SIGNALS_FILE))
+        if PASSIVE_SOURCE == "socketcan":
+            source = obd_canmon.SocketCanSource(CAN_INTERFACE, decoder.frameIds)
+        else:
+            source = None
+            for port in scanSerial():
+                elm = obd_io.OBDPort(port, None, 2, 2)
+                if elm.State == 1:
+                    source = obd_canmon.ElmMonitorSource(elm, decoder.frameIds)
+                    break
+                elm.close()
+            if source is None:
+                return
+        self.port = obd_canmon.PassiveOBDPort(source, decoder)
+        print "Listening on " + self.port.port.name
+
     def is_connected(self):
         return self.port
         
@@ -35,6 +101,11 @@ class OBD_Capture:
         return self.supportedSensorList 
 
     def capture_data(self):
+        if TRANSPORT == "passive":
+            return self.capture_passive()
+        if TRANSPORT == "shared":
+            return self.capture_shared()
+
         # Find supported sensors - by getting PIDs from OBD
         # its a string of binary 01010101010101 
         # 1 means the sensor is supported
@@ -74,8 +145,46 @@ class OBD_Capture:
 
         print "Initial sensor values:"
         print text
+
+        if TRANSPORT == "elm":
+            (baud, throughput) = self.port.get_link_stats()
+            print "Link speed: %d baud, measured %.0f bytes/sec" % (baud, throughput)
+        return text
+
+    # When listening passively the supported sensors are the ones with broadcast signals configured
+    def capture_passive(self):
+        self.supportedSensorList = []
+        for i in range(len(obd_sensors.SENSORS)):
+            if obd_sensors.SENSORS[i].shortname in self.port.decoder.shortnames:
+                self.supportedSensorList.append([i, obd_sensors.SENSORS[i]])
+        text = ""
+        for supportedSensor in self.supportedSensorList:
+            text += "broadcast sensor = " + supportedSensor[1].shortname + "\n"
+        print text
+        return text
+
+    # When reading the live value bus the supported sensors are the ones the daemon has published
+    def capture_shared(self):
+        self.supportedSensorList = []
+        for i in self.port.getPublishedSensors():
+            self.supportedSensorList.append([i, obd_sensors.SENSORS[i]])
+        text = ""
+        for supportedSensor in self.supportedSensorList:
+            text += "published sensor = " + supportedSensor[1].shortname + "\n"
+        print text
         return text
 
+    # Captures one or two sensors (by short name) at the highest rate the adapter manages into a binary log
+    def capture_fast(self, shortnames, filename, duration=None):
+        indexes = []
+        for shortname in shortnames:
+            for i in range(len(obd_sensors.SENSORS)):
+                if obd_sensors.SENSORS[i].shortname == shortname:
+                    indexes.append(i)
+        return self.port.log(indexes, filename, duration)
+
+# Usage: obd_capture.py                                 (print the supported sensors and their values)
+#        obd_capture.py capture <file> <seconds> <sensor> [sensor]   (max rate capture, e.g. capture rpm.log 30 rpm speed)
 if __name__ == "__main__":
 
     o = OBD_Capture()
@@ -83,5 +192,7 @@ if __name__ == "__main__":
     time.sleep(3)
     if not o.is_connected():
         print "Not connected"
+    elif len(sys.argv) > 4 and sys.argv[1] == "capture":
+        o.capture_fast(sys.argv[4:], sys.argv[2], float(sys.argv[3]))
     else:
         o.capture_data()
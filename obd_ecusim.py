@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# Scripted ECU responder for testing the SocketCAN transport on a virtual CAN interface:
+#
+#   sudo ip link add dev vcan0 type vcan && sudo ip link set up vcan0
+#   python obd_ecusim.py vcan0 [script]
+#
+# It can also replay a candump log (candump -l) onto the interface in real time, to test the passive listener:
+#
+#   python obd_ecusim.py vcan0 --replay candump.log
+#
+# A script has one response per line: the request in hex followed by the response data bytes, e.g. "010C 1A F8".
+# When a request has several lines they are answered in turn, so values can change over time. Lines starting
+# with '#' are comments.
+
+import sys
+import string
+import time
+
+from obd_can import CanSocket, IsoTp, OBD_FUNCTIONAL_ID, OBD_REQUEST_ID, OBD_RESPONSE_ID
+from obd_canmon import readCandump
+
+# Used when no script is given: supported PIDs, load, coolant, rpm, speed, MAF, run time and one stored DTC
+DEFAULT_SCRIPT = """
+0100 BE 3E B8 11
+0104 80
+0105 7B
+010C 1A F8
+010C 1B 58
+010C 1C 20
+010D 3C
+010D 3E
+0110 05 DC
+011F 00 3C
+03 01 01 33
+07 00
+04
+"""
+
+class ScriptedECU:
+    def __init__(self, sock, ecu=0, script=DEFAULT_SCRIPT):
+        self.sock = sock
+        self.isotp = IsoTp(sock)
+        self.requestId = OBD_REQUEST_ID + ecu
+        self.responseId = OBD_RESPONSE_ID + ecu
+
+        # Request bytes -> list of response data, and the index of the next response to give
+        self.responses = {}
+        self.next = {}
+        self.parse(script)
+
+    def parse(self, script):
+        for line in string.split(script, "\n"):
+            fields = string.split(line)
+            if len(fields) == 0 or fields[0][0] == "#":
+                continue
+            request = fields[0].upper().decode("hex")
+            self.responses.setdefault(request, []).append(string.join(fields[1:], "").decode("hex"))
+            self.next[request] = 0
+
+    def load(self, filename):
+        f = open(filename, "r")
+        self.parse(f.read())
+        f.close()
+
+    # Returns the response payload for a request payload, or None if the ECU doesn't answer it
+    def respond(self, request):
+        responses = self.responses.get(request)
+        if responses is None:
+            return None
+        data = responses[self.next[request] % len(responses)]
+        self.next[request] += 1
+        return chr(ord(request[0]) + 0x40) + request[1:] + data
+
+    def run(self, duration=None):
+        start = time.time()
+        while duration is None or time.time() - start < duration:
+            frame = self.sock.recv(0.5)
+            if frame is None:
+                continue
+            canId, data = frame
+            # Requests are always single frames
+            if canId not in (OBD_FUNCTIONAL_ID, self.requestId) or len(data) == 0 or ord(data[0]) >> 4 != 0:
+                continue
+            response = self.respond(data[1:1 + ord(data[0])])
+            if response is not None:
+                self.isotp.send(self.responseId, response, self.requestId, time.time() + 1.0)
+
+# Sends the frames of a candump log with their original timing (or as fast as possible if realtime is False)
+def replayCandump(filename, sock, realtime=True):
+    frames = readCandump(filename)
+    if len(frames) == 0:
+        return 0
+    start = time.time() - frames[0][0]
+    for timestamp, canId, data in frames:
+        if realtime:
+            delay = start + timestamp - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        sock.send(canId, data)
+    return len(frames)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Usage: obd_ecusim.py <interface> [script | --replay candump.log]"
+        sys.exit(1)
+    if len(sys.argv) > 3 and sys.argv[2] == "--replay":
+        print "Replayed %d frames" % replayCandump(sys.argv[3], CanSocket(sys.argv[1]))
+        sys.exit(0)
+    ecu = ScriptedECU(CanSocket(sys.argv[1]))
+    if len(sys.argv) > 2:
+        ecu.responses = {}
+        ecu.load(sys.argv[2])
+    print "ECU responding on " + sys.argv[1]
+    ecu.run()
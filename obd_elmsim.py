@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# Simulated ELM327 adapters on pseudo terminals, for testing without a car:
+#
+#   python obd_elmsim.py [count]
+#
+# prints the pty name of each simulated adapter (e.g. /dev/pts/3), which can be opened with OBDPort like a real one.
+# The simulated car answers the common mode 01 PIDs with values that change over time, has one stored DTC and
+# reports its VIN. An adapter can be given several ECUs, e.g. ("7E8", "7E9") for an engine and transmission, in which
+# case the transmission also answers the supported PIDs and speed requests.
+
+import os
+import sys
+import math
+import select
+import string
+import threading
+import time
+import tty
+
+# Seconds the simulated ECU takes to answer, and the extra time the adapter waits for more answers when the
+# request has no response count digit (its AT ST timeout)
+ECU_DELAY = 0.01
+ADAPTER_TIMEOUT = 0.05
+
+# Seconds between answering AT BRD and sending the ID at the new rate, which gives the host time to switch rates
+BAUD_SWITCH_DELAY = 0.02
+
+# PIDs the ECUs other than the engine answer
+OTHER_ECU_PIDS = [0x00, 0x0D]
+
+VIN = "1D4GP00R55B123456"
+
+class SimulatedCar:
+    """ Values of the simulated car, shared by all the adapters plugged into it"""
+    def __init__(self):
+        self.start = time.time()
+
+    # Returns the data bytes an ECU (0 = engine) answers for a mode 01 PID, or None if it isn't supported
+    def pidData(self, pid, ecu=0):
+        if ecu != 0 and pid not in OTHER_ECU_PIDS:
+            return None
+        t = time.time() - self.start
+        rpm = int((2000 + 1500 * math.sin(t)) * 4)
+        data = {
+            0x00: [0xBE, 0x3E, 0xB8, 0x11],
+            0x04: [int(128 + 100 * math.sin(t))],
+            0x05: [int(40 + 80 + 15 * math.sin(t / 10))],
+            0x0B: [int(100 + 50 * math.sin(t))],
+            0x0C: [rpm >> 8, rpm & 0xFF],
+            0x0D: [int(60 + 40 * math.sin(t / 3))],
+            0x0F: [65],
+            0x10: [0x05, 0xDC],
+            0x11: [int(128 + 100 * math.sin(t))],
+            0x1F: [int(t) >> 8, int(t) & 0xFF],
+        }
+        return data.get(pid)
+
+class SimulatedELM:
+    def __init__(self, car, ecus=("7E8",)):
+        self.car = car
+        self.ecus = ecus
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.name = os.ttyname(self.slave)
+        self.reset()
+        self.running = False
+
+    def reset(self):
+        self.echo = True
+        self.headers = False
+        self.spaces = True
+        self.last = ""
+
+        # Seconds the host has to confirm a new rate (AT BRT)
+        self.baudConfirmTimeout = 0.075
+
+        # Request header (AT SH) and the address answers are accepted from (AT CRA, None for all)
+        self.header = "7DF"
+        self.receiveAddress = None
+
+    # Returns the ECUs a request reaches, and that the adapter passes the answers of
+    def addressedEcus(self):
+        ecus = []
+        for ecu in self.ecus:
+            if self.header != "7DF" and int(self.header, 16) + 8 != int(ecu, 16):
+                continue
+            if self.receiveAddress is not None and self.receiveAddress != ecu:
+                continue
+            ecus.append(ecu)
+        return ecus
+
+    # Returns the lines of an ECU's answer, split into CAN frames as an ELM327 shows them
+    def format(self, ecu, data):
+        separator = " " if self.spaces else ""
+        if len(data) <= 7:
+            frames = [[len(data)] + data]
+            if not self.headers:
+                return string.join(["%02X" % b for b in data], separator)
+        else:
+            # First frame with the 12 bit length, then consecutive frames numbered from 1
+            frames = [[0x10 | (len(data) >> 8), len(data) & 0xFF] + data[:6]]
+            for i in range(6, len(data), 7):
+                frames.append([0x20 | (len(frames) % 16)] + data[i:i + 7])
+            if not self.headers:
+                lines = ["%03X" % len(data), "0:" + separator + string.join(["%02X" % b for b in data[:6]], separator)]
+                for i in range(1, len(frames)):
+                    bytes = ["%02X" % b for b in frames[i][1:]]
+                    lines.append("%X:" % (i % 16) + separator + string.join(bytes, separator))
+                return string.join(lines, "\r")
+        lines = []
+        for frame in frames:
+            # Frames are padded to 8 bytes
+            frame = frame + [0x00] * (8 - len(frame))
+            lines.append(string.join([ecu] + ["%02X" % b for b in frame], separator))
+        return string.join(lines, "\r")
+
+    def handle(self, cmd):
+        cmd = string.upper(string.replace(cmd, " ", ""))
+        if cmd == "":
+            # Empty command repeats the last one
+            cmd = self.last
+        self.last = cmd
+
+        if cmd[:2] == "AT":
+            return self.handleAt(cmd[2:])
+
+        if cmd[:2] == "01" and len(cmd) >= 4:
+            body = cmd[2:]
+            count = None
+            if len(body) % 2 == 1:
+                count = int(body[-1])
+                body = body[:-1]
+            answers = []
+            for ecu in self.addressedEcus():
+                data = [0x41]
+                for j in range(0, len(body), 2):
+                    # ECU n answers from 7E8 + n
+                    pidData = self.car.pidData(int(body[j:j + 2], 16), int(ecu, 16) - 0x7E8)
+                    if pidData is not None:
+                        data += [int(body[j:j + 2], 16)] + pidData
+                if len(data) > 1:
+                    answers.append(self.format(ecu, data))
+            if count is None:
+                time.sleep(ADAPTER_TIMEOUT)
+            else:
+                answers = answers[:count]
+            if len(answers) == 0:
+                return "NO DATA"
+            return string.join(answers, "\r")
+
+        # The other modes are only answered by the engine
+        if "7E8" not in self.addressedEcus():
+            return "NO DATA"
+        if cmd == "03":
+            return self.format("7E8", [0x43, 0x01, 0x33, 0x00, 0x00, 0x00, 0x00])
+        if cmd == "04":
+            return self.format("7E8", [0x44])
+        if cmd == "07":
+            return "NO DATA"
+        if cmd == "0902":
+            return self.format("7E8", [0x49, 0x02, 0x01] + [ord(c) for c in VIN])
+        return "?"
+
+    def handleAt(self, cmd):
+        if cmd == "Z":
+            self.reset()
+            return "\r\rELM327 v1.5"
+        if cmd == "I":
+            return "ELM327 v1.5"
+        if cmd in ("E0", "E1"):
+            self.echo = cmd == "E1"
+        elif cmd in ("H0", "H1"):
+            self.headers = cmd == "H1"
+        elif cmd in ("S0", "S1"):
+            self.spaces = cmd == "S1"
+        elif cmd[:2] == "SH":
+            self.header = cmd[2:]
+        elif cmd[:3] == "CRA":
+            self.receiveAddress = cmd[3:] or None
+        elif cmd[:3] == "BRT":
+            self.baudConfirmTimeout = int(cmd[3:], 16) * 0.005
+        elif cmd[:3] == "BRD":
+            # Switch rates: OK, then the ID at the new rate once the host has had time to switch. A pty has no real
+            # rate, so the host's confirmation is read if it comes within the AT BRT timeout.
+            os.write(self.master, "OK\r")
+            time.sleep(BAUD_SWITCH_DELAY)
+            os.write(self.master, "ELM327 v1.5\r")
+            readable, _, _ = select.select([self.master], [], [], self.baudConfirmTimeout)
+            if readable:
+                os.read(self.master, 64)
+            return ""
+        return "OK"
+
+    def run(self):
+        self.running = True
+        buffer = ""
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.5)
+            if not readable:
+                continue
+            buffer = buffer + os.read(self.master, 1024)
+            while "\r" in buffer:
+                line, buffer = string.split(buffer, "\r", 1)
+                line = string.strip(line, "\n")
+                time.sleep(ECU_DELAY)
+                response = self.handle(line)
+                if self.echo:
+                    response = line + "\r" + response
+                os.write(self.master, response + "\r\r>")
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.running = False
+
+if __name__ == "__main__":
+    count = 1
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    car = SimulatedCar()
+    adapters = [SimulatedELM(car) for i in range(count)]
+    for adapter in adapters:
+        adapter.start()
+        print adapter.name
+    sys.stdout.flush()
+    try:
+        while 1:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
@@ -7,12 +7,21 @@
 ###########################################################################
 #-------------------------------------------------------------------------------
 
-import os
+import math
+import time
 import wx
 
 from obd_loading import *
 from pigauge_features import *
 from obd_sensors import Sensor
+from pigauge_history import HistoryStore
+from pigauge_triggers import TriggerEngine
+from pigauge_rules import RuleEngine
+from pigauge_anomaly import AnomalyDetector
+from pigauge_thermal import ThermalModel
+from pigauge_heatmap import ResidencyHeatmaps
+from pigauge_tripstore import TripStore
+from obd_scheduler import Channel, ChannelScheduler
 
 #-------------------------------------------------------------------------------
 
@@ -22,6 +31,15 @@ GAUGE_FILENAME = "frame_C2.jpg"
 # Global update interval in milliseconds (this triggers the updating of the OBD sensors)
 GLOBAL_UPDATE_INTERVAL = 400
 
+# Time budget in milliseconds for polling sensors within one update. Sensors that don't fit are polled
+# first on the next update. A tick can overrun this by at most one request deadline and the resync after it
+# (obd_io.REQUEST_TIMEOUT + obd_io.RESYNC_TIMEOUT).
+TICK_POLL_BUDGET = 300
+
+# Sensor values older than this (in seconds) are greyed out rather than shown as live
+STALE_SENSOR_AGE = 2.0
+STALE_SENSOR_COLOUR = '#808080'
+
 # True = speedometer style UI
 # False = gauge pod style UI
 SPEEDOMETER_STYLE = True
@@ -64,6 +82,14 @@ def CreateSensorValText(theParent, sensor):
     tSensorVal.SetForegroundColour('WHITE')
     return tSensorVal
 
+# Returns the vehicle id of the car the port is connected to, or None if the port doesn't identify the car (e.g. the CAN
+# and live value ports)
+def GetVehicleId(port):
+    timing = getattr(port, 'timing', None)
+    if timing is None:
+        return None
+    return timing.vehicleId
+
 def CreateInfoBox(theParent):
     tInfoBox = wx.TextCtrl(theParent, pos=(5, 5), size=(100, 220), style=wx.TE_READONLY | wx.TE_MULTILINE)
     tInfoBox.SetBackgroundColour('#21211f')
@@ -71,6 +97,44 @@ def CreateInfoBox(theParent):
     tInfoBox.SetFont(wx.Font(14, wx.ROMAN, wx.NORMAL, wx.NORMAL, faceName="Monaco"))
     return tInfoBox
 
+class HeatmapGrid(wx.Panel):
+    """
+    Draws a heatmap (see pigauge_heatmap) as a grid of cells, brighter for more time, with the highest rpm at the top
+    and the cell of the latest values outlined.
+    """
+
+    def __init__(self, parent, heatmap):
+        wx.Panel.__init__(self, parent)
+        self.heatmap = heatmap
+        self.SetBackgroundColour('#21211f')
+        self.Bind(wx.EVT_PAINT, self.OnPaint)
+
+    def OnPaint(self, event):
+        dc = wx.PaintDC(self)
+        width, height = self.GetClientSize()
+        times = self.heatmap.times
+        rows, columns = times.shape
+        cellWidth = width / float(columns)
+        cellHeight = height / float(rows)
+        peak = times.max()
+
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        for row in range(rows):
+            for column in range(columns):
+                # Square root, so the cells with a little time still show beside the one with the most
+                level = 0
+                if peak > 0:
+                    level = int(255 * math.sqrt(times[row, column] / peak))
+                dc.SetBrush(wx.Brush(wx.Colour(level, level / 2, 0)))
+                dc.DrawRectangle(int(column * cellWidth), int((rows - 1 - row) * cellHeight), int(cellWidth) + 1,
+                                 int(cellHeight) + 1)
+
+        if self.heatmap.row is not None and self.heatmap.column is not None:
+            dc.SetPen(wx.Pen(wx.WHITE, 2))
+            dc.SetBrush(wx.TRANSPARENT_BRUSH)
+            dc.DrawRectangle(int(self.heatmap.column * cellWidth), int((rows - 1 - self.heatmap.row) * cellHeight),
+                             int(cellWidth) + 1, int(cellHeight) + 1)
+
 #-------------------------------------------------------------------------------
 
 class OBDPanelGauges(wx.Panel):
@@ -106,11 +170,51 @@ class OBDPanelGauges(wx.Panel):
         self.boxes = []
 
         # Indexed by sensor shortname + 'name'/'value'. (ie 'rpmname', 'speedvalue'). Contains wx text elements
-        # With the exception of "infobox"
+        # With the exception of "infobox" and "heatmap" (the residency grid)
         self.texts = {}
         
+        # History of every polled sensor for the whole drive (see pigauge_history)
+        self.history = HistoryStore()
+
+        # Captures the lead up to alerts (see pigauge_triggers)
+        self.triggers = TriggerEngine()
+
+        # Alert rules, which set the colours of the values and start captures (see pigauge_rules)
+        self.rules = RuleEngine(triggers=self.triggers)
+
+        # Flags readings outside the learned operating envelope (see pigauge_anomaly)
+        self.anomalies = AnomalyDetector()
+
+        # Estimated turbo and oil temperatures, for the turbo timer and the coolant gauge (see pigauge_thermal)
+        self.thermal = ThermalModel()
+
+        # Time spent at each rpm x load and rpm x manifold pressure, over every trip (see pigauge_heatmap)
+        self.heatmaps = ResidencyHeatmaps()
+
+        # Events that aren't in the logs, e.g. turbo timer cycles (see pigauge_tripstore)
+        self.tripStore = TripStore()
+
+        # Sensors are polled once per update, unless a feature boosts them (see ChannelScheduler.boost)
+        self.scheduler = ChannelScheduler()
+
         # Declare which features should be enabled
-        self.features = [TurboTimer(True)]
+        self.features = [TurboTimer(True), Residency(True, self.heatmaps), PerformanceTimer(True)]
+        for feature in self.features:
+            feature.history = self.history
+            feature.thermal = self.thermal
+            feature.scheduler = self.scheduler
+            feature.recordEvent = self.recordEvent
+
+        # Index of the next sensor to poll, so a tick that runs out of budget carries on where it stopped
+        self.nextPollIndex = 0
+
+        # Timestamp of the last value passed on for each sensor. Ports that listen (passive CAN, the live value bus)
+        # set values outside updateSensor, so new values are told apart by this rather than by the call changing them.
+        self.passedTimestamps = {}
+
+        # Duration of the last update and the worst seen so far (in seconds)
+        self.tickLatency = 0.0
+        self.maxTickLatency = 0.0
 
 
     # Creates a instrument cluster style GUI
@@ -177,10 +281,24 @@ class OBDPanelGauges(wx.Panel):
         coolantBoxSizer.Add(tSensorName, 0, wx.ALIGN_CENTER | wx.BOTTOM | wx.ALL, 45)
         self.texts[coolantSensor.shortname + 'name'] = tSensorName
 
+        # Create box for the features (performance timer etc.) and alerts
+        infoBox = wx.StaticBox(self, wx.ID_ANY)
+        self.boxes.append(infoBox)
+        infoBoxSizer = wx.StaticBoxSizer(infoBox, wx.VERTICAL)
+        tInfoBox = CreateInfoBox(self)
+        infoBoxSizer.Add(tInfoBox, 1, wx.EXPAND | wx.ALL, 1)
+        self.texts['infobox'] = tInfoBox
+
+        # Rpm x load residency grid under the info box
+        heatmapGrid = HeatmapGrid(self, self.heatmaps.getHeatmap('rpm_load'))
+        infoBoxSizer.Add(heatmapGrid, 1, wx.EXPAND | wx.ALL, 1)
+        self.texts['heatmap'] = heatmapGrid
+
         # Add to screen
         gridSizerMain.Add(speedBoxSizer, 1, wx.EXPAND | wx.TOP | wx.LEFT | wx.ALIGN_CENTER)
         gridSizerMain.Add(rpmBoxSizer, 1, wx.EXPAND | wx.TOP | wx.RIGHT | wx.ALIGN_CENTER)
         gridSizerMain.Add(coolantBoxSizer, 1, wx.EXPAND | wx.BOTTOM | wx.RIGHT | wx.ALIGN_CENTER)
+        gridSizerMain.Add(infoBoxSizer, 1, wx.EXPAND | wx.BOTTOM | wx.RIGHT | wx.ALIGN_CENTER)
         self.SetSizer(gridSizerMain)
         self.Refresh()
         self.Layout()
@@ -257,24 +375,82 @@ class OBDPanelGauges(wx.Panel):
             self.timer.Start(GLOBAL_UPDATE_INTERVAL)
 
 
+    # Polls as many sensors as fit in the time budget, starting with the ones skipped last time. Sensors boosted by a
+    # feature are also polled whenever they are due, in between the others and with any budget left over, but the GUI
+    # never waits for them.
+    def pollSensors(self, deadline):
+        sensors = self.sensors.values()
+        for sensor in sensors:
+            if self.scheduler.get(sensor.shortname) is None:
+                self.scheduler.add(Channel(sensor, 1000.0 / GLOBAL_UPDATE_INTERVAL))
+        boosted = [channel for channel in self.scheduler.channels if channel.isBoosted()]
+
+        for i in range(len(sensors)):
+            if time.time() >= deadline:
+                break
+            self.pollBoosted(boosted)
+            self.pollSensor(sensors[self.nextPollIndex % len(sensors)])
+            self.nextPollIndex = (self.nextPollIndex + 1) % len(sensors)
+
+        while time.time() < deadline and self.pollBoosted(boosted):
+            pass
+
+    # Polls the boosted sensors that are due, returning True if any were
+    def pollBoosted(self, boosted):
+        now = time.time()
+        polled = False
+        for channel in boosted:
+            if channel.nextDue <= now:
+                self.pollSensor(channel.sensor)
+                self.scheduler.done(channel)
+                polled = True
+        return polled
+
+    # Polls a sensor, passing on a new value
+    def pollSensor(self, sensor):
+        self.port.updateSensor(sensor)
+        if sensor.timestamp is None or sensor.timestamp == self.passedTimestamps.get(sensor.shortname):
+            return
+        self.passedTimestamps[sensor.shortname] = sensor.timestamp
+
+        # Record new numeric values in the history, the thermal model, the heatmaps, the capture buffer, the rules and the
+        # anomaly detector
+        if type(sensor.value) in (int, long, float):
+            self.history.add(sensor.shortname, sensor.timestamp, sensor.value)
+            self.thermal.add(sensor.shortname, sensor.timestamp, sensor.value)
+            self.heatmaps.add(sensor.shortname, sensor.timestamp, sensor.value)
+            self.triggers.add(sensor.shortname, sensor.timestamp, sensor.value)
+            self.rules.set(sensor.shortname, sensor.value)
+            self.anomalies.add(sensor.shortname, sensor.timestamp, sensor.value)
+
+    # Sets the colour of a value text from the alert rules and whether the value is stale
+    def updateSensorColour(self, sensor, uiElement):
+        colour = self.rules.getColour(sensor.shortname)
+        if sensor.isStale(STALE_SENSOR_AGE):
+            uiElement.SetForegroundColour(STALE_SENSOR_COLOUR)
+        elif colour is not None:
+            uiElement.SetForegroundColour(wx.Colour(*colour))
+        else:
+            uiElement.SetForegroundColour('WHITE')
+
     # Update gets fresh data from the sensors and updates features
     def obdUpdate(self, event):
+        tickStart = time.time()
+        self.pollSensors(tickStart + TICK_POLL_BUDGET / 1000.0)
+
+        # Evaluate the alert rules, with whether the oil has warmed up from the thermal model
+        self.rules.set('oil_ready', self.thermal.isOilReady())
+        self.rules.evaluate(tickStart)
+
         i = 0
         for shortname, sensor in self.sensors.iteritems():
-            self.port.updateSensor(sensor)
-
             if SPEEDOMETER_STYLE:
                 # Update all displayed sensors
                 if shortname in SPEEDO_SENSOR_SHORTNAMES:
                     # This is a currently displayed sensor
                     formattedValue = sensor.getFormattedValue()
                     self.texts[shortname + 'value'].SetLabel(formattedValue)
-                    
-                    # Update UI elements for special sensors (coolant etc.)
-                    if sensor.__class__.__name__ != "Sensor":
-                        sensor.updateUi(self.texts[shortname+'value'])
-                    else:
-                        self.texts[shortname+'value'].SetForegroundColour('WHITE')
+                    self.updateSensorColour(sensor, self.texts[shortname + 'value'])
             else:
                 # Update current sensor index only
                 if i == self.currSensorIndex:
@@ -282,23 +458,34 @@ class OBDPanelGauges(wx.Panel):
                     formattedValue = sensor.getFormattedValue()
                     self.texts['sensorvalue'].SetLabel(formattedValue)
                     self.texts['sensorname'].SetLabel(sensor.name)
-
-                # Update UI elements for special sensors (coolant etc.)
-                if sensor.__class__.__name__ != "Sensor":
-                    sensor.updateUi(self.texts['sensorvalue'])
-                else:
-                    self.texts['sensorvalue'].SetForegroundColour('WHITE')
+                    self.updateSensorColour(sensor, self.texts['sensorvalue'])
             i += 1
 
-        if SPEEDOMETER_STYLE == False:
-            # Update features, passing in the sensor list and info text box
-            self.texts['infobox'].Clear()
-            for feature in self.features:
-                feature.update(self.sensors, self.texts['infobox'])
-                self.texts['infobox'].AppendText("\n")
+        # Update features, passing in the sensor list and info text box (in both styles)
+        self.texts['infobox'].Clear()
+        for feature in self.features:
+            feature.update(self.sensors, self.texts['infobox'])
+            self.texts['infobox'].AppendText("\n")
+        for alert in self.rules.getAlerts() + self.anomalies.getAlerts():
+            self.texts['infobox'].AppendText(alert + "\n")
+        if 'heatmap' in self.texts:
+            self.texts['heatmap'].Refresh()
+
+        # Record how long this update took
+        self.tickLatency = time.time() - tickStart
+        if self.tickLatency > self.maxTickLatency:
+            self.maxTickLatency = self.tickLatency
 
 
+    # Adds an event that isn't in the logs to the trip store, for the car connected to
+    def recordEvent(self, eventType, start, end=None, peak=None):
+        self.tripStore.addEvent(GetVehicleId(self.port), eventType, start, end, peak)
+
     def onCtrlC(self, event):
+        self.triggers.close()
+        self.anomalies.close()
+        self.heatmaps.close()
+        self.tripStore.close()
         self.GetParent().Close()
 
         
@@ -371,8 +558,13 @@ class OBDFrame(wx.Frame):
             for sensor in sensors:
                 if sensor[1].enabled:
                     self.panelGauges.sensors[sensor[1].shortname] = sensor[1]
+
+            # The coolant gauge shows the oil warm-up estimated by the thermal model
+            if 'temp' in self.panelGauges.sensors:
+                self.panelGauges.sensors['temp'].thermal = self.panelGauges.thermal
         
             self.panelGauges.port = port
+            self.panelGauges.heatmaps.setVehicle(GetVehicleId(port))
             
         self.sizer = wx.BoxSizer(wx.VERTICAL)
         self.sizer.Add(self.panelGauges, 1, wx.EXPAND)
@@ -29,10 +29,48 @@ import time
 import obd_sensors
 
 from obd_sensors import hex_to_int
+from obd_timing import AdaptiveTiming, vehicleIdFromPids, splitCommand
+from obd_binlog import BinLogWriter
+from obd_response import parseResponse, positiveAnswers, OBD_FUNCTIONAL_ID, OBD_REQUEST_ID, OBD_RESPONSE_ID
+from obd_utils import loadState, saveState
 
 GET_DTC_COMMAND   = "03"
 CLEAR_DTC_COMMAND = "04"
 GET_FREEZE_DTC_COMMAND = "07"
+GET_VIN_COMMAND = "0902"
+
+# Deadline (in seconds) for a single sensor request. When it expires the request is
+# aborted and the adapter resynchronised, so a silent ECU costs at most this long.
+REQUEST_TIMEOUT = 0.5
+
+# Deadline (in seconds) for the adapter to return its prompt after an aborted request
+RESYNC_TIMEOUT = 0.2
+
+# Sent to abort a request. Any character stops a busy ELM327, but a carriage return reaching it once it is idle again
+# repeats the last command, whereas a space is ignored.
+ABORT_CHARACTER = " "
+
+# Serial read timeout (in seconds), i.e. how often the request deadline is checked
+READ_POLL_TIMEOUT = 0.05
+
+# Number of sensor requests between retuning the adapter timeout from the learned timings
+TIMING_TUNE_INTERVAL = 50
+
+# Serial rate the ELM327 starts at, and the faster rates to try (fastest first) when negotiating with AT BRD
+DEFAULT_BAUD = 38400
+NEGOTIATE_BAUD_RATES = [500000, 250000, 230400, 115200]
+
+# The AT BRD divisor is taken from the ELM327 internal 4 MHz clock
+ELM_BAUD_CLOCK = 4000000
+
+# Time the adapter waits for the host to confirm a new rate (AT BRT, in units of 5 ms)
+BAUD_CONFIRM_TIMEOUT = 0x28
+
+# State file holding the rate that worked for each adapter
+BAUD_STATE_FILE = "baud.json"
+
+# Most data bytes a capture request can ask for, so the response fits in a single CAN frame
+CAPTURE_MAX_BYTES = 6
 
 from debugEvent import debug_display
 
@@ -65,27 +103,76 @@ def decrypt_dtc_code(code):
         dtc.append(type+dig1+dig2+dig3+dig4)
         current = current[4:]
     return dtc
+def decode_dtcs(res, status):
+    """Returns the DTCs in a mode 03/07 response line (e.g. '43 01 33 00 00 00 00') as
+    a list of [status, DTC code] pairs"""
+    dtcLetters = ["P", "C", "B", "U"]
+    DTCCodes = []
+    for j in range(0, 3):
+        val1 = hex_to_int(res[3+j*6:5+j*6])
+        val2 = hex_to_int(res[6+j*6:8+j*6]) #get DTC codes from response (3 DTC each 2 bytes)
+        val  = (val1<<8)+val2 #DTC val as int
+        
+        if val==0: #skip fill of last packet
+          break
+           
+        DTCStr=dtcLetters[(val&0xC000)>14]+str((val&0x3000)>>12)+str((val&0x0f00)>>8)+str((val&0x00f0)>>4)+str(val&0x000f)
+        DTCCodes.append([status,DTCStr])
+    return DTCCodes
 #__________________________________________________________________________
 
 class OBDPort:
      """ OBDPort abstracts all communication with OBD-II device."""
-     def __init__(self,portnum,_notify_window,SERTIMEOUT,RECONNATTEMPTS):
-         """Initializes port by resetting device and gettings supported PIDs. """
-         # These should really be set by the user.
-         baud     = 38400 # 38400, 9600 or 115200
-         databits = 8
-         par      = serial.PARITY_NONE  # parity
-         sb       = 1                   # stop bits
-         to       = SERTIMEOUT
+     def __init__(self,portnum,_notify_window,SERTIMEOUT,RECONNATTEMPTS,baud=DEFAULT_BAUD,negotiateBaud=False):
+         """Initializes port by resetting device and gettings supported PIDs.
+         If negotiateBaud is set the link is then raised to the fastest rate the adapter accepts."""
          self.ELMver = "Unknown"
          self.State = 1 #state SERIAL is 1 connected, 0 disconnected (connection failed)
          self.port = None
+
+         # Deadlines for initialisation commands and for sensor requests
+         self.initTimeout = SERTIMEOUT
+         self.requestTimeout = min(REQUEST_TIMEOUT, SERTIMEOUT)
+
+         # Request latency statistics (in seconds), and the number of requests that hit their deadline
+         self.sendTime = None
+         self.lastLatency = 0.0
+         self.maxLatency = 0.0
+         self.timeoutCount = 0
+
+         # Learned response counts and timings, replaced with the vehicle's own once it has been identified
+         self.timing = AdaptiveTiming()
+         self.requestCount = 0
+
+         # Link speed, and the bytes transferred and time spent in requests for measuring the actual throughput
+         self.portnum = portnum
+         self.baud = baud
+         self.bytesTransferred = 0
+         self.transferTime = 0.0
+
+         # Bytes read past the end of a response (e.g. the start of the next one), which the next read starts with
+         self.readBuffer = ""
+
+         # Responses carry the address of the ECU answering (AT H1), and the ECU number requests are sent to
+         # (0 = engine), or None to ask all of them
+         self.headers = True
+         self.targetEcu = None
          
          self._notify_window=_notify_window
+         self.open(negotiateBaud)
+
+     def open(self, negotiateBaud=False):
+         """Internal use only: opens the serial port and sets up the adapter. Ports that reach the
+         adapter another way (e.g. through the broker) override this."""
+         # These should really be set by the user.
+         databits = 8
+         par      = serial.PARITY_NONE  # parity
+         sb       = 1                   # stop bits
+         to       = READ_POLL_TIMEOUT
          debug_display(self._notify_window, 1, "Opening interface (serial port)")
 
          try:
-             self.port = serial.Serial(portnum,baud, \
+             self.port = serial.Serial(self.portnum,self.baud, \
              parity = par, stopbits = sb, bytesize = databits,timeout = to)
              
          except serial.SerialException as e:
@@ -103,36 +190,60 @@ class OBDPort:
             self.State = 0
             return
 
-         self.ELMver = self.get_result()
+         self.ELMver = self.get_result(self.initTimeout)
+         if self.ELMver is None:
+            # The adapter may have been left at a negotiated rate by a session that didn't close it
+            self.ELMver = self.reset_at_remembered_baud()
          if self.ELMver is None:
             self.State = 0
             return
          
          debug_display(self._notify_window, 2, "atz response:" + self.ELMver)
 
-         # Echo off
-         self.send_command("ate0")
-         debug_display(self._notify_window, 2, "ate0 response:" + self.get_result())
-
-         # Set mode to CAN (11 bit ID, 500 kbaud)
-         self.send_command("at sp 6")
-         debug_display(self._notify_window, 2, "at sp response:" + self.get_result())
-
+         self.configure_adapter()
 
          self.send_command("0100")
-         ready = self.get_result()
+         lines = self.get_result_lines(self.initTimeout)
          
-         if ready is None:
+         if lines is None:
             self.State = 0
             return
             
-         debug_display(self._notify_window, 2, "0100 response:" + ready)
+         debug_display(self._notify_window, 2, "0100 response:" + string.join(lines, " "))
+
+         # Load what has been learned about this vehicle, identified by the engine's supported PIDs
+         answers = self.get_answers("0100", lines)
+         if answers:
+            self.timing = AdaptiveTiming(vehicleIdFromPids(answers[0][1]))
+
+         if negotiateBaud:
+            self.negotiate_baud()
          return
               
+     def configure_adapter(self):
+         """Internal use only: sets up the adapter after a reset"""
+         # Echo off
+         self.send_command("ate0")
+         debug_display(self._notify_window, 2, "ate0 response:" + str(self.get_result(self.initTimeout)))
+
+         # Set mode to CAN (11 bit ID, 500 kbaud)
+         self.send_command("at sp 6")
+         debug_display(self._notify_window, 2, "at sp response:" + str(self.get_result(self.initTimeout)))
+
+         # Let the adapter adapt its own timeout too
+         self.send_command("at at1")
+         debug_display(self._notify_window, 2, "at at1 response:" + str(self.get_result(self.initTimeout)))
+
+         # Headers on, so answers from different ECUs can be told apart
+         if self.headers:
+            self.send_command("at h1")
+            debug_display(self._notify_window, 2, "at h1 response:" + str(self.get_result(self.initTimeout)))
+
      def close(self):
          """ Resets device and closes all associated filehandles"""
          
          if (self.port is not None) and (self.State == 1):
+            self.timing.save()
             self.send_command("atz")
             self.port.close()
          
@@ -143,10 +254,12 @@ class OBDPort:
          """Internal use only: not a public interface"""
          if self.port:
              self.port.flushOutput()
-             self.port.flushInput()
+             self.flush_input()
              for c in cmd:
                  self.port.write(c)
              self.port.write("\r\n")
+             self.sendTime = time.time()
+             self.bytesTransferred += len(cmd) + 2
              #debug_display(self._notify_window, 3, "Send command:" + cmd)
 
      def interpret_result(self,code):
@@ -176,51 +289,278 @@ class OBDPort:
          code = code[4:]
          return code
     
-     def get_result(self):
+     def get_answers(self, cmd, lines):
+         """Internal use only: returns the positive (ECU address, payload) answers to cmd (without a
+         response count digit) in the response lines. The answer of the target ECU, or else of the
+         engine (the lowest address), comes first."""
+         answers = positiveAnswers(cmd, parseResponse(lines, self.headers))
+         if self.targetEcu is None:
+            preferred = OBD_RESPONSE_ID
+         else:
+            preferred = OBD_RESPONSE_ID + self.targetEcu
+         answers.sort(key=lambda answer: (answer[0] != preferred, answer[0]))
+         return answers
+
+     def interpret_lines(self, cmd, lines):
+         """Internal use only: returns the data (without the mode and PID) of the preferred answer to a
+         sensor command in the response lines, or "NODATA" if no ECU answered"""
+         base = splitCommand(cmd)[0]
+         answers = self.get_answers(base, lines)
+         if len(answers) == 0:
+            return "NODATA"
+         return answers[0][1][len(base):]
+
+     def get_result(self, timeout=None):
          """Internal use only: not a public interface"""
-         #time.sleep(0.01)
-         repeat_count = 0
-         if self.port is not None:
-             buffer = ""
-             while 1:
-                 c = self.port.read(1)
-                 if len(c) == 0:
-                    if repeat_count == 5:
-                        break
-                    print "Got nothing\n"
-                    repeat_count += 1
-                    continue
-                    
-                 if c == '\r':
-                    continue
-                    
-                 if c == ">":
-                    break
-                     
-                 if buffer != "" or c != ">": #if something is in buffer, add everything
-                    buffer = buffer + c
-                    
-             #debug_display(self._notify_window, 3, "Get result:" + buffer)
-             if buffer == "":
+         lines = self.get_result_lines(timeout)
+         if lines is None:
+            return None
+         return string.join(lines, "")
+
+     def get_result_lines(self, timeout=None):
+         """Internal use only: reads the response up to the prompt and returns its non-empty
+         lines, or None if nothing arrived before the deadline (default: the request timeout)."""
+         if self.port is None:
+            debug_display(self._notify_window, 3, "NO self.port!")
+            return None
+
+         if timeout is None:
+            timeout = self.requestTimeout
+         deadline = time.time() + timeout
+
+         buffer = self.readBuffer
+         self.readBuffer = ""
+         while 1:
+             prompt = buffer.find(">")
+             if prompt >= 0:
+                # Anything after the prompt belongs to what comes next
+                self.readBuffer = buffer[prompt + 1:]
+                buffer = buffer[:prompt]
+                break
+
+             # Read whatever has arrived, or wait up to the read timeout for the next byte
+             buffer = buffer + self.port.read(self.port.inWaiting() or 1)
+
+             if time.time() >= deadline:
+                print "Request timed out after " + str(timeout) + "s\n"
+                self.resync()
                 return None
-             return buffer
+
+         # Track how long the adapter took to answer
+         self.bytesTransferred += len(buffer) + 1
+         if self.sendTime is not None:
+            self.lastLatency = time.time() - self.sendTime
+            self.transferTime += self.lastLatency
+            if self.lastLatency > self.maxLatency:
+               self.maxLatency = self.lastLatency
+
+         lines = [line for line in string.split(buffer, "\r") if string.strip(line) != ""]
+         if len(lines) == 0:
+            return None
+         return lines
+
+     def read_until(self, marker, timeout):
+         """Internal use only: reads until marker arrives, returning everything read up to and
+         including it, or None if the timeout (in seconds) expires first. Anything read after the
+         marker is kept for the next read."""
+         deadline = time.time() + timeout
+         buffer = self.readBuffer
+         while 1:
+             end = buffer.find(marker)
+             if end >= 0:
+                end += len(marker)
+                self.readBuffer = buffer[end:]
+                return buffer[:end]
+             if time.time() >= deadline:
+                self.readBuffer = buffer
+                return None
+             buffer = buffer + self.port.read(self.port.inWaiting() or 1)
+
+     def flush_input(self):
+         """Internal use only: discards everything received but not read yet"""
+         self.port.flushInput()
+         self.readBuffer = ""
+
+     def resync(self):
+         """Internal use only: aborts the pending request and waits for the adapter prompt"""
+         self.timeoutCount += 1
+         try:
+            # Any character sent while the ELM is busy aborts the current request
+            self.port.write(ABORT_CHARACTER)
+            self.read_until(">", RESYNC_TIMEOUT)
+            self.flush_input()
+         except serial.SerialException:
+            self.State = 0
+
+     def get_adapter_id(self):
+         """Internal use only: identifies the adapter by port and version, for remembering its link speed"""
+         version = str(self.ELMver)
+         # Skip anything echoed before the version string
+         if "ELM" in version:
+            version = version[version.find("ELM"):]
+         return self.portnum + " " + string.strip(version)
+
+     def negotiate_baud(self):
+         """Raises the link to the fastest rate the adapter and host accept, trying the rate that
+         last worked for this adapter first. Returns the rate in use afterwards."""
+         rates = loadState(BAUD_STATE_FILE, {})
+         remembered = rates.get(self.get_adapter_id())
+         candidates = [rate for rate in NEGOTIATE_BAUD_RATES if rate > self.baud]
+         if remembered in candidates:
+            candidates.remove(remembered)
+            candidates.insert(0, remembered)
+
+         # Give the host time to confirm the new rate
+         self.send_command("at brt %02X" % BAUD_CONFIRM_TIMEOUT)
+         if self.get_result(self.initTimeout) != "OK":
+            debug_display(self._notify_window, 2, "Adapter does not support baud rate negotiation")
+            return self.baud
+
+         for rate in candidates:
+            if self.try_baud(rate):
+               rates[self.get_adapter_id()] = rate
+               saveState(BAUD_STATE_FILE, rates)
+               break
+
+         debug_display(self._notify_window, 2, "Link speed: " + str(self.baud) + " baud")
+         return self.baud
+
+     def try_baud(self, rate):
+         """Internal use only: switches to a new rate with AT BRD. The adapter answers OK at the old rate,
+         then sends its ID at the new rate and keeps it only if the host confirms within AT BRT."""
+         oldRate = self.baud
+         self.send_command("at brd %02X" % int(round(float(ELM_BAUD_CLOCK) / rate)))
+         reply = self.read_until("\r", self.initTimeout)
+         if reply is None or "OK" not in reply:
+            # Rate not accepted (e.g. "?"), wait for the prompt at the old rate
+            self.read_until(">", RESYNC_TIMEOUT)
+            return False
+
+         confirmed = False
+         try:
+            self.port.baudrate = rate
+            greeting = self.read_until("\r", BAUD_CONFIRM_TIMEOUT * 0.005)
+            if greeting is not None and "ELM" in greeting:
+               self.port.write("\r")
+               confirmed = self.read_until(">", RESYNC_TIMEOUT) is not None
+         except (serial.SerialException, ValueError) as e:
+            print e
+
+         if not confirmed:
+            # Unconfirmed, so the adapter goes back to the old rate by itself
+            self.port.baudrate = oldRate
+            self.read_until(">", RESYNC_TIMEOUT)
+            self.flush_input()
+            return False
+
+         # Check the link really works at the new rate
+         self.baud = rate
+         self.send_command("ati")
+         ident = self.get_result(self.initTimeout)
+         if ident is not None and "ELM" in ident:
+            return True
+
+         # Both ends switched but the link is unusable. Reset the adapter back to its power-on rate and set it up again.
+         print "Link check failed at " + str(rate) + " baud"
+         self.baud = DEFAULT_BAUD
+         if self.reset_adapter_baud(rate) is not None:
+            self.configure_adapter()
          else:
-            debug_display(self._notify_window, 3, "NO self.port!")
+            self.State = 0
+         return False
+
+     def reset_adapter_baud(self, rate):
+         """Internal use only: resets an adapter running at rate, which returns it to its power-on rate.
+         Returns the reset response or None."""
+         self.port.baudrate = rate
+         self.send_command("atz")
+         self.port.baudrate = self.baud
+         time.sleep(1)
+         return self.get_result(self.initTimeout)
+
+     def reset_at_remembered_baud(self):
+         """Internal use only: resets the adapter at the rate that last worked for this port, in case
+         it is still running at it. Returns the reset response or None."""
+         rates = loadState(BAUD_STATE_FILE, {})
+         for adapterId, rate in rates.items():
+            if adapterId.split(" ")[0] == self.portnum and rate != self.baud:
+               response = self.reset_adapter_baud(rate)
+               if response is not None:
+                  return response
          return None
 
+     def get_link_stats(self):
+         """Returns a 2-tuple of the link speed (baud) and the measured throughput (bytes/sec) of requests"""
+         if self.transferTime == 0:
+            return self.baud, 0.0
+         return self.baud, self.bytesTransferred / self.transferTime
+
+     def set_target_ecu(self, ecu):
+         """Sends requests to one ECU only (0 = engine), or to all of them if ecu is None. The adapter
+         then only passes on that ECU's answers, so each request gets a single answer."""
+         if ecu is None:
+            commands = ["at sh %03X" % OBD_FUNCTIONAL_ID, "at cra"]
+         else:
+            commands = ["at sh %03X" % (OBD_REQUEST_ID + ecu), "at cra %03X" % (OBD_RESPONSE_ID + ecu)]
+         for cmd in commands:
+            self.send_command(cmd)
+            debug_display(self._notify_window, 3, cmd + " response:" + str(self.get_result(self.initTimeout)))
+         self.targetEcu = ecu
+
+     def request_command(self, cmd):
+         """Internal use only: returns the command to send for a sensor command, with a response count
+         digit if the number of answers is known"""
+         base = splitCommand(cmd)[0]
+         if self.targetEcu is not None and len(base) == 4 and base[:2] in ("01", "02"):
+            # Only the target answers
+            return base + "1"
+         return self.timing.command(cmd)
+
      # get sensor value from command
      def updateSensor(self, sensor):
          """Gets the latest value from OBD and updates it"""
-         cmd = sensor.cmd
+         cmd = self.request_command(sensor.cmd)
          self.send_command(cmd)
-         data = self.get_result()
+         lines = self.get_result_lines()
          
-         if data:
-             data = self.interpret_result(data)
+         if lines:
+             data = self.interpret_lines(sensor.cmd, lines)
              if data != "NODATA":
-                 sensor.update(data)
+                 # The ECU sampled the value between the request and the answer, so it is timed at the middle of the two
+                 sensor.update(data, self.sendTime + self.lastLatency / 2.0)
+                 if self.targetEcu is None:
+                     # Learn how many ECUs answer, from the whole answers rather than the frames
+                     payloads = [payload for ecu, payload in self.get_answers(splitCommand(sensor.cmd)[0], lines)]
+                     self.timing.record(sensor.cmd, payloads, self.lastLatency)
+             else:
+                 self.timing_miss(sensor.cmd, False)
          else:
-             sensor.value = "NORESPONSE"
+             self.timing_miss(sensor.cmd)
+         # On a miss the sensor keeps its last value, which ages until it is flagged as stale
+
+         self.requestCount += 1
+         if self.requestCount % TIMING_TUNE_INTERVAL == 0:
+             self.tune_timing()
+
+     def timing_miss(self, cmd, timedOut=True):
+         """Internal use only: falls back to safe timing after a request got no answer, backing
+         the adapter timeout off only if the request timed out rather than getting NO DATA"""
+         if self.timing.miss(cmd, timedOut):
+             self.set_adapter_timeout(self.timing.timeout)
+
+     def tune_timing(self):
+         """Tightens the adapter timeout to suit the learned ECU response times"""
+         timeout = self.timing.tunedTimeout()
+         if timeout is not None:
+             self.set_adapter_timeout(timeout)
+         # Saved when something has been learned, and on close
+         if self.timing.changed or timeout is not None:
+             self.timing.save()
+
+     def set_adapter_timeout(self, timeout):
+         """Sets the adapter timeout (AT ST), in units of 4 ms"""
+         self.send_command("at st %02X" % timeout)
+         debug_display(self._notify_window, 3, "at st %02X response:" % timeout + str(self.get_result()))
      
      def updateSensorByIndex(self, sensor_index):
          sensor = obd_sensors.SENSORS[sensor_index]
@@ -266,61 +606,45 @@ class OBDPort:
          
          return statusTrans
           
-     #
-     # fixme: j1979 specifies that the program should poll until the number
-     # of returned DTCs matches the number indicated by a call to PID 01
-     #
      def get_dtc(self):
-          """Returns a list of all pending DTC codes. Each element consists of
-          a 2-tuple: (DTC code (string), Code description (string) )"""
-          dtcLetters = ["P", "C", "B", "U"]
-          
-          # Get DTC data
-          self.updateSensorByIndex(1)
-          r = self.getSensorTuple(1)[1] #data
-          
-          dtcNumber = r[0]
-          mil = r[1]
+          """Returns a list of [status, DTC code] pairs from every ECU, stored (mode 03) and freeze
+          frame (mode 07)"""
+          # The codes are read from the modes themselves rather than counted from the 0101 status first, as
+          # the adapter returns every answer to one request
           DTCCodes = []
+          for cmd, status in ((GET_DTC_COMMAND, "Active"), (GET_FREEZE_DTC_COMMAND, "Passive")):
+            self.send_command(cmd)
+            lines = self.get_result_lines()
+            if lines is None:
+              continue
+            print "DTC result:" + string.join(lines, " ")
+            DTCCodes.extend(self.decode_dtc_answers(cmd, lines, status))
+          return DTCCodes
 
-          print "Number of stored DTC:" + str(dtcNumber) + " MIL: " + str(mil)
-          # get all DTC, 3 per mesg response
-          for i in range(0, ((dtcNumber+2)/3)):
-            self.send_command(GET_DTC_COMMAND)
-            res = self.get_result()
-            print "DTC result:" + res
-            for j in range(0, 3):
-                val1 = hex_to_int(res[3+j*6:5+j*6])
-                val2 = hex_to_int(res[6+j*6:8+j*6]) #get DTC codes from response (3 DTC each 2 bytes)
-                val  = (val1<<8)+val2 #DTC val as int
-                
-                if val==0: #skip fill of last packet
-                  break
-                   
-                DTCStr=dtcLetters[(val&0xC000)>14]+str((val&0x3000)>>12)+str((val&0x0f00)>>8)+str((val&0x00f0)>>4)+str(val&0x000f)
-                
-                DTCCodes.append(["Active",DTCStr])
-          
-          #read mode 7
-          self.send_command(GET_FREEZE_DTC_COMMAND)
-          res = self.get_result()
-          
-          if res[:7] == "NODATA": #no freeze frame
-            return DTCCodes
-          
-          print "DTC freeze result:" + res
-          for i in range(0, 3):
-              val1 = hex_to_int(res[3+i*6:5+i*6])
-              val2 = hex_to_int(res[6+i*6:8+i*6]) #get DTC codes from response (3 DTC each 2 bytes)
-              val  = (val1<<8)+val2 #DTC val as int
-                
-              if val==0: #skip fill of last packet
-                break
-                   
-              DTCStr=dtcLetters[(val&0xC000)>14]+str((val&0x3000)>>12)+str((val&0x0f00)>>8)+str((val&0x00f0)>>4)+str(val&0x000f)
-              DTCCodes.append(["Passive",DTCStr])
-              
+     def decode_dtc_answers(self, cmd, lines, status):
+          """Internal use only: returns the [status, DTC code] pairs in the answers of every ECU to a
+          mode 03 or 07 request"""
+          DTCCodes = []
+          for ecu, payload in self.get_answers(cmd, lines):
+            # The DTCs follow the mode byte in 3 DTC chunks, as a line like '43 01 33 00 00 00 00'
+            codes = payload[2:]
+            for i in range(0, len(codes), 12):
+              chunk = codes[i:i + 12].ljust(12, "0")
+              line = payload[:2] + " " + string.join([chunk[j:j + 2] for j in range(0, 12, 2)], " ")
+              DTCCodes.extend(decode_dtcs(line, status))
           return DTCCodes
+
+     def get_vin(self):
+          """Returns the vehicle identification number, or None if the vehicle doesn't report it"""
+          self.send_command(GET_VIN_COMMAND)
+          lines = self.get_result_lines(self.initTimeout)
+          if lines is None:
+            return None
+          answers = self.get_answers(GET_VIN_COMMAND, lines)
+          if len(answers) == 0:
+            return None
+          # The VIN follows the mode, PID and number of data items
+          return answers[0][1][6:].decode("hex").strip("\x00")
               
      def clear_dtc(self):
          """Clears all DTCs and freeze frame data"""
@@ -328,19 +652,91 @@ class OBDPort:
          r = self.get_result()
          return r
      
-     def log(self, sensor_index, filename): 
-          file = open(filename, "w")
-          start_time = time.time() 
-          if file:
-               self.updateSensorByIndex(sensor_index)
-               data = self.getSensorTuple(sensor_index)
-               file.write("%s     \t%s(%s)\n" % \
-                         ("Time", string.strip(data[0]), data[2])) 
-               while 1:
+     def log(self, sensor_index, filename, duration=None):
+          """Captures one or more sensors (an index or list of indexes) at the highest rate the adapter
+          manages into a binary log (see obd_binlog), for duration seconds or until Ctrl C is pressed.
+          All channels are requested at once, and the request is repeated with the ELM327 repeat shortcut."""
+          if type(sensor_index) != list:
+               sensor_index = [sensor_index]
+          sensors = [obd_sensors.SENSORS[i] for i in sensor_index]
+
+          # Request each PID on its own first to find the length of its data
+          pids = {}
+          length = 0
+          for i in range(len(sensors)):
+               pid = splitCommand(sensors[i].cmd)[0][2:]
+               self.send_command("01" + pid)
+               lines = self.get_result_lines()
+               if lines is None or self.interpret_lines("01" + pid, lines) == "NODATA":
+                    raise ValueError("No response from sensor " + sensors[i].shortname)
+               size = len(self.interpret_lines("01" + pid, lines))
+               pids[pid] = (size, sensors[i].valueParserFunc, sensor_index[i])
+               length += 1 + size / 2
+          if length > CAPTURE_MAX_BYTES:
+               raise ValueError("Too many channels to capture at once")
+
+          # Headers, spaces and echo off keep the responses as short as possible
+          for cmd in ("ate0", "ath0", "ats0"):
+               self.send_command(cmd)
+               self.get_result(self.initTimeout)
+
+          channels = {}
+          for i in range(len(sensors)):
+               channels[sensor_index[i]] = sensors[i].shortname
+          writer = BinLogWriter(filename, channels, self.timing.vehicleId, {"mode": "capture"})
+
+          # e.g. "010C0D1" for rpm and speed, with a response count so the adapter doesn't wait for its timeout
+          cmd = "01" + string.join([splitCommand(s.cmd)[0][2:] for s in sensors], "") + "1"
+          self.send_command(cmd)
+          sent = self.sendTime
+
+          write = writer.write
+          read_until = self.read_until
+          portWrite = self.port.write
+          timeout = self.requestTimeout
+          start = time.time()
+          try:
+               while duration is None or time.time() - start < duration:
+                    response = read_until(">", timeout)
                     now = time.time()
-                    self.updateSensorByIndex(sensor_index)
-                    data = self.getSensorTuple(sensor_index)
-                    line = "%.6f,\t%s\n" % (now - start_time, data[1])
-                    file.write(line)
-                    file.flush()
-          
+                    if response is None:
+                         # Lost the adapter, start again with the full command
+                         self.resync()
+                         self.send_command(cmd)
+                         sent = self.sendTime
+                         continue
+
+                    # The ECU sampled the values between the request and the answer, so they are timed at the middle
+                    sampleTime = (sent + now) / 2.0
+
+                    # Empty command repeats the last one
+                    portWrite("\r")
+                    sent = time.time()
+
+                    # Response is e.g. "410C1AF80D3C\r\r>", walk through the PIDs after the mode byte
+                    response = response.strip("\r>")
+                    if response[:2] != "41":
+                         continue
+                    i = 2
+                    while i < len(response):
+                         entry = pids.get(response[i:i + 2])
+                         if entry is None:
+                              break
+                         write(sampleTime, entry[2], entry[1](response[i + 2:i + 2 + entry[0]]))
+                         i += 2 + entry[0]
+          except KeyboardInterrupt:
+               pass
+          finally:
+               elapsed = time.time() - start
+               writer.close()
+               # Let the repeat still in flight finish
+               self.read_until(">", timeout)
+               self.flush_input()
+               self.send_command("ats1")
+               self.get_result(self.initTimeout)
+               if self.headers:
+                    self.send_command("ath1")
+                    self.get_result(self.initTimeout)
+
+          print "Captured %d samples in %.1fs: %.1f samples/sec" % (writer.count, elapsed, writer.count / elapsed)
+          return writer.count
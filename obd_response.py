@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# This file defines the parsing of ELM327 responses on CAN. With headers on (AT H1) every line is one CAN frame,
+# starting with the address of the ECU that sent it, so the answers of several ECUs can be told apart and multi frame
+# (ISO-TP) answers reassembled per ECU, e.g. the engine and transmission both answering "0100":
+#
+#   7E8 06 41 00 BE 3E B8 11
+#   7E9 06 41 00 98 18 80 01
+#
+# or a VIN split over three frames:
+#
+#   7E8 10 14 49 02 01 31 44 34
+#   7E8 21 47 50 30 30 52 35 35
+#   7E8 22 42 31 32 33 34 35 36
+#
+# With headers off the ECU is unknown. Multi frame answers are then numbered by the adapter ("014", "0: 49 02 ...").
+
+import string
+
+# OBD-II on 11 bit CAN: functional (broadcast) request id, and the request/response ids of ECU n are 0x7E0+n/0x7E8+n
+OBD_FUNCTIONAL_ID = 0x7DF
+OBD_REQUEST_ID = 0x7E0
+OBD_RESPONSE_ID = 0x7E8
+
+# Length in hex digits of 11 bit and 29 bit CAN headers
+SHORT_HEADER_LENGTH = 3
+LONG_HEADER_LENGTH = 8
+
+# ISO-TP frame types (high nibble of the first byte)
+SINGLE_FRAME = 0x0
+FIRST_FRAME = 0x1
+CONSECUTIVE_FRAME = 0x2
+
+HEX_DIGITS = "0123456789ABCDEF"
+
+def isHex(text):
+    for c in text:
+        if c not in HEX_DIGITS:
+            return False
+    return len(text) > 0
+
+# A multi frame answer being reassembled
+class PartialAnswer:
+    def __init__(self, length, data):
+        self.length = length
+        self.data = data
+        self.sequence = 1
+
+    def isComplete(self):
+        return len(self.data) >= self.length * 2
+
+# Parses the lines of a response. Returns a list of (ECU address, payload) answers in the order they completed, where
+# the payload is the hex string of the answer starting with the mode byte (e.g. "410C1AF8") and the address is the
+# CAN id of the ECU (e.g. 0x7E8), or None with headers off. Lines that aren't data, e.g. "NO DATA" or "SEARCHING...",
+# are skipped, as are multi frame answers with frames missing.
+def parseResponse(lines, headers=True):
+    if headers:
+        return parseFrames(lines)
+
+    answers = []
+    partial = None
+    for line in lines:
+        line = string.upper(string.join(string.split(line), ""))
+        if ":" in line:
+            # Numbered frame of a multi frame answer, e.g. "0:490201314434"
+            index, data = string.split(line, ":", 1)
+            if partial is not None and isHex(index) and isHex(data):
+                partial.data = partial.data + data
+                if partial.isComplete():
+                    answers.append((None, partial.data[:partial.length * 2]))
+                    partial = None
+        elif not isHex(line):
+            continue
+        elif len(line) == 3:
+            # Length (in bytes) of the multi frame answer that follows
+            partial = PartialAnswer(int(line, 16), "")
+        else:
+            answers.append((None, line))
+    return answers
+
+def parseFrames(lines):
+    answers = []
+    partials = {}
+    for line in lines:
+        line = string.upper(string.join(string.split(line), ""))
+        if not isHex(line):
+            continue
+
+        # An odd length is a 3 digit (11 bit) header followed by whole bytes
+        if len(line) % 2 == 1:
+            headerLength = SHORT_HEADER_LENGTH
+        else:
+            headerLength = LONG_HEADER_LENGTH
+        if len(line) < headerLength + 2:
+            continue
+        ecu = int(line[:headerLength], 16)
+        frame = line[headerLength:]
+        frameType = int(frame[0], 16)
+
+        if frameType == SINGLE_FRAME:
+            length = int(frame[1], 16)
+            if len(frame) >= 2 + length * 2:
+                answers.append((ecu, frame[2:2 + length * 2]))
+        elif frameType == FIRST_FRAME and len(frame) >= 4:
+            partials[ecu] = PartialAnswer(int(frame[1:4], 16), frame[4:])
+        elif frameType == CONSECUTIVE_FRAME and ecu in partials:
+            partial = partials[ecu]
+            if int(frame[1], 16) != partial.sequence % 16:
+                # A frame went missing, the answer can't be put back together
+                del partials[ecu]
+                continue
+            partial.sequence += 1
+            partial.data = partial.data + frame[2:]
+            if partial.isComplete():
+                answers.append((ecu, partial.data[:partial.length * 2]))
+                del partials[ecu]
+        # Anything else, e.g. flow control, isn't an answer
+    return answers
+
+# Returns the positive answers to a command (e.g. "010C") from a list of (ECU address, payload) answers
+def positiveAnswers(cmd, answers):
+    expected = "%02X" % (int(cmd[:2], 16) + 0x40) + string.upper(cmd[2:])
+    return [(ecu, payload) for ecu, payload in answers if payload[:len(expected)] == expected]
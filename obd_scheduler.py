@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# This file defines the channel scheduler, which decides which sensor to poll next. Each channel has a rate (polls
+# per second) and a priority. The channel polled next is the highest priority one that is due, and the most overdue
+# of those.
+
+import time
+
+# A sensor polled at a given rate and priority
+class Channel:
+    def __init__(self, sensor, rate, priority=0):
+        self.sensor = sensor
+        self.shortname = sensor.shortname
+        self.rate = rate
+        self.priority = priority
+
+        # Rate and priority the channel goes back to when a boost is removed
+        self.baseRate = rate
+        self.basePriority = priority
+
+        self.nextDue = 0.0
+        self.pollCount = 0
+
+    def getInterval(self):
+        return 1.0 / self.rate
+
+    def isBoosted(self):
+        return self.rate != self.baseRate or self.priority != self.basePriority
+
+class ChannelScheduler:
+    def __init__(self, channels=None):
+        self.channels = []
+        self.byName = {}
+        if channels:
+            for channel in channels:
+                self.add(channel)
+
+    def add(self, channel):
+        self.channels.append(channel)
+        self.byName[channel.shortname] = channel
+
+    def get(self, shortname):
+        return self.byName.get(shortname)
+
+    # Returns the channel to poll now, or None if nothing is due
+    def nextDue(self, now=None):
+        if now is None:
+            now = time.time()
+        best = None
+        for channel in self.channels:
+            if channel.nextDue <= now:
+                if best is None or channel.priority > best.priority or \
+                   (channel.priority == best.priority and channel.nextDue < best.nextDue):
+                    best = channel
+        return best
+
+    # Seconds until the next channel is due (0 if one is due now)
+    def timeUntilNext(self, now=None):
+        if now is None:
+            now = time.time()
+        if len(self.channels) == 0:
+            return None
+        return max(0.0, min([channel.nextDue for channel in self.channels]) - now)
+
+    # Records that a channel has been polled
+    def done(self, channel, now=None):
+        if now is None:
+            now = time.time()
+        channel.pollCount += 1
+        # Keep to the rate, but don't try to catch up on polls missed while the adapter was slow
+        channel.nextDue = max(channel.nextDue + channel.getInterval(), now)
+
+    # Temporarily polls a channel at a different rate and priority, e.g. while a feature needs it
+    def boost(self, shortname, rate, priority):
+        channel = self.byName.get(shortname)
+        if channel is not None:
+            channel.rate = rate
+            channel.priority = priority
+            channel.nextDue = 0.0
+
+    def unboost(self, shortname):
+        channel = self.byName.get(shortname)
+        if channel is not None:
+            channel.rate = channel.baseRate
+            channel.priority = channel.basePriority
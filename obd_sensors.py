@@ -24,12 +24,9 @@
 
 import time
 import sys
-import wx
-
 
 def hex_to_int(str):
-    i = eval("0x" + str, {}, {})
-    return i
+    return int(str, 16)
 
 def maf(code):
     code = hex_to_int(code)
@@ -146,16 +143,36 @@ class Sensor:
         self.valueParserFunc = valueParserFunc
         self.unit = strUnit
         self.enabled = bEnabled
+
+        # Time (in seconds) the current value was sampled, None until the first sample arrives
+        self.timestamp = None
         
-    # Update the sensor value
-    def update(self, newVal):
-        self.value = self.valueParserFunc(newVal)
+    # Update the sensor value from the raw hex data returned by the ECU, sampled at the given time (defaults to now)
+    def update(self, newVal, timestamp=None):
+        self.setValue(self.valueParserFunc(newVal), timestamp)
+
+    # Set an already decoded value, sampled at the given time (defaults to now)
+    def setValue(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.value = value
+        self.timestamp = timestamp
         
         # Update min/max
         if self.value < self.minRecordedVal:
             self.minRecordedVal = self.value
         if self.value > self.maxRecordedVal:
             self.maxRecordedVal = self.value
+
+    # Age of the current value in seconds (infinite if the sensor has never been sampled)
+    def getAge(self):
+        if self.timestamp is None:
+            return float("inf")
+        return time.time() - self.timestamp
+
+    # A stale sensor is showing a value older than maxAge seconds, so it shouldn't be displayed as live
+    def isStale(self, maxAge):
+        return self.getAge() > maxAge
         
     def getFormattedValue(self):
         # Get the actual value unless we don't have a command set (debug mode)
@@ -188,57 +205,41 @@ class SensorLimits(Sensor):
         self.lowerSafeLimit = lowerSafeLimit
         self.upperSafeLimit = upperSafeLimit
 
-    # Update UI to reflect status of sensor value within the limits
-    def updateUi(self, uiElement):
-        if self.value >= self.lowerSafeLimit and self.value <= self.upperSafeLimit:
-            # Within safe limits
-            uiElement.SetForegroundColour(wx.Colour(0, 255, 0))
-        elif self.value > self.upperSafeLimit:
-            # Above safe limit
-            uiElement.SetForegroundColour(wx.Colour(255, 0, 0))
-        else:
-            # Below safe limit
-            uiElement.SetForegroundColour(wx.Colour(255, 255, 0))
         
         
-# The coolant sensor class is a bespoke class that is used to display when the coolant has been up to operating temperature for
-# more than five minutes. This is for cars that don't have access to the oil temperature via OBD2 (like mine). Waiting five minutes
-# after the coolant has warmed up generally means the oil should be warmed up too, so we want to display this.
+# The coolant sensor class is a bespoke class that is used to display when the oil should have warmed up, as estimated by the
+# thermal model from the coolant temperature and how hard the engine has been working (see pigauge_thermal). This is for cars
+# that don't have access to the oil temperature via OBD2 (like mine).
 class CoolantSensor(SensorLimits):
     def __init__(self, shortName, sensorName, sensorCmd, valueParserFunc, strUnit, min, max, lowerSafeLimit, upperSafeLimit, bEnabled):
         SensorLimits.__init__(self, shortName, sensorName, sensorCmd, valueParserFunc, strUnit, min, max, lowerSafeLimit, upperSafeLimit, bEnabled)
         self.bReachedOpTemp = False
         self.bOilTempReady = False
-        self.timeLastReachedTemp = sys.maxint
         
-        # This defines the time to wait in seconds that oil takes to warm up after coolant has (default: 5 mins)
-        self.oilTempDelay = 300
+        # Thermal model estimating the oil temperature (see pigauge_thermal), set by the gauges. Without one, the oil is
+        # taken to be ready once the coolant is up to temp.
+        self.thermal = None
         
         # This is the tolerance that the coolant must drop below after dropping past the lower safe limit in order for the oil to be
         # flagged as "not ready" again
         self.dropTempTolerance = 4
         
-    def update(self, newVal):
-        Sensor.update(self, newVal)
+    def setValue(self, value, timestamp=None):
+        Sensor.setValue(self, value, timestamp)
         
         # Is the sensor up-to-temp yet?
         if self.bReachedOpTemp == False and self.value >= self.lowerSafeLimit:
             self.bReachedOpTemp = True
-            
-            # Get current time (in seconds)
-            self.timeLastReachedTemp = time.time()
         
         # Has the temp dropped? (shouldn't happen, unless the engine is switched off. best to handle it anyway.)
         if self.bReachedOpTemp and self.value < (self.lowerSafeLimit - self.dropTempTolerance):
-            # This will essentially reset the oil warm-up timer
             self.bReachedOpTemp = False
-            self.bOilTempReady = False
-            self.timeLastReachedTemp = sys.maxint
         
-        # Has the sensor been up-to-temp for more than five minutes?
-        if self.bReachedOpTemp and time.time() > (self.timeLastReachedTemp + self.oilTempDelay):
-            # Oil temp should be ready now!
-            self.bOilTempReady = True
+        # Has the oil warmed up?
+        if self.thermal is not None:
+            self.bOilTempReady = self.thermal.isOilReady()
+        else:
+            self.bOilTempReady = self.bReachedOpTemp
             
     def getFormattedValue(self):
         formatted = Sensor.getFormattedValue(self)
@@ -246,35 +247,22 @@ class CoolantSensor(SensorLimits):
         # Add oil temp indicator
         formatted = formatted + str("\nOIL:")
         
-        if self.bReachedOpTemp:
-            if self.bOilTempReady:
-                # Oil is ready
-                formatted = formatted + str("OK")
-            else:
-                # Display countdown
-                timeLeft = int(self.timeLastReachedTemp + self.oilTempDelay - time.time())
-                formatted = formatted + str(timeLeft) + str("s")
+        timeLeft = None
+        if self.thermal is not None:
+            timeLeft = self.thermal.getOilReadyTime()
+        
+        if self.bOilTempReady:
+            # Oil is ready
+            formatted = formatted + str("OK")
+        elif timeLeft is not None:
+            # Display countdown
+            formatted = formatted + str(int(timeLeft)) + str("s")
         else:
             # Wait for coolant temp
             formatted = formatted + str("WAIT")
         
         return formatted
 
-    # Updates the colours on the UI to reflect the status of the coolant
-    def updateUi(self, uiElement):
-        if self.bOilTempReady and self.value <= self.upperSafeLimit:
-            # Oil temp ready and coolant safe
-            uiElement.SetForegroundColour(wx.Colour(0, 255, 0))
-        elif self.value > self.upperSafeLimit:
-            # Coolant unsafe (too hot)
-            uiElement.SetForegroundColour(wx.Colour(255, 0, 0))
-        elif self.bOilTempReady == False and self.value >= self.lowerSafeLimit and self.value <= self.upperSafeLimit:
-            # Oil not ready but coolant is safe
-            uiElement.SetForegroundColour(wx.Colour(255, 153, 0))
-        else:
-            # Coolant unsafe(too cold)
-            uiElement.SetForegroundColour(wx.Colour(255, 255, 0))
-
 
 # NOTE: The ordering of this array is important
 SENSORS = [
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# This file defines the live value bus, a shared memory segment the acquisition process publishes the latest value of
+# every channel into. Any number of other processes (the gauges, a logger, analytics) can read it without touching the
+# serial port, which only one process can own.
+#
+# The layout is fixed: a header, then one slot per entry in obd_sensors.SENSORS, in the same order. A slot is
+# (sequence, status, timestamp, value). Each slot is a seqlock: the writer makes the sequence odd while it updates the
+# slot and even again afterwards, and a reader retries until it sees the same even sequence before and after reading.
+# Readers unpack straight from the mapping, nothing is copied or locked.
+
+import os
+import mmap
+import struct
+import time
+
+import obd_sensors
+from obd_utils import DATA_DIR
+
+MAGIC = "PGSHM1\0\0"
+
+# Magic, number of slots and slot size
+HEADER = struct.Struct("<8sII")
+
+# Sequence, then status, timestamp and value
+SEQUENCE = struct.Struct("<I")
+SLOT_DATA = struct.Struct("<Idd")
+SLOT_SIZE = SEQUENCE.size + SLOT_DATA.size
+
+# Slot status: never written, or holding a sampled value
+STATUS_NONE = 0
+STATUS_OK = 1
+
+# Times a reader tries a slot that keeps changing under it before giving up, e.g. if the writer died mid-update
+MAX_READ_ATTEMPTS = 1000
+
+# Kept in RAM (tmpfs) where available, as the segment is rewritten many times a second
+if os.path.isdir("/dev/shm"):
+    SHM_PATH = "/dev/shm/pigauge_live"
+else:
+    SHM_PATH = os.path.join(DATA_DIR, "live.shm")
+
+def getSegmentSize(count):
+    return HEADER.size + count * SLOT_SIZE
+
+class LiveValueWriter:
+    """ Publishes channel values into the segment. There must only be one writer."""
+    def __init__(self, path=SHM_PATH, count=None):
+        if count is None:
+            count = len(obd_sensors.SENSORS)
+        self.path = path
+        self.count = count
+        size = getSegmentSize(count)
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+
+        # Clear anything left by a previous run, then write the header so readers know the layout
+        self.map[:size] = "\0" * size
+        HEADER.pack_into(self.map, 0, MAGIC, count, SLOT_SIZE)
+        self.sequences = [0] * count
+
+    def publish(self, index, value, timestamp=None, status=STATUS_OK):
+        if timestamp is None:
+            timestamp = time.time()
+        offset = HEADER.size + index * SLOT_SIZE
+        sequence = self.sequences[index]
+        # Odd while the slot is being written
+        SEQUENCE.pack_into(self.map, offset, (sequence + 1) & 0xFFFFFFFF)
+        SLOT_DATA.pack_into(self.map, offset + SEQUENCE.size, status, timestamp, value)
+        sequence = (sequence + 2) & 0xFFFFFFFF
+        SEQUENCE.pack_into(self.map, offset, sequence)
+        self.sequences[index] = sequence
+
+    def close(self):
+        self.map.close()
+
+class LiveValueReader:
+    """ Reads channel values from the segment"""
+    def __init__(self, path=SHM_PATH):
+        self.path = path
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(fd)
+
+        magic, self.count, slotSize = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or slotSize != SLOT_SIZE or size < getSegmentSize(self.count):
+            self.map.close()
+            raise ValueError("Not a PiGaugeOBD live value segment: %s" % path)
+
+        # Last consistent read of each slot, returned if a slot can't be read consistently
+        self.lastRead = [(0.0, 0.0, STATUS_NONE)] * self.count
+
+    # Returns (value, timestamp, status) of a channel. If the slot doesn't stay still for MAX_READ_ATTEMPTS tries, the
+    # last value read is returned instead (its timestamp shows how stale it is), or STATUS_NONE if there isn't one.
+    def read(self, index):
+        offset = HEADER.size + index * SLOT_SIZE
+        dataOffset = offset + SEQUENCE.size
+        for attempt in xrange(MAX_READ_ATTEMPTS):
+            (sequence,) = SEQUENCE.unpack_from(self.map, offset)
+            if sequence & 1:
+                # Being written, which only takes a moment
+                continue
+            status, timestamp, value = SLOT_DATA.unpack_from(self.map, dataOffset)
+            if SEQUENCE.unpack_from(self.map, offset)[0] == sequence:
+                self.lastRead[index] = (value, timestamp, status)
+                return value, timestamp, status
+        return self.lastRead[index]
+
+    # Returns a list of (value, timestamp, status) of every channel
+    def readAll(self):
+        return [self.read(index) for index in range(self.count)]
+
+    def close(self):
+        self.map.close()
+
+class SharedOBDPort:
+    """ Sensor interface (like OBDPort) reading the live value bus, for running the gauges alongside
+    the acquisition daemon. Updating a sensor takes its latest published value."""
+    def __init__(self, path=SHM_PATH):
+        self.ELMver = "Shared"
+        self.State = 1
+        self.port = None
+        self.name = path
+        try:
+            self.reader = LiveValueReader(path)
+        except (OSError, IOError, ValueError) as e:
+            print e
+            self.State = 0
+            return
+
+        self.indexes = {}
+        for i in range(min(len(obd_sensors.SENSORS), self.reader.count)):
+            self.indexes[obd_sensors.SENSORS[i].shortname] = i
+
+    def close(self):
+        if self.State == 1:
+            self.reader.close()
+        self.State = 0
+
+    # Returns the indexes of the sensors the writer has published
+    def getPublishedSensors(self):
+        values = self.reader.readAll()
+        return [i for i in range(len(values)) if values[i][2] != STATUS_NONE]
+
+    def updateSensor(self, sensor):
+        index = self.indexes.get(sensor.shortname)
+        if index is None:
+            return
+        value, timestamp, status = self.reader.read(index)
+        if status == STATUS_OK and timestamp != sensor.timestamp:
+            sensor.setValue(value, timestamp)
+        # Otherwise the sensor keeps its last value, which ages until it is flagged as stale
+
+    def updateSensorByIndex(self, sensor_index):
+        self.updateSensor(obd_sensors.SENSORS[sensor_index])
+
+    def getSensorTuple(self, sensor_index):
+        sensor = obd_sensors.SENSORS[sensor_index]
+        return sensor.name, sensor.value, sensor.unit
+
+    def getSensorFormatted(self, sensor_index):
+        return obd_sensors.SENSORS[sensor_index].getFormattedValue()
+
+    def get_dtc(self):
+        return []
+
+    def clear_dtc(self):
+        return None
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# This file defines the adaptive timing used by OBDPort. It learns, per vehicle and per PID, how many ECUs answer
+# and how long they take. Requests can then carry the ELM327 response count digit (e.g. "010C1"), so the adapter
+# returns as soon as the answers are in instead of waiting for its timeout, and AT ST can be tightened.
+
+import string
+
+from obd_utils import loadState, saveState
+
+# Number of requests with the same number of responses before a PID is given a response count hint
+LEARN_SAMPLES = 3
+
+# Number of misses after which a PID is no longer hinted for the rest of the session
+MAX_MISSES = 3
+
+# Weight of a new latency sample in the moving average
+LATENCY_WEIGHT = 0.2
+
+# AT ST values, in the ELM327 units of 4 ms. The default is the ELM327 power-on value (200 ms).
+DEFAULT_TIMEOUT = 0x32
+MIN_TIMEOUT = 0x08
+
+# AT ST is set to the slowest learned latency multiplied by this margin. It grows every time a tuned timeout misses.
+TIMEOUT_MARGIN = 2.0
+MAX_TIMEOUT_MARGIN = 8.0
+
+# Gets an identifier for the vehicle from its "0100" (supported PIDs) response
+def vehicleIdFromPids(response):
+    response = string.join(string.split(response), "")
+    start = response.find("4100")
+    if start < 0:
+        return None
+    return response[start:start + 12]
+
+# Splits a sensor command into the command without response count digit, and the digit (None if there isn't one)
+def splitCommand(cmd):
+    # Mode 01 and 02 requests are a two digit mode plus two digit PID, anything after that is the count digit
+    if len(cmd) == 5 and cmd[:2] in ("01", "02"):
+        return cmd[:4], int(cmd[4])
+    return cmd, None
+
+# What has been learned about one PID
+class PidTiming:
+    def __init__(self):
+        # Number of responses seen, and how many requests in a row returned that many
+        self.responses = None
+        self.consistent = 0
+
+        # Average latency (in seconds) of hinted requests, which is close to the ECU response time
+        self.latency = None
+
+        self.misses = 0
+        self.hinted = False
+
+    def toDict(self):
+        return {"responses": self.responses, "latency": self.latency, "hinted": self.hinted}
+
+    def fromDict(self, d):
+        self.responses = d.get("responses")
+        self.latency = d.get("latency")
+        self.hinted = d.get("hinted", False) and self.responses is not None
+        if self.hinted:
+            self.consistent = LEARN_SAMPLES
+
+class AdaptiveTiming:
+    def __init__(self, vehicleId=None):
+        self.vehicleId = vehicleId
+        self.pids = {}
+
+        # Timeout currently set on the adapter (AT ST) and the margin used to calculate it
+        self.timeout = DEFAULT_TIMEOUT
+        self.margin = TIMEOUT_MARGIN
+
+        # Set when a response count, hint or the margin has changed since the timing was loaded or saved
+        self.changed = False
+
+        self.load()
+
+    def getPid(self, cmd):
+        base, hint = splitCommand(cmd)
+        timing = self.pids.get(base)
+        if timing is None:
+            timing = PidTiming()
+            # Hints already written into the sensor table are trusted until they miss
+            if hint is not None:
+                timing.responses = hint
+                timing.consistent = LEARN_SAMPLES
+                timing.hinted = True
+            self.pids[base] = timing
+        return timing
+
+    # Returns the command to send for a sensor command, with a response count digit if one has been learned
+    def command(self, cmd):
+        base = splitCommand(cmd)[0]
+        timing = self.getPid(cmd)
+        if timing.hinted and timing.responses < 10:
+            return base + str(timing.responses)
+        return base
+
+    # Records a successful request. lines are the response lines and latency the time taken in seconds.
+    def record(self, cmd, lines, latency):
+        base = splitCommand(cmd)[0]
+        timing = self.getPid(cmd)
+
+        # Count the answers, i.e. the lines starting with the positive response to this request ("41 0C" for "010C")
+        expected = "%X" % (int(base[:2], 16) + 0x40) + base[2:]
+        responses = 0
+        for line in lines:
+            if string.join(string.split(line), "")[:len(expected)] == expected:
+                responses += 1
+        if responses == 0:
+            return
+
+        if timing.hinted:
+            # Only hinted requests return as soon as the ECU answers, so only they measure the ECU response time
+            if timing.latency is None:
+                timing.latency = latency
+            else:
+                timing.latency += LATENCY_WEIGHT * (latency - timing.latency)
+            return
+
+        if responses == timing.responses:
+            timing.consistent += 1
+        else:
+            timing.responses = responses
+            timing.consistent = 1
+            self.changed = True
+
+        if timing.consistent >= LEARN_SAMPLES and timing.misses < MAX_MISSES:
+            timing.hinted = True
+            self.changed = True
+
+    # Records a request that got no answer. timedOut is False if the adapter answered NO DATA, which doesn't mean the
+    # adapter timeout is too short. Returns True if the adapter timeout should go back to its default.
+    def miss(self, cmd, timedOut=True):
+        timing = self.getPid(cmd)
+        if timing.hinted:
+            # Fall back to an unhinted request and learn the response count again
+            timing.misses += 1
+            timing.hinted = False
+            timing.consistent = 0
+            timing.latency = None
+            self.changed = True
+
+        if timedOut and self.timeout < DEFAULT_TIMEOUT:
+            # The tuned timeout may have been too short. Back off and be more careful next time.
+            self.margin = min(self.margin * 1.5, MAX_TIMEOUT_MARGIN)
+            self.timeout = DEFAULT_TIMEOUT
+            self.changed = True
+            return True
+        return False
+
+    # Calculates the AT ST value from the learned latencies, or returns None if it should stay as it is
+    def tunedTimeout(self):
+        latencies = [t.latency for t in self.pids.values() if t.hinted and t.latency is not None]
+        if len(latencies) == 0:
+            return None
+
+        timeout = int(max(latencies) * self.margin / 0.004) + 1
+        timeout = max(MIN_TIMEOUT, min(DEFAULT_TIMEOUT, timeout))
+
+        # Avoid sending AT ST for small changes
+        if abs(timeout - self.timeout) <= 2:
+            return None
+        self.timeout = timeout
+        return timeout
+
+    def getFilename(self):
+        if self.vehicleId is None:
+            return None
+        return "timing_" + self.vehicleId + ".json"
+
+    def load(self):
+        filename = self.getFilename()
+        if filename is None:
+            return
+        state = loadState(filename, {})
+        self.margin = state.get("margin", TIMEOUT_MARGIN)
+        for base, d in state.get("pids", {}).items():
+            timing = PidTiming()
+            timing.fromDict(d)
+            self.pids[str(base)] = timing
+
+    def save(self):
+        filename = self.getFilename()
+        if filename is None:
+            return
+        pids = {}
+        for base, timing in self.pids.items():
+            pids[base] = timing.toDict()
+        saveState(filename, {"margin": self.margin, "pids": pids})
+        self.changed = False
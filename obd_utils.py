@@ -1,4 +1,9 @@
 import serial
+import os
+import json
+
+# Directory where settings learned at runtime (adapter timings, link speeds etc.) are kept between runs
+DATA_DIR = os.path.join(os.path.expanduser("~"), ".pigauge")
 
 def scanSerial():
     """scan for available ports. return a list of serial names"""
@@ -29,4 +34,34 @@ def scanSerial():
       #except serial.SerialException:
         #pass
     
-    return available
\ No newline at end of file
+    return available
+
+
+def loadState(filename, default):
+    """load a JSON state file from the data directory. returns default if it is missing or unreadable"""
+    try:
+        f = open(os.path.join(DATA_DIR, filename), "r")
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return default
+
+def saveState(filename, state):
+    """save state as a JSON file in the data directory, returning False if it could not be written"""
+    try:
+        if not os.path.isdir(DATA_DIR):
+            os.makedirs(DATA_DIR)
+        # Write to a temporary file first so a power cut can't leave a half written file behind
+        path = os.path.join(DATA_DIR, filename)
+        f = open(path + ".tmp", "w")
+        try:
+            json.dump(state, f)
+        finally:
+            f.close()
+        os.rename(path + ".tmp", path)
+        return True
+    except (IOError, OSError) as e:
+        print e
+        return False
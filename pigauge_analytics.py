@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# Batch analytics over a directory of binary logs (see obd_binlog), e.g. the logs uploaded by a fleet:
+#
+#   python pigauge_analytics.py [-j processes] [-o report.json] <log directory>
+#
+# Each log is analysed on its own, in a pool of processes, into a partial result: time at coolant temperature, time in
+# each rpm/load cell, overheat events, distance and fuel used. Partial results merge by adding them up, so the logs of a
+# vehicle that follow on from each other are merged into trips, and the trips into totals for the vehicle.
+#
+# Partial results are cached by the SHA-1 of the log, so a rerun only analyses new logs.
+
+import os
+import getopt
+import hashlib
+import json
+import multiprocessing
+import struct
+import sys
+import time
+
+import numpy
+
+import obd_sensors
+from obd_binlog import BinLogReader, RECORD_SIZE
+from obd_utils import loadState, saveState
+
+# Partial results of analysed logs by hash. Bump ANALYTICS_VERSION when the partial results change.
+ANALYTICS_CACHE_FILE = "analytics_cache.json"
+ANALYTICS_VERSION = 2
+
+# Records read and analysed at a time
+CHUNK_RECORDS = 65536
+
+# Longest time (in seconds) a sample is taken to hold its value. Longer gaps (the adapter dropped out) aren't counted.
+MAX_GAP = 5.0
+
+# Logs of a vehicle less than this many seconds apart belong to the same trip
+TRIP_GAP = 300.0
+
+# Histogram bin edges: coolant temperature (C), rpm and calculated load (%). The last coolant bin is open-ended,
+# holding everything over its lower edge.
+TEMP_BINS = range(-40, 150, 10)
+RPM_BINS = range(0, 8001, 500)
+LOAD_BINS = range(0, 101, 10)
+
+# Air fuel ratio and the weight (in lb) of a US gallon of petrol, for fuel used from the MAF
+AIR_FUEL_RATIO = 14.7
+FUEL_LB_PER_GALLON = 6.17
+
+# Coolant above this (C) is an overheat
+OVERHEAT_TEMP = obd_sensors.SENSORS[5].upperSafeLimit
+
+RECORD_DTYPE = numpy.dtype([("timestamp", "<f8"), ("channel", "u1"), ("value", "<f8")])
+
+# Returns an empty partial result
+def newPartial(vehicle=None, start=None):
+    return {
+        "vehicle": vehicle,
+        "start": start,
+        "end": start,
+        "logs": 0,
+        "samples": 0,
+        "tempTime": [0.0] * (len(TEMP_BINS) - 1),
+        "rpmLoadTime": [[0.0] * (len(LOAD_BINS) - 1) for i in range(len(RPM_BINS) - 1)],
+        "overheats": [],
+        "maxTemp": None,
+        "miles": 0.0,
+        "gallons": 0.0,
+    }
+
+# Adds partial result b into a. Overheat events that run on from one into the other are joined.
+def mergePartials(a, b):
+    a["vehicle"] = a["vehicle"] or b["vehicle"]
+    if b["start"] is not None:
+        a["start"] = b["start"] if a["start"] is None else min(a["start"], b["start"])
+        a["end"] = b["end"] if a["end"] is None else max(a["end"], b["end"])
+    a["logs"] += b["logs"]
+    a["samples"] += b["samples"]
+    a["tempTime"] = (numpy.array(a["tempTime"]) + b["tempTime"]).tolist()
+    a["rpmLoadTime"] = (numpy.array(a["rpmLoadTime"]) + b["rpmLoadTime"]).tolist()
+    a["overheats"] = mergeEvents(a["overheats"], b["overheats"])
+    a["maxTemp"] = maxValue(a["maxTemp"], b["maxTemp"])
+    a["miles"] += b["miles"]
+    a["gallons"] += b["gallons"]
+    return a
+
+def maxValue(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+# Returns the [start, end, peak] events of both lists in order, joining events less than MAX_GAP apart
+def mergeEvents(a, b):
+    merged = []
+    for event in sorted(a + b):
+        if merged and event[0] - merged[-1][1] <= MAX_GAP:
+            last = merged[-1]
+            merged[-1] = [last[0], max(last[1], event[1]), max(last[2], event[2])]
+        else:
+            merged.append(list(event))
+    return merged
+
+# Returns the timestamps and values of one channel in a chunk, after the channel's last sample from the previous chunk,
+# so the time each sample holds its value can be worked out across chunks
+def channelSeries(records, channel, last):
+    mask = records["channel"] == channel
+    timestamps = records["timestamp"][mask]
+    values = records["value"][mask]
+    if channel in last:
+        timestamps = numpy.concatenate(([last[channel][0]], timestamps))
+        values = numpy.concatenate(([last[channel][1]], values))
+    if len(timestamps):
+        last[channel] = (timestamps[-1], values[-1])
+    return timestamps, values
+
+# Time (in seconds) each sample but the last holds its value
+def holdTimes(timestamps):
+    durations = numpy.diff(timestamps)
+    durations[durations > MAX_GAP] = 0.0
+    return durations
+
+# Returns [start, end, peak] for every run of samples where flags is set
+def findRuns(timestamps, values, flags):
+    if not flags.any():
+        return []
+    edges = numpy.diff(numpy.concatenate(([0], flags.astype(numpy.int8), [0])))
+    starts = numpy.nonzero(edges == 1)[0]
+    ends = numpy.nonzero(edges == -1)[0] - 1
+    return [[float(timestamps[s]), float(timestamps[e]), float(values[s:e + 1].max())] for s, e in zip(starts, ends)]
+
+# Returns the start time of every interval holding samples, and the count, min, max, mean and last value of the samples
+# in each. The timestamps must be in order.
+def rollup(timestamps, values, interval):
+    bins = numpy.floor(timestamps / interval)
+    starts = numpy.nonzero(numpy.concatenate(([True], bins[1:] != bins[:-1])))[0]
+    counts = numpy.diff(numpy.concatenate((starts, [len(values)])))
+    return (bins[starts] * interval, counts, numpy.minimum.reduceat(values, starts),
+            numpy.maximum.reduceat(values, starts), numpy.add.reduceat(values, starts) / counts,
+            values[starts + counts - 1])
+
+# Yields the records of a log (see BinLogReader) as numpy arrays of up to count records
+def readRecordArrays(reader, count=None):
+    if count is None:
+        count = CHUNK_RECORDS
+    reader.file.seek(reader.dataOffset)
+    while 1:
+        data = reader.file.read(count * RECORD_SIZE)
+        n = len(data) / RECORD_SIZE
+        if n == 0:
+            break
+        yield numpy.frombuffer(data[:n * RECORD_SIZE], RECORD_DTYPE)
+
+def analyseChunk(partial, records, channels, last):
+    partial["samples"] += len(records)
+
+    if "temp" in channels:
+        timestamps, values = channelSeries(records, channels["temp"], last)
+        if len(values) > 1:
+            partial["tempTime"] = (numpy.array(partial["tempTime"]) +
+                                   numpy.histogram(numpy.minimum(values[:-1], TEMP_BINS[-1]), TEMP_BINS, weights=holdTimes(timestamps))[0]).tolist()
+        if len(values):
+            partial["maxTemp"] = maxValue(partial["maxTemp"], float(values.max()))
+
+        # Runs of samples over the limit. An event running on from the last chunk starts at the carried over sample and
+        # joins up with the event recorded for it.
+        events = findRuns(timestamps, values, values > OVERHEAT_TEMP)
+        if events:
+            partial["overheats"] = mergeEvents(partial["overheats"], events)
+
+    if "rpm" in channels and "load" in channels:
+        # The load when each rpm sample was taken, from the latest load sample before it (NaN if there was none). The
+        # last rpm sample is carried over with its load, as the load may have been sampled again since.
+        loadTimestamps, loadValues = channelSeries(records, channels["load"], last)
+        mask = records["channel"] == channels["rpm"]
+        timestamps = records["timestamp"][mask]
+        values = records["value"][mask]
+        loadIndexes = numpy.searchsorted(loadTimestamps, timestamps, "right") - 1
+        loads = numpy.empty(len(timestamps))
+        loads.fill(numpy.nan)
+        loads[loadIndexes >= 0] = loadValues[loadIndexes[loadIndexes >= 0]]
+        if "rpmLoad" in last:
+            timestamps = numpy.concatenate(([last["rpmLoad"][0]], timestamps))
+            values = numpy.concatenate(([last["rpmLoad"][1]], values))
+            loads = numpy.concatenate(([last["rpmLoad"][2]], loads))
+        if len(timestamps):
+            last["rpmLoad"] = (timestamps[-1], values[-1], loads[-1])
+        if len(values) > 1:
+            known = ~numpy.isnan(loads[:-1])
+            histogram = numpy.histogram2d(values[:-1][known], loads[:-1][known],
+                                          [RPM_BINS, LOAD_BINS], weights=holdTimes(timestamps)[known])[0]
+            partial["rpmLoadTime"] = (numpy.array(partial["rpmLoadTime"]) + histogram).tolist()
+
+    if "speed" in channels:
+        timestamps, values = channelSeries(records, channels["speed"], last)
+        if len(values) > 1:
+            partial["miles"] += float(numpy.dot(values[:-1], holdTimes(timestamps))) / 3600.0
+
+    if "maf" in channels:
+        # MAF is in lb of air per minute
+        timestamps, values = channelSeries(records, channels["maf"], last)
+        if len(values) > 1:
+            partial["gallons"] += (float(numpy.dot(values[:-1], holdTimes(timestamps))) / 60.0 /
+                                   AIR_FUEL_RATIO / FUEL_LB_PER_GALLON)
+
+# Analyses one log into a partial result
+def analyseLog(filename):
+    reader = BinLogReader(filename)
+    channels = dict([(shortname, index) for index, shortname in reader.channels.items()])
+    partial = newPartial(reader.header.get("vehicle"))
+    partial["logs"] = 1
+    last = {}
+    try:
+        for records in readRecordArrays(reader):
+            if partial["start"] is None:
+                partial["start"] = float(records["timestamp"][0])
+            partial["end"] = float(records["timestamp"][-1])
+            analyseChunk(partial, records, channels, last)
+    finally:
+        reader.close()
+    return partial
+
+def hashFile(filename):
+    digest = hashlib.sha1()
+    f = open(filename, "rb")
+    try:
+        while 1:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+# Pool worker: returns (hash, partial result), or (hash, None) for a file that isn't a log
+def analyseWorker(job):
+    filename, fileHash = job
+    try:
+        return fileHash, analyseLog(filename)
+    except (ValueError, IOError, struct.error) as e:
+        print "Skipping %s: %s" % (filename, e)
+        return fileHash, None
+
+# Returns the partial results of every log in a directory, analysing the ones not in the cache across processes
+def analyseDirectory(directory, processes=None):
+    cache = loadState(ANALYTICS_CACHE_FILE, {})
+    if cache.get("version") != ANALYTICS_VERSION:
+        cache = {"version": ANALYTICS_VERSION, "partials": {}}
+    cached = cache["partials"]
+
+    partials = []
+    jobs = []
+    for root, dirs, files in os.walk(directory):
+        for name in sorted(files):
+            # Files that aren't logs are skipped (and cached as such) by the workers
+            filename = os.path.join(root, name)
+            fileHash = hashFile(filename)
+            if fileHash in cached:
+                if cached[fileHash] is not None:
+                    partials.append(cached[fileHash])
+            else:
+                jobs.append((filename, fileHash))
+
+    print "%d logs cached, %d to analyse" % (len(partials), len(jobs))
+    if jobs:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for fileHash, partial in pool.imap_unordered(analyseWorker, jobs):
+                cached[fileHash] = partial
+                if partial is not None:
+                    partials.append(partial)
+        finally:
+            pool.close()
+            pool.join()
+        saveState(ANALYTICS_CACHE_FILE, cache)
+    return partials
+
+# Reduces partial results to {vehicle: {"trips": [partial], "total": partial}}
+def reducePartials(partials):
+    vehicles = {}
+    for partial in sorted(partials, key=lambda partial: partial["start"]):
+        if partial["start"] is None:
+            continue
+        vehicle = vehicles.setdefault(partial["vehicle"] or "unknown", {"trips": [], "total": newPartial()})
+        trips = vehicle["trips"]
+        if trips and partial["start"] - trips[-1]["end"] <= TRIP_GAP:
+            mergePartials(trips[-1], partial)
+        else:
+            trips.append(mergePartials(newPartial(), partial))
+        mergePartials(vehicle["total"], partial)
+    return vehicles
+
+# Figures derived from a partial result, for reports
+def summarise(partial):
+    summary = {
+        "vehicle": partial["vehicle"],
+        "start": partial["start"],
+        "duration": partial["end"] - partial["start"],
+        "miles": partial["miles"],
+        "gallons": partial["gallons"],
+        "mpg": None,
+        "maxTemp": partial["maxTemp"],
+        "overheats": len(partial["overheats"]),
+        "overheatTime": sum([event[1] - event[0] for event in partial["overheats"]]),
+    }
+    if partial["gallons"] > 0:
+        summary["mpg"] = partial["miles"] / partial["gallons"]
+    return summary
+
+def printReport(vehicles):
+    for name in sorted(vehicles):
+        vehicle = vehicles[name]
+        total = vehicle["total"]
+        summary = summarise(total)
+        print "Vehicle %s: %d trips, %.1f hours, %.1f miles" % (name, len(vehicle["trips"]),
+                                                               summary["duration"] / 3600.0, summary["miles"])
+        for trip in vehicle["trips"]:
+            tripSummary = summarise(trip)
+            line = "  %s  %5.1f min  %6.1f miles" % (time.strftime("%Y-%m-%d %H:%M", time.localtime(trip["start"])),
+                                                       tripSummary["duration"] / 60.0, tripSummary["miles"])
+            if tripSummary["mpg"] is not None:
+                line = line + "  %5.1f mpg" % tripSummary["mpg"]
+            if tripSummary["overheats"]:
+                line = line + "  %d overheats (max %d C)" % (tripSummary["overheats"], tripSummary["maxTemp"])
+            print line
+
+        if summary["mpg"] is not None:
+            print "  Fuel economy %.1f mpg" % summary["mpg"]
+        print "  Overheats: %d, %.0f s over %d C" % (summary["overheats"], summary["overheatTime"], OVERHEAT_TEMP)
+
+        tempTotal = sum(total["tempTime"])
+        if tempTotal > 0:
+            print "  Time at coolant temperature:"
+            for i in range(len(total["tempTime"])):
+                if total["tempTime"][i] == 0:
+                    continue
+                if i == len(total["tempTime"]) - 1:
+                    print "    %4d+     C %5.1f%%" % (TEMP_BINS[i], 100.0 * total["tempTime"][i] / tempTotal)
+                else:
+                    print "    %4d-%-4d C %5.1f%%" % (TEMP_BINS[i], TEMP_BINS[i + 1],
+                                                      100.0 * total["tempTime"][i] / tempTotal)
+
+        rpmLoad = numpy.array(total["rpmLoadTime"])
+        if rpmLoad.sum() > 0:
+            print "  Time at rpm (rows) and load (columns), %:"
+            print "         " + "".join(["%5d" % load for load in LOAD_BINS[:-1]])
+            percent = 100.0 * rpmLoad / rpmLoad.sum()
+            for i in range(len(RPM_BINS) - 1):
+                if rpmLoad[i].sum() > 0:
+                    print "    %5d" % RPM_BINS[i] + "".join(["%5.1f" % cell for cell in percent[i]])
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "j:o:")
+    except getopt.GetoptError as e:
+        args = []
+    if len(args) != 1:
+        print "Usage: pigauge_analytics.py [-j processes] [-o report.json] <log directory>"
+        sys.exit(1)
+    processes = None
+    output = None
+    for opt, value in opts:
+        if opt == "-j":
+            processes = int(value)
+        elif opt == "-o":
+            output = value
+
+    vehicles = reducePartials(analyseDirectory(args[0], processes))
+    printReport(vehicles)
+    if output is not None:
+        report = {}
+        for name, vehicle in vehicles.items():
+            report[name] = {"total": summarise(vehicle["total"]),
+                            "trips": [summarise(trip) for trip in vehicle["trips"]],
+                            "tempTime": dict(zip(TEMP_BINS, vehicle["total"]["tempTime"])),
+                            "rpmLoadTime": vehicle["total"]["rpmLoadTime"]}
+        f = open(output, "w")
+        json.dump(report, f, indent=1)
+        f.close()
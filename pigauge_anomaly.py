@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# This file defines the anomaly detector, which flags readings outside the operating envelope learned for the car, e.g.
+# the fuel trims drifting, the coolant rising faster than usual for the load, or the MAF not matching rpm x load.
+#
+# Each detector turns samples into a measurement (a channel's value, its rate of change, or its ratio to other
+# channels), optionally smoothed, and keeps an exponentially weighted mean and variance of the measurement in bins of
+# a context channel (e.g. the load). A measurement more than ANOMALY_SCORE standard deviations from the mean of its bin
+# for ANOMALY_SAMPLES measurements in a row is flagged, and isn't learned. Updates take constant time, so the detector
+# can run on every sample. What has been learned is kept in ANOMALY_STATE_FILE between drives.
+
+import bisect
+import math
+
+from obd_utils import loadState, saveState
+
+ANOMALY_STATE_FILE = "anomaly.json"
+
+# Weight of a new measurement in the learned mean and variance, once a bin has 1 / LEARN_RATE measurements
+LEARN_RATE = 0.001
+
+# Measurements a bin needs before its measurements are scored
+MIN_LEARNED = 200
+
+# Standard deviations from the learned mean at which a measurement is anomalous, and the measurements in a row needed
+# for the detector to be flagged
+ANOMALY_SCORE = 4.0
+ANOMALY_SAMPLES = 5
+
+# Time (in seconds) between saving what has been learned
+SAVE_INTERVAL = 300.0
+
+# Longest gap (in seconds) between samples for a rate of change to be measured
+MAX_RATE_GAP = 10.0
+
+# Exponentially weighted mean and variance of the measurements in each bin
+class Envelope:
+    def __init__(self, binCount):
+        self.counts = [0] * binCount
+        self.means = [0.0] * binCount
+        self.variances = [0.0] * binCount
+
+    def learn(self, bin, measurement):
+        self.counts[bin] += 1
+        weight = max(1.0 / self.counts[bin], LEARN_RATE)
+        difference = measurement - self.means[bin]
+        increment = weight * difference
+        self.means[bin] += increment
+        self.variances[bin] = (1.0 - weight) * (self.variances[bin] + difference * increment)
+
+    def getState(self):
+        return [self.counts, self.means, self.variances]
+
+    def setState(self, state):
+        if len(state[0]) == len(self.counts):
+            self.counts, self.means, self.variances = state
+
+class Detector:
+    def __init__(self, name, channel, message, context=None, bins=None, minDeviation=0.0, smoothing=1.0):
+        """measures channel, learning it in bins of the context channel (bins are the upper edges of all but the last
+        bin). minDeviation is the smallest standard deviation used for scoring, e.g. the channel's resolution, and
+        smoothing the weight of a new measurement in the smoothed measurement (1 is unsmoothed)."""
+        self.name = name
+        self.channel = channel
+        self.message = message
+        self.context = context
+        self.bins = bins or []
+        self.minDeviation = minDeviation
+        self.smoothing = smoothing
+        self.envelope = Envelope(len(self.bins) + 1)
+        self.smoothed = None
+        self.score = 0.0
+        self.anomalousCount = 0
+        self.flagged = False
+
+    # Returns the measurement for a new sample of the channel, or None. values are the latest values of every channel.
+    def measure(self, values, timestamp, value):
+        return value
+
+    # Measures a new sample, learning it or scoring it against what has been learned. Returns True if the detector has
+    # just been flagged.
+    def update(self, values, timestamp, value):
+        measurement = self.measure(values, timestamp, value)
+        if measurement is None:
+            return False
+        if self.smoothed is None:
+            self.smoothed = measurement
+        else:
+            self.smoothed += self.smoothing * (measurement - self.smoothed)
+
+        bin = 0
+        if self.context is not None:
+            if self.context not in values:
+                return False
+            bin = bisect.bisect_left(self.bins, values[self.context])
+
+        envelope = self.envelope
+        self.score = 0.0
+        if envelope.counts[bin] >= MIN_LEARNED:
+            deviation = max(math.sqrt(envelope.variances[bin]), self.minDeviation)
+            self.score = (self.smoothed - envelope.means[bin]) / deviation
+        if abs(self.score) < ANOMALY_SCORE:
+            envelope.learn(bin, self.smoothed)
+            self.anomalousCount = 0
+            self.flagged = False
+            return False
+
+        self.anomalousCount += 1
+        if self.anomalousCount >= ANOMALY_SAMPLES and not self.flagged:
+            self.flagged = True
+            return True
+        return False
+
+# Measures the rate of change of a channel (per second)
+class RateDetector(Detector):
+    def __init__(self, *args, **kwargs):
+        Detector.__init__(self, *args, **kwargs)
+        self.lastTimestamp = None
+        self.lastValue = None
+
+    def measure(self, values, timestamp, value):
+        rate = None
+        if self.lastTimestamp is not None and 0 < timestamp - self.lastTimestamp <= MAX_RATE_GAP:
+            rate = (value - self.lastValue) / (timestamp - self.lastTimestamp)
+        self.lastTimestamp = timestamp
+        self.lastValue = value
+        return rate
+
+# Measures a channel's ratio to the product of other channels, e.g. the MAF to rpm x load
+class RatioDetector(Detector):
+    def __init__(self, name, channel, message, divisors, minDivisor=1.0, **kwargs):
+        Detector.__init__(self, name, channel, message, **kwargs)
+        self.divisors = divisors
+        self.minDivisor = minDivisor
+
+    def measure(self, values, timestamp, value):
+        divisor = 1.0
+        for channel in self.divisors:
+            if channel not in values:
+                return None
+            divisor *= values[channel]
+        if divisor < self.minDivisor:
+            return None
+        return value / divisor
+
+# Returns the detectors for the fuel trims drifting, the coolant rising faster than usual for the load and the MAF
+# not matching rpm x load (which it is proportional to, for a given rpm)
+def defaultDetectors():
+    detectors = []
+    for bank in ("1", "2"):
+        detectors.append(Detector("fuel_trim_drift_" + bank, "long_term_fuel_trim_" + bank, "FUEL TRIM DRIFT " + bank,
+                                  context="load", bins=[30, 60], minDeviation=1.0, smoothing=0.05))
+    detectors.append(RateDetector("coolant_rise", "temp", "COOLANT RISING FAST", context="load", bins=[20, 40, 60, 80],
+                                  minDeviation=0.05, smoothing=0.1))
+    detectors.append(RatioDetector("maf_mismatch", "maf", "MAF MISMATCH", ["rpm", "load"], minDivisor=5000.0,
+                                   context="rpm", bins=[1500, 2500, 3500, 4500], minDeviation=1e-6, smoothing=0.2))
+    return detectors
+
+class AnomalyDetector:
+    def __init__(self, detectors=None, triggers=None):
+        """triggers is the TriggerEngine started when a detector is flagged"""
+        if detectors is None:
+            detectors = defaultDetectors()
+        self.detectors = detectors
+        self.triggers = triggers
+
+        # Detectors by the channel they measure, and the latest value of every channel
+        self.byChannel = {}
+        for detector in detectors:
+            self.byChannel.setdefault(detector.channel, []).append(detector)
+        self.values = {}
+
+        state = loadState(ANOMALY_STATE_FILE, {})
+        for detector in detectors:
+            if detector.name in state:
+                detector.envelope.setState(state[detector.name])
+        self.lastSave = None
+
+    # Adds a sample, updating the detectors that measure its channel
+    def add(self, shortname, timestamp, value):
+        self.values[shortname] = value
+        for detector in self.byChannel.get(shortname, ()):
+            if detector.update(self.values, timestamp, value):
+                print "Anomaly %s (score %.1f)" % (detector.name, detector.score)
+                if self.triggers is not None:
+                    self.triggers.fire(detector.name, timestamp)
+
+        if self.lastSave is None:
+            self.lastSave = timestamp
+        elif timestamp - self.lastSave >= SAVE_INTERVAL:
+            self.save()
+            self.lastSave = timestamp
+
+    # Messages of the flagged detectors
+    def getAlerts(self):
+        return [detector.message for detector in self.detectors if detector.flagged]
+
+    def save(self):
+        state = loadState(ANOMALY_STATE_FILE, {})
+        for detector in self.detectors:
+            state[detector.name] = detector.envelope.getState()
+        saveState(ANOMALY_STATE_FILE, state)
+
+    def close(self):
+        self.save()
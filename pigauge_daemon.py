@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# Headless acquisition daemon, for units with no display. It finds the adapters, works out which sensors the car
+# supports, polls them across all the adapters and logs every sample to a binary log (see obd_binlog):
+#
+#   python pigauge_daemon.py [log directory]
+#
+# Nothing here imports wx. The latest value of every channel is also published on the live value bus (see obd_shm),
+# which the gauges and other processes can read while the daemon owns the adapters, and streamed to subscribers (see
+# pigauge_telemetry). Other consumers of the samples are attached with addSink.
+
+import os
+import signal
+import sys
+import time
+
+import obd_io
+import obd_sensors
+import obd_shm
+from pigauge_telemetry import TelemetryServer
+from pigauge_triggers import TriggerEngine
+from pigauge_rules import RuleEngine
+from pigauge_anomaly import AnomalyDetector
+from pigauge_thermal import ThermalModel
+from pigauge_heatmap import ResidencyHeatmaps
+from pigauge_tripstore import TripStore
+from obd_acquisition import Acquisition
+from obd_binlog import BinLogWriter, repairLog
+from obd_scheduler import Channel
+from obd_utils import scanSerial, DATA_DIR
+
+# Try to raise the serial link above the ELM327 default of 38400 baud when connecting
+NEGOTIATE_BAUD = True
+
+# Most adapters to poll at once, as channels are sharded across all the adapters found
+MAX_PORTS = 2
+
+LOG_DIR = os.path.join(DATA_DIR, "logs")
+
+# Publish the latest values on the live value bus
+PUBLISH_LIVE_VALUES = True
+
+# Stream live values to subscribers on a Unix socket, and on this TCP port if set (e.g. 7878). The TCP port only
+# accepts connections from this machine unless TELEMETRY_HOST is set to "" (every interface), e.g. for pit laptops.
+TELEMETRY = True
+TELEMETRY_PORT = None
+TELEMETRY_HOST = "127.0.0.1"
+
+# Polls per second and priority of channels by sensor short name. Other supported sensors are polled at DEFAULT_RATE.
+CHANNEL_RATES = {
+    "rpm": (10.0, 1),
+    "speed": (5.0, 1),
+    "throttle_pos": (10.0, 1),
+    "load": (5.0, 0),
+    "maf": (5.0, 0),
+    "manifold_pressure": (5.0, 0),
+    "temp": (0.5, 0),
+    "engine_time": (0.1, 0),
+}
+DEFAULT_RATE = 1.0
+
+# Capture the lead up to alerts to event files (see pigauge_triggers and pigauge_rules)
+CAPTURE_EVENTS = True
+
+# Read the DTCs when starting, adding codes the car hasn't reported before to the trip store (see pigauge_tripstore)
+RECORD_DTCS = True
+
+# Flag readings outside the learned operating envelope (see pigauge_anomaly)
+DETECT_ANOMALIES = True
+
+# Time (in seconds) between flushing the log to disk
+FLUSH_INTERVAL = 5.0
+
+# The log is split into chunks of this many seconds. A chunk is written to a ".part" file, which is renamed when the
+# chunk is complete, so complete chunks can be uploaded (see pigauge_uploader) while logging continues.
+LOG_CHUNK_SECONDS = 600
+LOG_EXTENSION = ".pglog"
+PARTIAL_EXTENSION = ".part"
+
+class PiGaugeDaemon:
+    def __init__(self, logDir=LOG_DIR):
+        self.logDir = logDir
+        self.ports = []
+        self.acquisition = None
+        self.writer = None
+        self.logChannels = None
+        self.sampleCount = 0
+        self.bus = None
+        self.telemetry = None
+        self.triggers = None
+        self.rules = None
+        self.anomalies = None
+        self.thermal = ThermalModel()
+        self.heatmaps = ResidencyHeatmaps()
+        self.sinks = []
+        self.running = False
+
+    # Opens every adapter found, up to MAX_PORTS
+    def connect(self):
+        for portname in scanSerial():
+            port = obd_io.OBDPort(portname, None, 2, 2, negotiateBaud=NEGOTIATE_BAUD)
+            if port.State == 0:
+                port.close()
+                continue
+            print "Connected to " + portname
+            self.ports.append(port)
+            if len(self.ports) >= MAX_PORTS:
+                break
+        return len(self.ports) > 0
+
+    # Returns the indexes of the sensors the car supports and answers with numeric values
+    def getSupportedSensors(self):
+        port = self.ports[0]
+        port.updateSensorByIndex(0)
+        supportedPIDs = str(port.getSensorTuple(0)[1])
+        supported = []
+        for i in range(1, len(obd_sensors.SENSORS)):
+            sensor = obd_sensors.SENSORS[i]
+            pid = int(sensor.cmd[2:4], 16)
+            if pid > len(supportedPIDs) or supportedPIDs[pid - 1] != "1":
+                continue
+            # Status sensors decode to text, which isn't logged
+            port.updateSensor(sensor)
+            if sensor.timestamp is not None and type(sensor.value) in (int, long, float):
+                supported.append(i)
+        return supported
+
+    # Adds a consumer of samples, called as sink(timestamp, sensor index, short name, value)
+    def addSink(self, sink):
+        self.sinks.append(sink)
+
+    # Reads the stored and freeze frame DTCs, adding codes the car hasn't reported before to the trip store and
+    # capturing what follows them. A failed read is only reported, so it never stops the daemon starting.
+    def readDtcs(self):
+        try:
+            codes = [code for status, code in self.ports[0].get_dtc()]
+            tripStore = TripStore()
+            try:
+                newCodes = tripStore.recordDtcs(self.ports[0].timing.vehicleId, codes)
+            finally:
+                tripStore.close()
+        except Exception as e:
+            print "Could not read the DTCs: " + str(e)
+            return
+        if newCodes and self.triggers is not None:
+            self.triggers.fire("dtc_" + "_".join(newCodes))
+
+    def start(self):
+        supported = self.getSupportedSensors()
+        print "Logging " + ", ".join([obd_sensors.SENSORS[i].shortname for i in supported])
+
+        channels = []
+        logChannels = {}
+        for i in supported:
+            sensor = obd_sensors.SENSORS[i]
+            rate, priority = CHANNEL_RATES.get(sensor.shortname, (DEFAULT_RATE, 0))
+            channels.append(Channel(sensor, rate, priority))
+            logChannels[i] = sensor.shortname
+        self.indexes = dict([(logChannels[i], i) for i in logChannels])
+
+        self.logChannels = logChannels
+        self.recoverLogs()
+        self.openLog()
+        self.addSink(lambda timestamp, index, shortname, value: self.writer.write(timestamp, index, value))
+        self.addSink(lambda timestamp, index, shortname, value: self.thermal.add(shortname, timestamp, value))
+        self.heatmaps.setVehicle(self.ports[0].timing.vehicleId)
+        self.addSink(lambda timestamp, index, shortname, value: self.heatmaps.add(shortname, timestamp, value))
+        if CAPTURE_EVENTS:
+            self.triggers = TriggerEngine(vehicleId=self.ports[0].timing.vehicleId)
+            self.addSink(lambda timestamp, index, shortname, value: self.triggers.add(shortname, timestamp, value))
+            self.rules = RuleEngine(triggers=self.triggers)
+            self.addSink(lambda timestamp, index, shortname, value: self.rules.set(shortname, value))
+        if DETECT_ANOMALIES:
+            self.anomalies = AnomalyDetector(triggers=self.triggers)
+            self.addSink(lambda timestamp, index, shortname, value: self.anomalies.add(shortname, timestamp, value))
+
+        # Live values are published as soon as they are sampled, without waiting to be merged into order
+        if PUBLISH_LIVE_VALUES:
+            self.bus = obd_shm.LiveValueWriter()
+            print "Publishing live values to " + self.bus.path
+        if TELEMETRY:
+            self.telemetry = TelemetryServer(port=TELEMETRY_PORT, host=TELEMETRY_HOST)
+            self.telemetry.start()
+            print "Streaming telemetry on " + self.telemetry.path
+
+        # The adapters belong to the acquisition once it starts, so the DTCs are read first
+        if RECORD_DTCS:
+            self.readDtcs()
+
+        self.acquisition = Acquisition(self.ports, channels, self.publish)
+        self.acquisition.start()
+
+    # Completes the log chunks left as ".part" files by a daemon that didn't shut down, e.g. on a power cut, so they are
+    # uploaded and ingested like the others. Chunks without a whole header are deleted.
+    def recoverLogs(self):
+        if not os.path.isdir(self.logDir):
+            return
+        for name in sorted(os.listdir(self.logDir)):
+            if not name.endswith(LOG_EXTENSION + PARTIAL_EXTENSION):
+                continue
+            filename = os.path.join(self.logDir, name)
+            if repairLog(filename):
+                os.rename(filename, filename[:-len(PARTIAL_EXTENSION)])
+                print "Recovered " + filename[:-len(PARTIAL_EXTENSION)]
+            else:
+                os.unlink(filename)
+                print "Deleted " + filename
+
+    # Starts a new log chunk
+    def openLog(self):
+        if not os.path.isdir(self.logDir):
+            os.makedirs(self.logDir)
+        filename = os.path.join(self.logDir, time.strftime("%Y%m%d-%H%M%S") + LOG_EXTENSION)
+        self.writer = BinLogWriter(filename + PARTIAL_EXTENSION, self.logChannels, self.ports[0].timing.vehicleId,
+                                   {"mode": "daemon", "ports": len(self.ports)})
+        self.logStart = time.time()
+        print "Logging to " + filename
+
+    # Completes the current log chunk
+    def closeLog(self):
+        self.writer.close()
+        self.sampleCount += self.writer.count
+        os.rename(self.writer.filename, self.writer.filename[:-len(PARTIAL_EXTENSION)])
+
+    # Evaluates the alert rules against the latest samples, starting captures
+    def evaluateRules(self):
+        self.rules.set("oil_ready", self.thermal.isOilReady())
+        self.rules.evaluate(time.time())
+
+    # Passes samples to the sinks until stop is called
+    def run(self):
+        self.running = True
+        lastFlush = time.time()
+        while self.running:
+            self.dispatch(self.acquisition.getSamples())
+            if self.rules is not None:
+                self.evaluateRules()
+            if time.time() - self.logStart >= LOG_CHUNK_SECONDS:
+                self.closeLog()
+                self.openLog()
+            elif time.time() - lastFlush >= FLUSH_INTERVAL:
+                self.writer.flush()
+                lastFlush = time.time()
+
+        self.acquisition.stop()
+        self.dispatch(self.acquisition.getSamples(0, True))
+        self.closeLog()
+        if self.triggers is not None:
+            self.triggers.close()
+        if self.anomalies is not None:
+            self.anomalies.close()
+        self.heatmaps.close()
+        if self.bus is not None:
+            self.bus.close()
+        if self.telemetry is not None:
+            self.telemetry.stop()
+        for port in self.ports:
+            port.close()
+        print "Logged %d samples" % self.sampleCount
+
+    def publish(self, sample):
+        timestamp, shortname, value, portIndex = sample
+        if self.bus is not None:
+            self.bus.publish(self.indexes[shortname], value, timestamp)
+        if self.telemetry is not None:
+            self.telemetry.update(shortname, value)
+
+    def dispatch(self, samples):
+        for timestamp, shortname, value, portIndex in samples:
+            index = self.indexes[shortname]
+            for sink in self.sinks:
+                sink(timestamp, index, shortname, value)
+
+    def stop(self, *args):
+        self.running = False
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        daemon = PiGaugeDaemon(sys.argv[1])
+    else:
+        daemon = PiGaugeDaemon()
+
+    if not daemon.connect():
+        print "Not connected"
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.start()
+    daemon.run()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# Virtual dyno: wheel power and torque curves from wide open throttle pulls.
+#
+#   python pigauge_dyno.py [-m mass] [-c drag area] [-o plot.png] run
+#   python pigauge_dyno.py [-m mass] [-c drag area] [-o plot.png] <log file>
+#
+# "run" polls only the rpm, speed and throttle, as fast as the adapters answer, until a pull has been recorded. A log
+# file (see obd_binlog) is searched for pulls instead. A pull is a run of wide open throttle in one gear, up to the
+# highest rpm reached.
+#
+# The speed is only reported to 1 mph, so it is worked out from the rpm with the gear's ratio of speed to rpm (fitted
+# over the pull). The rpm is resampled evenly, then smoothed and differentiated in one pass with a Savitzky-Golay
+# filter. The force at the wheels is what accelerates the car plus the drag and rolling resistance, and the power is
+# that force times the speed. Torque is given at the crank speed (power / rpm), as a rolling road would.
+#
+# The curves depend on how precisely the samples are timed, so the sample intervals of the pull are reported too.
+# matplotlib is needed for plots (sudo apt-get install python-matplotlib), otherwise the curves are printed.
+
+import os
+import getopt
+import sys
+import time
+
+import numpy
+
+import obd_sensors
+from obd_acquisition import Acquisition
+from obd_binlog import BinLogReader
+from obd_scheduler import Channel
+from obd_utils import DATA_DIR
+from pigauge_analytics import findRuns, readRecordArrays, RECORD_DTYPE
+
+DYNO_DIR = os.path.join(DATA_DIR, "dyno")
+
+# Vehicle settings: mass (in kg, with the driver), drag area (drag coefficient x frontal area, in m^2) and the
+# rolling resistance coefficient
+VEHICLE_MASS = 1400.0
+DRAG_AREA = 0.7
+ROLLING_RESISTANCE = 0.012
+
+AIR_DENSITY = 1.2
+GRAVITY = 9.81
+MPH_TO_MS = 0.44704
+WATTS_PER_HP = 745.7
+HP_RPM_TO_LBFT = 5252.0
+
+# Throttle position (in %) taken as wide open, and the shortest pull (in seconds) worth analysing
+WOT_THROTTLE = 80.0
+MIN_PULL_SECONDS = 2.0
+
+# Polls per second asked for while recording a pull. The adapters can't keep up, so the channels are polled back to
+# back.
+DYNO_RATES = {"rpm": 100.0, "speed": 20.0, "throttle_pos": 10.0}
+
+# Rate (per second) the rpm is resampled at, and the Savitzky-Golay window (in seconds) and polynomial order
+RESAMPLE_RATE = 20.0
+SMOOTH_SECONDS = 0.6
+SMOOTH_ORDER = 2
+
+# Returns the Savitzky-Golay filters (for convolution) giving the smoothed values and the first derivative (per
+# sample) of evenly spaced samples, for a window of size samples
+def savitzkyGolay(size, order):
+    half = size // 2
+    offsets = numpy.arange(-half, half + 1, dtype=float)
+    fit = numpy.linalg.pinv(numpy.vander(offsets, order + 1, increasing=True))
+    # Reversed, as convolution flips the filter
+    return fit[0][::-1], fit[1][::-1]
+
+# Returns the (start, end) times of the pulls: runs of wide open throttle of at least MIN_PULL_SECONDS, cut short at
+# the highest rpm reached
+def findPulls(throttleTimes, throttles, rpmTimes, rpms):
+    pulls = []
+    for start, end, peak in findRuns(throttleTimes, throttles, throttles >= WOT_THROTTLE):
+        inPull = (rpmTimes >= start) & (rpmTimes <= end)
+        if inPull.sum() < 2:
+            continue
+        end = rpmTimes[inPull][rpms[inPull].argmax()]
+        if end - start >= MIN_PULL_SECONDS:
+            pulls.append((start, end))
+    return pulls
+
+# Works out the curves of a pull from the rpm and speed samples (times in seconds, speed in mph). Returns a dict of
+# arrays (rpm, hp, torque in lb ft) and details of the pull, or None if there are too few samples.
+def analysePull(rpmTimes, rpms, speedTimes, speeds, mass=VEHICLE_MASS, dragArea=DRAG_AREA):
+    size = int(SMOOTH_SECONDS * RESAMPLE_RATE) // 2 * 2 + 1
+    grid = numpy.arange(rpmTimes[0], rpmTimes[-1], 1.0 / RESAMPLE_RATE)
+    if len(grid) <= size or len(speeds) < 2:
+        return None
+
+    # Speed per rpm in this gear, by least squares through the origin
+    speedRpms = numpy.interp(speedTimes, rpmTimes, rpms)
+    ratio = (speeds * speedRpms).sum() / (speedRpms * speedRpms).sum()
+
+    smooth, derivative = savitzkyGolay(size, SMOOTH_ORDER)
+    resampled = numpy.interp(grid, rpmTimes, rpms)
+    rpm = numpy.convolve(resampled, smooth, "valid")
+    rpmRate = numpy.convolve(resampled, derivative, "valid") * RESAMPLE_RATE
+
+    speed = rpm * ratio * MPH_TO_MS
+    acceleration = rpmRate * ratio * MPH_TO_MS
+    force = mass * acceleration + 0.5 * AIR_DENSITY * dragArea * speed * speed + ROLLING_RESISTANCE * mass * GRAVITY
+    hp = force * speed / WATTS_PER_HP
+    torque = hp * HP_RPM_TO_LBFT / numpy.maximum(rpm, 1.0)
+
+    intervals = numpy.diff(rpmTimes)
+    return {"rpm": rpm, "hp": hp, "torque": torque, "ratio": ratio, "duration": rpmTimes[-1] - rpmTimes[0],
+            "samples": len(rpms), "meanInterval": intervals.mean(), "maxInterval": intervals.max(),
+            "intervalJitter": intervals.std()}
+
+# Returns the results of every pull in a log
+def analyseLog(filename, mass=VEHICLE_MASS, dragArea=DRAG_AREA):
+    reader = BinLogReader(filename)
+    indexes = dict([(shortname, index) for index, shortname in reader.channels.items()])
+    records = numpy.concatenate(list(readRecordArrays(reader)) or [numpy.zeros(0, RECORD_DTYPE)])
+    reader.close()
+    if not all([name in indexes for name in DYNO_RATES]) or len(records) == 0:
+        print "%s doesn't have the rpm, speed and throttle" % filename
+        return []
+
+    series = {}
+    for name in DYNO_RATES:
+        channelRecords = records[records["channel"] == indexes[name]]
+        order = numpy.argsort(channelRecords["timestamp"], kind="mergesort")
+        series[name] = (channelRecords["timestamp"][order], channelRecords["value"][order])
+    return analyseSeries(series, mass, dragArea)
+
+# Returns the results of every pull in series, a dict of (times, values) arrays by short name
+def analyseSeries(series, mass=VEHICLE_MASS, dragArea=DRAG_AREA):
+    rpmTimes, rpms = series["rpm"]
+    speedTimes, speeds = series["speed"]
+    results = []
+    for start, end in findPulls(series["throttle_pos"][0], series["throttle_pos"][1], rpmTimes, rpms):
+        inRpm = (rpmTimes >= start) & (rpmTimes <= end)
+        inSpeed = (speedTimes >= start) & (speedTimes <= end)
+        result = analysePull(rpmTimes[inRpm], rpms[inRpm], speedTimes[inSpeed], speeds[inSpeed], mass, dragArea)
+        if result is not None:
+            result["start"] = start
+            results.append(result)
+    return results
+
+# Polls the rpm, speed and throttle as fast as the adapters answer until a pull has been recorded, returning its results
+def recordPull(ports, mass=VEHICLE_MASS, dragArea=DRAG_AREA):
+    channels = []
+    for sensor in obd_sensors.SENSORS:
+        if sensor.shortname in DYNO_RATES:
+            channels.append(Channel(sensor, DYNO_RATES[sensor.shortname], 1))
+    acquisition = Acquisition(ports, channels)
+    acquisition.start()
+
+    series = dict([(name, ([], [])) for name in DYNO_RATES])
+    results = []
+    wot = False
+    print "Ready, floor it in one gear"
+    try:
+        while not results:
+            for timestamp, shortname, value, port in acquisition.getSamples():
+                series[shortname][0].append(timestamp)
+                series[shortname][1].append(value)
+                if shortname != "throttle_pos":
+                    continue
+                if value >= WOT_THROTTLE and not wot:
+                    print "Recording pull"
+                elif value < WOT_THROTTLE and wot:
+                    # Pull finished, look for it in the samples so far
+                    arrays = dict([(name, (numpy.array(series[name][0]), numpy.array(series[name][1])))
+                                   for name in series])
+                    results = analyseSeries(arrays, mass, dragArea)
+                    if not results:
+                        print "Too short, try again"
+                wot = value >= WOT_THROTTLE
+    finally:
+        acquisition.stop()
+    return results
+
+def printResult(result):
+    peakHp = result["hp"].argmax()
+    peakTorque = result["torque"].argmax()
+    print "Pull of %.1f s, %d rpm samples every %.1f ms (jitter %.1f ms, longest gap %.1f ms)" % (
+        result["duration"], result["samples"], result["meanInterval"] * 1000, result["intervalJitter"] * 1000,
+        result["maxInterval"] * 1000)
+    print "  Peak %.0f hp at %d rpm, %.0f lb ft at %d rpm (at the wheels)" % (
+        result["hp"][peakHp], result["rpm"][peakHp], result["torque"][peakTorque], result["rpm"][peakTorque])
+    for rpm in range(int(result["rpm"].min()) // 250 * 250 + 250, int(result["rpm"].max()), 250):
+        i = numpy.abs(result["rpm"] - rpm).argmin()
+        print "  %5d rpm %6.1f hp %6.1f lb ft" % (rpm, result["hp"][i], result["torque"][i])
+
+# Plots the curves of the pulls to a PNG file, returning False if matplotlib isn't installed
+def plotResults(results, filename):
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as pyplot
+    except ImportError:
+        print "matplotlib isn't installed, so the curves can't be plotted"
+        return False
+
+    figure, powerAxes = pyplot.subplots()
+    torqueAxes = powerAxes.twinx()
+    for result in results:
+        powerAxes.plot(result["rpm"], result["hp"], "r-")
+        torqueAxes.plot(result["rpm"], result["torque"], "b-")
+    powerAxes.set_xlabel("rpm")
+    powerAxes.set_ylabel("wheel hp", color="r")
+    torqueAxes.set_ylabel("lb ft", color="b")
+    figure.savefig(filename)
+    pyplot.close(figure)
+    print "Plotted to " + filename
+    return True
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "m:c:o:")
+    except getopt.GetoptError as e:
+        args = []
+    if len(args) != 1:
+        print "Usage: pigauge_dyno.py [-m mass] [-c drag area] [-o plot.png] run|<log file>"
+        sys.exit(1)
+    mass = VEHICLE_MASS
+    dragArea = DRAG_AREA
+    output = None
+    for opt, value in opts:
+        if opt == "-m":
+            mass = float(value)
+        elif opt == "-c":
+            dragArea = float(value)
+        elif opt == "-o":
+            output = value
+
+    if args[0] == "run":
+        from pigauge_daemon import PiGaugeDaemon
+        daemon = PiGaugeDaemon()
+        if not daemon.connect():
+            print "Not connected"
+            sys.exit(1)
+        try:
+            results = recordPull(daemon.ports, mass, dragArea)
+        except KeyboardInterrupt:
+            results = []
+        for port in daemon.ports:
+            port.close()
+    else:
+        results = analyseLog(args[0], mass, dragArea)
+
+    for result in results:
+        printResult(result)
+    if results:
+        if output is None:
+            if not os.path.isdir(DYNO_DIR):
+                os.makedirs(DYNO_DIR)
+            output = os.path.join(DYNO_DIR, time.strftime("%Y%m%d-%H%M%S") + ".png")
+        plotResults(results, output)
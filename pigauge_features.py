@@ -4,18 +4,34 @@
 import time
 import sys
 
+from pigauge_tripstore import EVENT_TURBO_TIMER
+
 # Feature class is the base class which is used to run feature logic in a loop.
 # bEnabled sets wether the feature should be enabled or not
 class Feature:
     def __init__(self, bEnabled):
         self.enabled = bEnabled
+
+        # History of every sensor for the drive (see pigauge_history), set by the gauge panel
+        self.history = None
+
+        # Estimated turbo and oil temperatures (see pigauge_thermal), set by the gauge panel
+        self.thermal = None
+
+        # Scheduler of the sensor polling, to boost the sensors the feature needs (see obd_scheduler), set by the gauge panel
+        self.scheduler = None
+
+        # Records an event that isn't in the logs, as recordEvent(type, start, end, peak) (see TripStore.addEvent), set
+        # by the gauge panel
+        self.recordEvent = None
         
     # Update the feature, passing in the sensor list and info textbox for the feature to read and write to
     def update(self, sensorList, tInfoBox):
         pass
 
 # The manual turbo timer feature lets you know when it is safe to switch off your engine.
-# The base cooldown is 2 minutes, with a minute added for every hour driven, up to a maximum of 5 minutes.
+# The cooldown is how long the thermal model estimates the turbo takes to cool at idle, so it depends on how hard the car
+# has just been driven.
 class TurboTimer(Feature):
     def __init__(self, bEnabled):
         Feature.__init__(self, bEnabled)
@@ -25,33 +41,20 @@ class TurboTimer(Feature):
         
         self.currentlyIdling = False
         self.idleRpm = 1000
+
+        # Longest cooldown (in seconds) of the current idle, or None if there is no cooldown to finish
+        self.peakCooldown = None
         
-        # All in seconds
-        self.minCooldown = 90
-        self.maxCooldown = 300
-        self.cooldownIncrement = 80 # How much to increment the cooldown by per run time multiple
-        
-        # Engine running time multiple to increase cooldown (in minutes)
-        self.runTimeMultiple = 60
-        
-    # Calculates the optimal cooldown time in seconds
-    def calcCooldown(self, sensorList):
-        # Get engine run time
-        runTime = sensorList["engine_time"].value
-        hoursRan = runTime / self.runTimeMultiple
-        percentCurrentHour = float(runTime % self.runTimeMultiple) / self.runTimeMultiple
-        
-        # Calculate
-        cooldown = self.minCooldown + (self.cooldownIncrement * hoursRan) + (self.cooldownIncrement * percentCurrentHour)
-        if cooldown > self.maxCooldown:
-            cooldown = self.maxCooldown
-        
-        return cooldown
+    # Calculates the cooldown time left in seconds, or None if the turbo temperature isn't known yet
+    def calcCooldown(self):
+        if self.thermal is None:
+            return None
+        return self.thermal.getTurboCooldown()
     
     def update(self, sensorList, tInfoBox):
         # Get current RPM
         rpm = sensorList["rpm"].value
-        cooldown = self.calcCooldown(sensorList)
+        cooldown = self.calcCooldown()
     
         # Detect engine entering idle
         if self.currentlyIdling == False and rpm < self.idleRpm:
@@ -62,13 +65,135 @@ class TurboTimer(Feature):
         if self.currentlyIdling and rpm > self.idleRpm:
             self.timeStartedIdling = sys.maxint
             self.currentlyIdling = False
+            self.peakCooldown = None
             
         # Start countdown after 30 seconds of idle
-        if self.currentlyIdling:
+        if self.currentlyIdling and cooldown is not None:
             idlingTime = time.time() - self.timeStartedIdling
             if idlingTime > 30:
-                if idlingTime > cooldown:
+                if cooldown <= 0:
                     tInfoBox.AppendText("TurboTimer: SAFE.\n")
+                    # Record the cooldown as a turbo timer cycle once it has finished
+                    if self.peakCooldown is not None and self.recordEvent is not None:
+                        self.recordEvent(EVENT_TURBO_TIMER, self.timeStartedIdling, time.time(), self.peakCooldown)
+                    self.peakCooldown = None
+                else:
+                    tInfoBox.AppendText("TurboTimer: " + str(int(cooldown)) + "s\n")
+                    self.peakCooldown = max(self.peakCooldown, cooldown)
+
+# The residency feature shows where the engine spends most of its time (across every trip), and how much of it is spent
+# where it is now, from the rpm x load heatmap (see pigauge_heatmap)
+class Residency(Feature):
+    def __init__(self, bEnabled, heatmaps):
+        Feature.__init__(self, bEnabled)
+        self.heatmap = heatmaps.getHeatmap("rpm_load")
+
+    def update(self, sensorList, tInfoBox):
+        topCell = self.heatmap.getTopCell()
+        if topCell is None:
+            return
+        rpm, load, share = topCell
+        tInfoBox.AppendText("Most time: %drpm %d%% load (%d%%)\n" % (rpm, load, share * 100))
+        tInfoBox.AppendText("Time here: %d%%\n" % (self.heatmap.getCurrentShare() * 100))
+
+# Returns the time a line between two samples crosses a value
+def crossingTime(t1, v1, t2, v2, value):
+    if v2 == v1:
+        return t2
+    return t1 + (t2 - t1) * (value - v1) / float(v2 - v1)
+
+# The performance timer times 0-60 mph, 30-70 mph and the quarter mile. Start and finish times are interpolated between
+# speed samples, and the distance is integrated over them, so the times are much finer than the polling interval. While
+# a run is armed (stopped, or just under 30 mph for 30-70) or under way, the speed sensor is polled faster.
+class PerformanceTimer(Feature):
+    def __init__(self, bEnabled):
+        Feature.__init__(self, bEnabled)
+
+        # Speed (in mph) above which the car has set off
+        self.launchSpeed = 0.5
+
+        # Runs from a rolling start are armed this far (in mph) below their start speed
+        self.armWindow = 10
+
+        # (name, start speed, finish speed) of the timed runs
+        self.speedRuns = [("0-60", 0, 60), ("30-70", 30, 70)]
+        self.quarterMile = 0.25
+
+        # Polls per second and priority of the speed sensor while a run is armed or under way
+        self.boostRate = 10.0
+        self.boostPriority = 2
+
+        # Start time of each run under way by name, whether it is armed, and the last result
+        self.starts = {}
+        self.armed = {}
+        self.results = {}
+        self.distance = 0.0
+        self.boosted = False
+
+        self.lastTimestamp = None
+        self.lastSpeed = None
+
+    # Times the runs over the speed samples since the last update
+    def addSample(self, timestamp, speed):
+        t1, v1 = self.lastTimestamp, self.lastSpeed
+        self.lastTimestamp, self.lastSpeed = timestamp, speed
+        if t1 is None or timestamp <= t1:
+            return
+
+        for name, startSpeed, finishSpeed in self.speedRuns:
+            startSpeed = max(startSpeed, self.launchSpeed)
+            if speed < startSpeed:
+                # Slowed down to just under the start speed (or stopped), so ready to start again
+                self.armed[name] = startSpeed == self.launchSpeed or speed >= startSpeed - self.armWindow
+                self.starts.pop(name, None)
+            elif self.armed.get(name) and v1 < startSpeed:
+                self.starts[name] = crossingTime(t1, v1, timestamp, speed, startSpeed)
+                self.armed[name] = False
+            if name in self.starts and v1 < finishSpeed <= speed:
+                self.results[name] = crossingTime(t1, v1, timestamp, speed, finishSpeed) - self.starts.pop(name)
+
+        # The quarter mile starts from a standstill, with the distance (in miles) integrated from the launch
+        if speed < self.launchSpeed:
+            self.armed["1/4 mile"] = True
+            self.starts.pop("1/4 mile", None)
+        elif self.armed.get("1/4 mile") and v1 < self.launchSpeed:
+            launch = crossingTime(t1, v1, timestamp, speed, self.launchSpeed)
+            self.starts["1/4 mile"] = launch
+            self.armed["1/4 mile"] = False
+            self.distance = (self.launchSpeed + speed) / 2.0 * (timestamp - launch) / 3600.0
+        elif "1/4 mile" in self.starts:
+            step = (v1 + speed) / 2.0 * (timestamp - t1) / 3600.0
+            if self.distance + step >= self.quarterMile:
+                finish = t1 + (timestamp - t1) * (self.quarterMile - self.distance) / step
+                trapSpeed = v1 + (speed - v1) * (finish - t1) / (timestamp - t1)
+                self.results["1/4 mile"] = (finish - self.starts.pop("1/4 mile"), trapSpeed)
+            self.distance += step
+
+    # Polls the speed faster while a run is armed or under way
+    def updateBoost(self):
+        needed = bool(self.starts) or any(self.armed.values())
+        if needed != self.boosted and self.scheduler is not None:
+            if needed:
+                self.scheduler.boost("speed", self.boostRate, self.boostPriority)
+            else:
+                self.scheduler.unboost("speed")
+            self.boosted = needed
+
+    def update(self, sensorList, tInfoBox):
+        if self.history is None:
+            return
+        timestamps, speeds = self.history.get("speed", self.lastTimestamp)
+        for timestamp, speed in zip(timestamps, speeds):
+            self.addSample(timestamp, speed)
+        self.updateBoost()
+
+        for name in [run[0] for run in self.speedRuns] + ["1/4 mile"]:
+            if name in self.starts:
+                tInfoBox.AppendText("%s: GO\n" % name)
+            elif name in self.results:
+                if name == "1/4 mile":
+                    tInfoBox.AppendText("%s: %.2fs @ %dmph\n" % (name, self.results[name][0], self.results[name][1]))
                 else:
-                    timeLeft = int(cooldown - idlingTime)
-                    tInfoBox.AppendText("TurboTimer: " + str(timeLeft) + "s\n")
+                    tInfoBox.AppendText("%s: %.2fs\n" % (name, self.results[name]))
+            elif self.armed.get(name):
+                tInfoBox.AppendText("%s: READY\n" % name)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# This file defines the residency heatmaps: the time spent in each rpm x load cell and each rpm x manifold pressure
+# cell, kept up to date as samples arrive rather than worked out from the logs afterwards (see pigauge_analytics for
+# that). The time since the last sample is added to the cell of the latest values, which takes constant time, and the
+# heatmaps of each vehicle are kept in HEATMAP_STATE_FILE so they add up over every trip.
+#
+#   python pigauge_heatmap.py [export.csv]
+#
+# prints the heatmaps of every vehicle, or exports them as CSV.
+
+import csv
+import sys
+
+import numpy
+
+from obd_utils import loadState, saveState
+from pigauge_analytics import RPM_BINS, LOAD_BINS, MAX_GAP
+
+HEATMAP_STATE_FILE = "heatmap.json"
+
+# Manifold pressure bins, in the units of the manifold_pressure sensor (up to 1758 at the 255 kPa the PID can report)
+MAP_BINS = range(0, 1801, 100)
+
+# Time (in seconds) between saving the heatmaps
+SAVE_INTERVAL = 300.0
+
+# Key of the heatmaps in the state file when the vehicle isn't known
+UNKNOWN_VEHICLE = "unknown"
+
+# Index of the bin of evenly spaced bins a value falls in, with values outside the bins put in the first or last bin
+def binIndex(bins, value):
+    index = int((value - bins[0]) // (bins[1] - bins[0]))
+    return min(max(index, 0), len(bins) - 2)
+
+class Heatmap:
+    def __init__(self, name, rowChannel, rowBins, columnChannel, columnBins):
+        self.name = name
+        self.rowChannel = rowChannel
+        self.rowBins = rowBins
+        self.columnChannel = columnChannel
+        self.columnBins = columnBins
+
+        # Seconds spent in each cell
+        self.times = numpy.zeros((len(rowBins) - 1, len(columnBins) - 1))
+
+        # Cell of the latest values, or None until both are known
+        self.row = None
+        self.column = None
+
+    def set(self, shortname, value):
+        if shortname == self.rowChannel:
+            self.row = binIndex(self.rowBins, value)
+        elif shortname == self.columnChannel:
+            self.column = binIndex(self.columnBins, value)
+
+    # Adds time to the cell of the latest values
+    def addTime(self, seconds):
+        if self.row is not None and self.column is not None:
+            self.times[self.row, self.column] += seconds
+
+    # Fraction of the time spent in the cell of the latest values
+    def getCurrentShare(self):
+        total = self.times.sum()
+        if total == 0 or self.row is None or self.column is None:
+            return 0.0
+        return self.times[self.row, self.column] / total
+
+    # Returns the row bin, column bin and fraction of the time of the cell with the most time, or None
+    def getTopCell(self):
+        total = self.times.sum()
+        if total == 0:
+            return None
+        row, column = numpy.unravel_index(self.times.argmax(), self.times.shape)
+        return self.rowBins[row], self.columnBins[column], self.times[row, column] / total
+
+    def getState(self):
+        return {"rows": list(self.rowBins), "columns": list(self.columnBins), "times": self.times.round(1).tolist()}
+
+    # Restores the times, or clears them if the bins have changed since they were saved or state is None
+    def setState(self, state):
+        if state is not None and state["rows"] == list(self.rowBins) and state["columns"] == list(self.columnBins):
+            self.times = numpy.array(state["times"])
+        else:
+            self.times = numpy.zeros((len(self.rowBins) - 1, len(self.columnBins) - 1))
+
+# Returns new heatmaps of the time spent at each rpm x load and rpm x manifold pressure
+def createHeatmaps():
+    return [Heatmap("rpm_load", "rpm", RPM_BINS, "load", LOAD_BINS),
+            Heatmap("rpm_map", "rpm", RPM_BINS, "manifold_pressure", MAP_BINS)]
+
+class ResidencyHeatmaps:
+    def __init__(self, vehicleId=None):
+        self.heatmaps = createHeatmaps()
+        self.channels = set()
+        for heatmap in self.heatmaps:
+            self.channels.add(heatmap.rowChannel)
+            self.channels.add(heatmap.columnChannel)
+        self.lastTimestamp = None
+        self.lastSave = None
+
+        self.vehicleId = vehicleId
+        self.load()
+
+    # Switches to the heatmaps of another vehicle, e.g. once the gauges have identified the car
+    def setVehicle(self, vehicleId):
+        if vehicleId == self.vehicleId:
+            return
+        if self.lastTimestamp is not None:
+            self.save()
+        self.vehicleId = vehicleId
+        self.load()
+
+    def getKey(self):
+        return self.vehicleId or UNKNOWN_VEHICLE
+
+    def load(self):
+        state = loadState(HEATMAP_STATE_FILE, {}).get(self.getKey(), {})
+        for heatmap in self.heatmaps:
+            heatmap.setState(state.get(heatmap.name))
+
+    # Adds a sample, adding the time since the last one to the cells of the values held until now
+    def add(self, shortname, timestamp, value):
+        if shortname not in self.channels:
+            return
+        if self.lastTimestamp is not None and 0 < timestamp - self.lastTimestamp <= MAX_GAP:
+            for heatmap in self.heatmaps:
+                heatmap.addTime(timestamp - self.lastTimestamp)
+        if self.lastTimestamp is None or timestamp > self.lastTimestamp:
+            self.lastTimestamp = timestamp
+        for heatmap in self.heatmaps:
+            heatmap.set(shortname, value)
+
+        if self.lastSave is None:
+            self.lastSave = timestamp
+        elif timestamp - self.lastSave >= SAVE_INTERVAL:
+            self.save()
+            self.lastSave = timestamp
+
+    def getHeatmap(self, name):
+        for heatmap in self.heatmaps:
+            if heatmap.name == name:
+                return heatmap
+        return None
+
+    # Saves the heatmaps under the vehicle, leaving the other vehicles' as they are
+    def save(self):
+        state = loadState(HEATMAP_STATE_FILE, {})
+        state[self.getKey()] = dict([(heatmap.name, heatmap.getState()) for heatmap in self.heatmaps])
+        saveState(HEATMAP_STATE_FILE, state)
+
+    def close(self):
+        self.save()
+
+# Returns the saved heatmaps of every vehicle, as (vehicle, heatmaps) pairs
+def loadAllHeatmaps():
+    vehicles = []
+    for vehicle, state in sorted(loadState(HEATMAP_STATE_FILE, {}).items()):
+        heatmaps = createHeatmaps()
+        for heatmap in heatmaps:
+            heatmap.setState(state.get(heatmap.name))
+        vehicles.append((vehicle, heatmaps))
+    return vehicles
+
+# Writes the saved heatmaps of every vehicle as CSV: a row per cell with the vehicle, the heatmap, the lower edges of its
+# bins and the seconds spent
+def exportHeatmaps(f):
+    writer = csv.writer(f)
+    writer.writerow(["vehicle", "heatmap", "row", "column", "seconds"])
+    for vehicle, heatmaps in loadAllHeatmaps():
+        for heatmap in heatmaps:
+            for row in range(heatmap.times.shape[0]):
+                for column in range(heatmap.times.shape[1]):
+                    writer.writerow([vehicle, heatmap.name, heatmap.rowBins[row], heatmap.columnBins[column],
+                                     "%.1f" % heatmap.times[row, column]])
+
+def printHeatmaps(vehicle, heatmaps):
+    print "Vehicle " + vehicle
+    for heatmap in heatmaps:
+        total = heatmap.times.sum()
+        print "%s (%.1f h), %% of the time at %s (rows) and %s (columns):" % (heatmap.name, total / 3600.0,
+                                                                            heatmap.rowChannel, heatmap.columnChannel)
+        if total == 0:
+            continue
+        print "      " + "".join(["%6d" % column for column in heatmap.columnBins[:-1]])
+        percent = 100.0 * heatmap.times / total
+        for row in range(len(heatmap.rowBins) - 1):
+            if heatmap.times[row].sum() > 0:
+                print "%6d" % heatmap.rowBins[row] + "".join(["%6.1f" % cell for cell in percent[row]])
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        f = open(sys.argv[1], "wb")
+        exportHeatmaps(f)
+        f.close()
+    else:
+        for vehicle, heatmaps in loadAllHeatmaps():
+            printHeatmaps(vehicle, heatmaps)
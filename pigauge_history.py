@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# This file defines the in-memory history of every sensor, which keeps the whole drive rather than the last few
+# minutes. Samples are appended to an open block per channel, which is sealed into a compressed block every
+# SEAL_INTERVAL seconds (Gorilla style: timestamps as delta of deltas, values as the XOR with the previous value).
+# Blocks are decompressed when they are read, and the oldest blocks are only dropped once the history takes more
+# than its RAM cap.
+
+import collections
+import struct
+import threading
+
+# Time (in seconds) between sealing a channel's samples into a compressed block, and the most samples in a block
+SEAL_INTERVAL = 5.0
+MAX_BLOCK_SAMPLES = 1024
+
+# Bytes the history may take before the oldest blocks are dropped
+HISTORY_RAM_CAP = 4 * 1024 * 1024
+
+# Timestamps are stored to the millisecond
+TIMESTAMP_RESOLUTION = 0.001
+
+# Estimated bytes taken by a block besides its data, and by an open sample
+BLOCK_OVERHEAD = 120
+SAMPLE_OVERHEAD = 80
+
+DOUBLE = struct.Struct("<d")
+UINT64 = struct.Struct("<Q")
+
+# Bits stored for the delta of deltas of the timestamps. The range used is given by a prefix of that many 1 bits
+# ended by a 0, except for the last range.
+DOD_BITS = [0, 7, 9, 12, 32]
+
+class BitWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.buffer = 0
+        self.bits = 0
+
+    def write(self, value, bits):
+        self.buffer = (self.buffer << bits) | value
+        self.bits += bits
+        while self.bits >= 8:
+            self.bits -= 8
+            self.data.append((self.buffer >> self.bits) & 0xFF)
+        self.buffer &= (1 << self.bits) - 1
+
+    def getBytes(self):
+        if self.bits:
+            return str(self.data) + chr((self.buffer << (8 - self.bits)) & 0xFF)
+        return str(self.data)
+
+class BitReader:
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.position = 0
+        self.buffer = 0
+        self.bits = 0
+
+    def read(self, bits):
+        while self.bits < bits:
+            self.buffer = (self.buffer << 8) | self.data[self.position]
+            self.position += 1
+            self.bits += 8
+        self.bits -= bits
+        value = self.buffer >> self.bits
+        self.buffer &= (1 << self.bits) - 1
+        return value
+
+# True if a delta of deltas can be stored in this many bits
+def fitsBits(dod, bits):
+    if bits == 0:
+        return dod == 0
+    return -(1 << (bits - 1)) < dod <= (1 << (bits - 1))
+
+# Compresses a block of samples, returning the compressed data
+def compressBlock(timestamps, values):
+    writer = BitWriter()
+    start = timestamps[0]
+    writer.write(UINT64.unpack(DOUBLE.pack(start))[0], 64)
+
+    lastTime = 0
+    lastDelta = 0
+    lastBits = UINT64.unpack(DOUBLE.pack(values[0]))[0]
+    writer.write(lastBits, 64)
+    leading = 65
+    trailing = 0
+    for i in range(1, len(timestamps)):
+        # Timestamps, as the change in milliseconds between samples
+        offset = int(round((timestamps[i] - start) / TIMESTAMP_RESOLUTION))
+        delta = offset - lastTime
+        dod = delta - lastDelta
+        lastTime = offset
+        lastDelta = delta
+        prefix = 0
+        while prefix < len(DOD_BITS) - 1 and not fitsBits(dod, DOD_BITS[prefix]):
+            prefix += 1
+        if prefix < len(DOD_BITS) - 1:
+            writer.write(((1 << prefix) - 1) << 1, prefix + 1)
+        else:
+            writer.write((1 << prefix) - 1, prefix)
+        if DOD_BITS[prefix]:
+            writer.write(dod & ((1 << DOD_BITS[prefix]) - 1), DOD_BITS[prefix])
+
+        # Values, as the bits that changed
+        valueBits = UINT64.unpack(DOUBLE.pack(values[i]))[0]
+        xor = valueBits ^ lastBits
+        lastBits = valueBits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        newLeading = min(64 - xor.bit_length(), 31)
+        newTrailing = (xor & -xor).bit_length() - 1
+        if newLeading >= leading and newTrailing >= trailing:
+            # Fits in the meaningful bits of the last value
+            writer.write(2, 2)
+            writer.write(xor >> trailing, 64 - leading - trailing)
+        else:
+            leading = newLeading
+            trailing = newTrailing
+            meaningful = 64 - leading - trailing
+            writer.write(3, 2)
+            writer.write(leading, 5)
+            writer.write(meaningful & 63, 6)
+            writer.write(xor >> trailing, meaningful)
+    return writer.getBytes()
+
+# Decompresses a block of count samples into lists of timestamps and values
+def decompressBlock(data, count):
+    reader = BitReader(data)
+    start = DOUBLE.unpack(UINT64.pack(reader.read(64)))[0]
+    lastBits = reader.read(64)
+    timestamps = [start]
+    values = [DOUBLE.unpack(UINT64.pack(lastBits))[0]]
+
+    lastTime = 0
+    lastDelta = 0
+    leading = 0
+    trailing = 0
+    for i in range(1, count):
+        prefix = 0
+        while prefix < len(DOD_BITS) - 1 and reader.read(1):
+            prefix += 1
+        bits = DOD_BITS[prefix]
+        dod = 0
+        if bits:
+            dod = reader.read(bits)
+            if dod > (1 << (bits - 1)):
+                dod -= 1 << bits
+        lastDelta += dod
+        lastTime += lastDelta
+        timestamps.append(start + lastTime * TIMESTAMP_RESOLUTION)
+
+        if reader.read(1):
+            if reader.read(1):
+                leading = reader.read(5)
+                meaningful = reader.read(6) or 64
+                trailing = 64 - leading - meaningful
+            lastBits ^= reader.read(64 - leading - trailing) << trailing
+        values.append(DOUBLE.unpack(UINT64.pack(lastBits))[0])
+    return timestamps, values
+
+# A sealed block of one channel's samples
+class HistoryBlock:
+    def __init__(self, timestamps, values):
+        self.start = timestamps[0]
+        self.end = timestamps[-1]
+        self.count = len(timestamps)
+        self.data = compressBlock(timestamps, values)
+        self.size = len(self.data) + BLOCK_OVERHEAD
+
+    def decompress(self):
+        return decompressBlock(self.data, self.count)
+
+class ChannelHistory:
+    def __init__(self):
+        self.blocks = collections.deque()
+        self.timestamps = []
+        self.values = []
+
+class HistoryStore:
+    def __init__(self, ramCap=HISTORY_RAM_CAP, sealInterval=SEAL_INTERVAL):
+        self.ramCap = ramCap
+        self.sealInterval = sealInterval
+        self.channels = {}
+
+        # Sealed blocks of every channel, oldest first, for eviction
+        self.blocks = collections.deque()
+        self.size = 0
+        self.evictedCount = 0
+        self.lock = threading.Lock()
+
+    # Adds a sample, sealing the channel's open block once it covers the seal interval
+    def add(self, shortname, timestamp, value):
+        channel = self.channels.get(shortname)
+        if channel is None:
+            channel = ChannelHistory()
+            self.channels[shortname] = channel
+        with self.lock:
+            channel.timestamps.append(timestamp)
+            channel.values.append(float(value))
+            self.size += SAMPLE_OVERHEAD
+            if timestamp - channel.timestamps[0] >= self.sealInterval or len(channel.timestamps) >= MAX_BLOCK_SAMPLES:
+                self.seal(channel)
+
+    # Compresses the open samples of a channel into a block, dropping the oldest blocks if over the RAM cap
+    def seal(self, channel):
+        block = HistoryBlock(channel.timestamps, channel.values)
+        self.size += block.size - SAMPLE_OVERHEAD * block.count
+        channel.timestamps = []
+        channel.values = []
+        channel.blocks.append(block)
+        self.blocks.append((channel, block))
+        while self.size > self.ramCap and self.blocks:
+            oldChannel, oldBlock = self.blocks.popleft()
+            oldChannel.blocks.popleft()
+            self.size -= oldBlock.size
+            self.evictedCount += 1
+
+    # Returns lists of the timestamps and values of a channel from since to until (all of them if not given)
+    def get(self, shortname, since=None, until=None):
+        timestamps = []
+        values = []
+        channel = self.channels.get(shortname)
+        if channel is None:
+            return timestamps, values
+        with self.lock:
+            blocks = list(channel.blocks)
+            openTimestamps = list(channel.timestamps)
+            openValues = list(channel.values)
+
+        for block in blocks:
+            if (since is not None and block.end < since) or (until is not None and block.start > until):
+                continue
+            blockTimestamps, blockValues = block.decompress()
+            timestamps.extend(blockTimestamps)
+            values.extend(blockValues)
+        timestamps.extend(openTimestamps)
+        values.extend(openValues)
+
+        if since is not None or until is not None:
+            samples = [(t, v) for t, v in zip(timestamps, values)
+                       if (since is None or t >= since) and (until is None or t <= until)]
+            timestamps = [t for t, v in samples]
+            values = [v for t, v in samples]
+        return timestamps, values
+
+    # Time of the oldest sample still held for a channel, or None
+    def getStart(self, shortname):
+        channel = self.channels.get(shortname)
+        if channel is None:
+            return None
+        with self.lock:
+            if channel.blocks:
+                return channel.blocks[0].start
+            if channel.timestamps:
+                return channel.timestamps[0]
+        return None
+
+    def getChannels(self):
+        return self.channels.keys()
+
+    # Estimated bytes taken by the history
+    def getSize(self):
+        return self.size
+
+    def clear(self):
+        with self.lock:
+            self.channels = {}
+            self.blocks.clear()
+            self.size = 0
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# Minimal fleet server receiving log chunks from pigauge_uploader, for testing uploads locally:
+#
+#   python pigauge_receiver.py [port] [directory]
+#
+# A chunk is identified by the SHA-1 of its (uncompressed) contents and arrives zlib compressed, in pieces:
+#
+#   GET /chunks/<hash>                           -> {"received": <compressed bytes received>, "complete": true/false}
+#   PUT /chunks/<hash>?offset=<n>[&final=1]      body: the compressed bytes from offset n
+#
+# A piece that doesn't start where the last one ended is refused (409) with the number of bytes received, so the
+# uploader can resume from there. On the final piece the chunk is decompressed, checked against its hash and stored as
+# <directory>/<vehicle>/<name>.
+
+import os
+import hashlib
+import json
+import sys
+import zlib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from urlparse import urlparse, parse_qs
+
+RECEIVER_PORT = 8080
+RECEIVE_DIR = "received"
+
+# Hash -> stored path of every complete chunk
+INDEX_FILE = "index.json"
+
+class ChunkStore:
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.indexPath = os.path.join(directory, INDEX_FILE)
+        self.index = {}
+        if os.path.exists(self.indexPath):
+            f = open(self.indexPath, "r")
+            self.index = json.load(f)
+            f.close()
+
+    def partPath(self, chunkHash):
+        return os.path.join(self.directory, chunkHash + ".part")
+
+    def getStatus(self, chunkHash):
+        received = 0
+        if os.path.exists(self.partPath(chunkHash)):
+            received = os.path.getsize(self.partPath(chunkHash))
+        return {"received": received, "complete": chunkHash in self.index}
+
+    # Appends a piece. Returns the HTTP status code.
+    def addPiece(self, chunkHash, offset, data, final, vehicle, name):
+        if chunkHash in self.index:
+            return 200
+        if offset != self.getStatus(chunkHash)["received"]:
+            return 409
+        f = open(self.partPath(chunkHash), "ab")
+        f.write(data)
+        f.close()
+        if not final:
+            return 200
+
+        f = open(self.partPath(chunkHash), "rb")
+        compressed = f.read()
+        f.close()
+        os.unlink(self.partPath(chunkHash))
+        try:
+            contents = zlib.decompress(compressed)
+        except zlib.error:
+            return 422
+        if hashlib.sha1(contents).hexdigest() != chunkHash:
+            return 422
+
+        # Names come from the vehicle, keep them inside the store
+        vehicleDir = os.path.join(self.directory, os.path.basename(vehicle or "unknown"))
+        if not os.path.isdir(vehicleDir):
+            os.makedirs(vehicleDir)
+        path = os.path.join(vehicleDir, os.path.basename(name or chunkHash))
+        f = open(path, "wb")
+        f.write(contents)
+        f.close()
+
+        self.index[chunkHash] = path
+        f = open(self.indexPath + ".tmp", "w")
+        json.dump(self.index, f)
+        f.close()
+        os.rename(self.indexPath + ".tmp", self.indexPath)
+        print "Received " + path
+        return 200
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    # Keep the connection open between pieces
+    protocol_version = "HTTP/1.1"
+
+    def getHash(self):
+        path = urlparse(self.path).path
+        if not path.startswith("/chunks/"):
+            return None
+        chunkHash = path[len("/chunks/"):]
+        if len(chunkHash) != 40:
+            return None
+        return chunkHash
+
+    def reply(self, code, message):
+        body = json.dumps(message)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        chunkHash = self.getHash()
+        if chunkHash is None:
+            # Reachability check
+            self.reply(200, {})
+            return
+        self.reply(200, self.server.store.getStatus(chunkHash))
+
+    def do_PUT(self):
+        chunkHash = self.getHash()
+        length = int(self.headers.getheader("Content-Length", 0))
+        data = self.rfile.read(length)
+        if chunkHash is None:
+            self.reply(404, {})
+            return
+        query = parse_qs(urlparse(self.path).query)
+        offset = int(query.get("offset", ["0"])[0])
+        final = query.get("final", ["0"])[0] == "1"
+        store = self.server.store
+        code = store.addPiece(chunkHash, offset, data, final,
+                              self.headers.getheader("X-Vehicle"), self.headers.getheader("X-Chunk-Name"))
+        self.reply(code, store.getStatus(chunkHash))
+
+    def log_message(self, format, *args):
+        pass
+
+def makeReceiver(port=RECEIVER_PORT, directory=RECEIVE_DIR):
+    server = HTTPServer(("", port), ReceiverHandler)
+    server.store = ChunkStore(directory)
+    return server
+
+if __name__ == "__main__":
+    port = RECEIVER_PORT
+    directory = RECEIVE_DIR
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        directory = sys.argv[2]
+    server = makeReceiver(port, directory)
+    print "Receiving on port %d into %s" % (port, directory)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
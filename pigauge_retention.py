@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# Retention manager, so the logs never fill the SD card. Data is kept in tiers:
+#
+#   full resolution logs        for RAW_DAYS
+#   1 s rollups                 for SECOND_DAYS
+#   1 min rollups               for MINUTE_DAYS
+#   daily rollups and trips     for good
+#
+# where rollups (the count, min, max, mean and last value of each channel over each interval) are kept in the trip
+# store (see pigauge_tripstore). Event captures (see pigauge_triggers) are kept for EVENT_DAYS. Logs are ingested into
+# the trip store before they are deleted, one at a time. If the logs, event captures and the trip store take more than
+# SPACE_BUDGET bytes, the oldest logs, then the oldest event captures, then the oldest 1 s and 1 min rollups are
+# deleted early. Rollups are deleted a whole UTC day at a time.
+#
+#   python pigauge_retention.py [log directory]
+#
+# runs it every RETENTION_INTERVAL seconds at the lowest CPU priority, beside the daemon.
+
+import os
+import sys
+import time
+
+from obd_utils import loadState, saveState
+from pigauge_daemon import LOG_DIR, LOG_EXTENSION, PARTIAL_EXTENSION
+from pigauge_triggers import EVENT_DIR
+from pigauge_tripstore import TripStore, ROLLUP_INTERVALS
+from pigauge_uploader import UPLOAD_STATE_FILE
+
+DAY = 86400.0
+
+RAW_DAYS = 7
+SECOND_DAYS = 30
+MINUTE_DAYS = 365
+EVENT_DAYS = 90
+
+# Most bytes the logs, event captures and the trip store (with its write-ahead log) may take
+SPACE_BUDGET = 2 * 1024 * 1024 * 1024
+
+# Keep logs until the uploader has sent them (see pigauge_uploader), unless they break the space budget
+KEEP_UNTIL_UPLOADED = False
+
+# Days rolled up into daily rollups again in case logs for them arrived late
+LATE_DAYS = 2
+
+# Time (in seconds) between runs, and to rest between logs while ingesting
+RETENTION_INTERVAL = 3600
+INGEST_PAUSE = 1.0
+
+# Niceness added to the retention process (19 is the lowest priority)
+RETENTION_NICE = 19
+
+# Day up to which daily rollups have been made, and the day before which the rollups they are made from have been
+# deleted
+RETENTION_STATE_FILE = "retention.json"
+
+# Start of the UTC day holding a time
+def dayStart(timestamp):
+    return int(timestamp / DAY) * DAY
+
+# Returns the files in a directory ending with an extension, oldest (by their timestamped names) first
+def listFiles(directory, extension):
+    if not os.path.isdir(directory):
+        return []
+    names = sorted([name for name in os.listdir(directory) if name.endswith(extension)])
+    return [os.path.join(directory, name) for name in names]
+
+class RetentionManager:
+    def __init__(self, store, logDir=LOG_DIR, eventDir=EVENT_DIR):
+        self.store = store
+        self.logDir = logDir
+        self.eventDir = eventDir
+        self.state = loadState(RETENTION_STATE_FILE, {})
+
+    # Returns the complete logs, oldest first
+    def getLogs(self):
+        return listFiles(self.logDir, LOG_EXTENSION)
+
+    # Returns the complete event captures, oldest first
+    def getEvents(self):
+        return listFiles(self.eventDir, LOG_EXTENSION)
+
+    # Bytes taken by the trip store, its write-ahead log, the logs and the event captures, including the ones still
+    # being written (or left behind by a crash)
+    def getUsedSize(self):
+        size = self.store.getUsedSize()
+        if os.path.exists(self.store.path + "-wal"):
+            size += os.path.getsize(self.store.path + "-wal")
+        for directory in (self.logDir, self.eventDir):
+            for filename in listFiles(directory, LOG_EXTENSION) + listFiles(directory, PARTIAL_EXTENSION):
+                size += os.path.getsize(filename)
+        return size
+
+    # Ingests the logs not in the trip store yet
+    def ingestLogs(self):
+        for filename in self.getLogs():
+            if not self.store.isFileIngested(filename) and self.store.ingestLog(filename):
+                time.sleep(INGEST_PAUSE)
+
+    def deleteLog(self, filename):
+        os.unlink(filename)
+        print "Deleted " + filename
+
+    # Deletes event captures older than EVENT_DAYS
+    def expireEvents(self, now):
+        for filename in self.getEvents():
+            if os.path.getmtime(filename) >= now - EVENT_DAYS * DAY:
+                break
+            self.deleteLog(filename)
+
+    # Deletes logs older than RAW_DAYS (by their modification time, i.e. when they were completed)
+    def expireLogs(self, now):
+        uploaded = None
+        if KEEP_UNTIL_UPLOADED:
+            uploaded = loadState(UPLOAD_STATE_FILE, {})
+        for filename in self.getLogs():
+            if os.path.getmtime(filename) >= now - RAW_DAYS * DAY:
+                break
+            if not self.store.isFileIngested(filename):
+                continue
+            if uploaded is not None and os.path.basename(filename) not in uploaded:
+                continue
+            self.deleteLog(filename)
+
+    # Deletes the rollups at an interval from the UTC days before the one holding a time. Days whose 1 min rollups
+    # have gone are never rolled up again, as a late log would replace their daily rollups with its part of the day.
+    def deleteRollups(self, interval, before):
+        before = dayStart(before)
+        self.store.deleteRollups(interval, before)
+        if interval == ROLLUP_INTERVALS[-1] and before > self.state.get("dailyFrom", 0):
+            self.state["dailyFrom"] = before
+            saveState(RETENTION_STATE_FILE, self.state)
+
+    # Makes the daily rollups of the days completed since the last run, and deletes expired rollups
+    def expireRollups(self, now):
+        since = self.state.get("dailyUntil")
+        if since is None:
+            since = self.store.getOldestRollup(ROLLUP_INTERVALS[-1]) or now
+        else:
+            since = since - LATE_DAYS * DAY
+        self.store.addDailyRollups(max(since, self.state.get("dailyFrom", 0)), now)
+        self.state["dailyUntil"] = now
+        saveState(RETENTION_STATE_FILE, self.state)
+
+        self.deleteRollups(ROLLUP_INTERVALS[0], now - SECOND_DAYS * DAY)
+        self.deleteRollups(ROLLUP_INTERVALS[-1], now - MINUTE_DAYS * DAY)
+
+    # Deletes the oldest data until the space budget is met: logs that are in the trip store, then event captures,
+    # then a day of 1 s rollups at a time, then a day of 1 min rollups at a time. Daily rollups and trips are never
+    # deleted.
+    def enforceBudget(self):
+        size = self.getUsedSize()
+        for filename in self.getLogs():
+            if size <= SPACE_BUDGET:
+                return
+            if self.store.isFileIngested(filename):
+                size -= os.path.getsize(filename)
+                self.deleteLog(filename)
+        for filename in self.getEvents():
+            if size <= SPACE_BUDGET:
+                return
+            size -= os.path.getsize(filename)
+            self.deleteLog(filename)
+
+        for interval in ROLLUP_INTERVALS:
+            while size > SPACE_BUDGET:
+                oldest = self.store.getOldestRollup(interval)
+                if oldest is None:
+                    break
+                self.deleteRollups(interval, oldest + DAY)
+                size = self.getUsedSize()
+        if size > SPACE_BUDGET:
+            print "Over the space budget by %d bytes" % (size - SPACE_BUDGET)
+
+    def enforce(self):
+        now = time.time()
+        self.ingestLogs()
+        self.expireLogs(now)
+        self.expireEvents(now)
+        self.expireRollups(now)
+        self.enforceBudget()
+
+    def run(self):
+        while 1:
+            self.enforce()
+            time.sleep(RETENTION_INTERVAL)
+
+if __name__ == "__main__":
+    os.nice(RETENTION_NICE)
+    if len(sys.argv) > 1:
+        manager = RetentionManager(TripStore(), sys.argv[1])
+    else:
+        manager = RetentionManager(TripStore())
+    try:
+        manager.run()
+    except KeyboardInterrupt:
+        pass
+    manager.store.close()
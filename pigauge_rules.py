@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# This file defines the alert rules, which decide the display colour of every value, the alerts shown on screen and
+# when events are captured (see pigauge_triggers), all in one place.
+#
+# A rule is a condition on a channel (above or below a threshold), which must hold for a duration before the rule
+# fires, and stops firing once the value is back past the threshold by the hysteresis. The rules are compiled into
+# arrays once, so evaluating them all on a tick is a handful of numpy operations however many rules there are. Only
+# rules that start firing are then handled one by one.
+
+import numpy
+
+import obd_sensors
+
+# Display colours (RGB). Values of channels with colour rules are shown COLOUR_SAFE while none of them fire.
+COLOUR_SAFE = (0, 255, 0)
+COLOUR_UNSAFE = (255, 0, 0)
+COLOUR_LOW = (255, 255, 0)
+COLOUR_WARMING = (255, 153, 0)
+
+# Severities, lowest first. The colour of the most severe rule firing on a channel is used.
+SEVERITY_NOTICE = 1
+SEVERITY_WARNING = 2
+SEVERITY_CRITICAL = 3
+
+ABOVE = ">"
+BELOW = "<"
+
+# Channels worked out by the gauges rather than polled: oil_ready is 1 once the oil has warmed up
+DERIVED_CHANNELS = ["oil_ready"]
+
+# Channels whose values over the upper safe limit are alerted and captured. Over the limit on the others (e.g. speed)
+# is only coloured.
+CAPTURE_CHANNELS = ["temp", "rpm"]
+
+# The rpm redline rule fires at this fraction of the rpm sensor's maximum
+REDLINE_FRACTION = 0.95
+
+class Rule:
+    def __init__(self, name, channel, condition, threshold, severity=SEVERITY_WARNING, colour=None, target=None,
+                 hysteresis=0.0, duration=0.0, message=None, capture=False):
+        """condition is ABOVE or BELOW the threshold. colour is shown on the target channel (by default the
+        channel itself) while the rule fires, message is shown as an alert, and capture starts an event capture
+        when the rule starts firing."""
+        self.name = name
+        self.channel = channel
+        self.condition = condition
+        self.threshold = threshold
+        self.severity = severity
+        self.colour = colour
+        self.target = target or channel
+        self.hysteresis = hysteresis
+        self.duration = duration
+        self.message = message
+        self.capture = capture
+
+# Returns the rules for the sensor limits: values over the upper safe limit are unsafe (and alerted and captured for
+# CAPTURE_CHANNELS), values under the lower safe limit are low, the coolant is warming until the oil is ready, and the
+# rpm nearing the redline is captured
+def defaultRules():
+    rules = []
+    for sensor in obd_sensors.SENSORS:
+        if not isinstance(sensor, obd_sensors.SensorLimits):
+            continue
+        message = None
+        capture = sensor.shortname in CAPTURE_CHANNELS
+        if capture:
+            message = sensor.name + " HIGH"
+        rules.append(Rule(sensor.shortname + "_high", sensor.shortname, ABOVE, sensor.upperSafeLimit,
+                          SEVERITY_CRITICAL, COLOUR_UNSAFE, message=message, capture=capture))
+        rules.append(Rule(sensor.shortname + "_low", sensor.shortname, BELOW, sensor.lowerSafeLimit,
+                          SEVERITY_WARNING, COLOUR_LOW))
+        if isinstance(sensor, obd_sensors.CoolantSensor):
+            rules.append(Rule("oil_warming", "oil_ready", BELOW, 0.5, SEVERITY_NOTICE, COLOUR_WARMING,
+                              target=sensor.shortname))
+        if sensor.shortname == "rpm":
+            rules.append(Rule("redline", "rpm", ABOVE, sensor.max * REDLINE_FRACTION, SEVERITY_CRITICAL,
+                              message="REDLINE", capture=True))
+    return rules
+
+class RuleEngine:
+    def __init__(self, rules=None, triggers=None):
+        """triggers is the TriggerEngine started by rules that capture"""
+        if rules is None:
+            rules = defaultRules()
+        self.triggers = triggers
+
+        self.names = [sensor.shortname for sensor in obd_sensors.SENSORS] + DERIVED_CHANNELS
+        self.indexes = dict([(self.names[i], i) for i in range(len(self.names))])
+        self.values = numpy.zeros(len(self.names))
+        self.known = numpy.zeros(len(self.names), bool)
+        self.compile(rules)
+
+    # Compiles the rules into arrays, most severe last
+    def compile(self, rules):
+        self.rules = sorted(rules, key=lambda rule: rule.severity)
+        count = len(self.rules)
+
+        # Conditions are all evaluated as value > threshold, with BELOW rules negated
+        sign = numpy.array([1.0 if rule.condition == ABOVE else -1.0 for rule in self.rules])
+        self.sign = sign
+        self.channel = numpy.array([self.indexes[rule.channel] for rule in self.rules], int)
+        self.threshold = sign * numpy.array([rule.threshold for rule in self.rules], float)
+        self.releaseThreshold = self.threshold - numpy.array([rule.hysteresis for rule in self.rules], float)
+        self.duration = numpy.array([rule.duration for rule in self.rules], float)
+        self.hasMessage = numpy.array([rule.message is not None for rule in self.rules], bool)
+
+        # Time each rule's condition started holding (NaN while it doesn't), and the rules firing
+        self.since = numpy.empty(count)
+        self.since.fill(numpy.nan)
+        self.firing = numpy.zeros(count, bool)
+
+        # Rules with colours and the channel they colour. Channels with colour rules have a colour even while none
+        # fire, the others have none.
+        self.colourRules = numpy.array([i for i in range(count) if self.rules[i].colour is not None], int)
+        self.colourTargets = numpy.array([self.indexes[self.rules[i].target] for i in self.colourRules], int)
+        self.colourRule = numpy.empty(len(self.names), int)
+        self.colourRule.fill(-1)
+        self.coloured = numpy.zeros(len(self.names), bool)
+        self.coloured[self.colourTargets] = True
+
+    # Sets the latest value of a channel
+    def set(self, shortname, value):
+        index = self.indexes[shortname]
+        self.values[index] = value
+        self.known[index] = True
+
+    # Evaluates every rule, returning the rules that started firing
+    def evaluate(self, now):
+        values = self.values[self.channel] * self.sign
+        holding = self.known[self.channel] & (values > numpy.where(self.firing, self.releaseThreshold,
+                                                                   self.threshold))
+        self.since[~holding] = numpy.nan
+        self.since[holding & numpy.isnan(self.since)] = now
+        firing = holding & (now - numpy.nan_to_num(self.since) >= self.duration)
+        started = numpy.nonzero(firing & ~self.firing)[0]
+        self.firing = firing
+
+        # The colour of every channel is from the most severe of its firing rules (the last, as they are sorted)
+        self.colourRule.fill(-1)
+        firingColours = firing[self.colourRules]
+        numpy.maximum.at(self.colourRule, self.colourTargets[firingColours], self.colourRules[firingColours])
+
+        startedRules = [self.rules[i] for i in started]
+        if self.triggers is not None:
+            for rule in startedRules:
+                if rule.capture:
+                    self.triggers.fire(rule.name, now)
+        return startedRules
+
+    # Colour (RGB) of a channel's value, or None if it has no colour rules
+    def getColour(self, shortname):
+        index = self.indexes[shortname]
+        if not self.coloured[index]:
+            return None
+        rule = self.colourRule[index]
+        if rule < 0:
+            return COLOUR_SAFE
+        return self.rules[rule].colour
+
+    # Messages of the rules firing, most severe first
+    def getAlerts(self):
+        return [self.rules[i].message for i in numpy.nonzero(self.firing & self.hasMessage)[0][::-1]]
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# This file defines the live telemetry stream the acquisition daemon serves to pit laptops and other displays, on a
+# Unix socket and optionally a TCP port. Browsers can connect to the TCP port with a WebSocket.
+#
+# A client sends one subscription (a JSON object on one line, or one WebSocket text message):
+#
+#   {"channels": ["rpm", "speed"], "rate": 10}
+#
+# where rate is the most updates per second it wants. The server answers with the id it uses for each channel, then
+# sends updates as JSON arrays holding only the channels that changed since the client's last update:
+#
+#   {"channels": {"rpm": 12, "speed": 13}}
+#   [0, 12, 3120, 13, 54.6]
+#   [100, 12, 3185]
+#
+# The first element is the time in milliseconds since the client's previous update. The values themselves are sent
+# whole, not as differences from the last ones, so an update that is lost or skipped never throws off the ones after
+# it. Updates are sent no faster than the client's rate, so a slow link gets fewer, larger updates rather than a growing
+# backlog.
+#
+#   python pigauge_telemetry.py <socket path | host:port> <channel> [channel]
+#
+# prints the updates of a running daemon.
+
+import os
+import base64
+import errno
+import hashlib
+import json
+import socket
+import string
+import struct
+import sys
+import threading
+import time
+
+import obd_sensors
+from obd_async import EventLoop
+from obd_utils import DATA_DIR
+
+TELEMETRY_SOCKET = os.path.join(DATA_DIR, "telemetry.sock")
+
+# Address the TCP port listens on. Only this machine can connect unless it is set to "" (every interface).
+TELEMETRY_HOST = "127.0.0.1"
+
+# Fastest update rate (per second) a client can ask for, and the rate used if it doesn't say
+MAX_RATE = 50.0
+DEFAULT_RATE = 10.0
+
+# Updates aren't queued for a client that has this many bytes waiting to be sent, it gets the latest values once it
+# has caught up instead
+MAX_BUFFERED = 16384
+
+# Significant digits sent, so noise below the display resolution doesn't count as a change
+VALUE_DIGITS = 5
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WEBSOCKET_TEXT = 0x1
+WEBSOCKET_CLOSE = 0x8
+
+def roundValue(value):
+    if type(value) not in (int, long, float):
+        return value
+    value = float("%.*g" % (VALUE_DIGITS, value))
+    if value == int(value):
+        return int(value)
+    return value
+
+# A connected client and what it has been sent
+class TelemetryClient:
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.input = ""
+        self.output = ""
+        self.websocket = None
+
+        # Subscribed channel ids, the interval between updates and the values last sent
+        self.channels = None
+        self.interval = 1.0 / DEFAULT_RATE
+        self.lastUpdate = None
+        self.sent = {}
+
+class TelemetryServer:
+    def __init__(self, path=TELEMETRY_SOCKET, port=None, host=TELEMETRY_HOST):
+        self.loop = EventLoop()
+        self.clients = {}
+        self.servers = []
+        self.thread = None
+
+        # Latest value of every channel by id (the index in obd_sensors.SENSORS). Written by the acquisition
+        # thread and read by the server thread, a single dictionary store each.
+        self.values = {}
+        self.ids = {}
+        for i in range(len(obd_sensors.SENSORS)):
+            self.ids[obd_sensors.SENSORS[i].shortname] = i
+
+        if path is not None:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            if os.path.exists(path):
+                os.unlink(path)
+            self.listen(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), path)
+        if port is not None:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listen(server, (host, port))
+        self.path = path
+
+    def listen(self, server, address):
+        server.bind(address)
+        server.listen(5)
+        server.setblocking(0)
+        self.loop.add_reader(server.fileno(), self.onAccept, server)
+        self.servers.append(server)
+
+    # Sets the latest value of a channel, from any thread
+    def update(self, shortname, value):
+        self.values[self.ids[shortname]] = roundValue(value)
+
+    def onAccept(self, server):
+        try:
+            sock, address = server.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        client = TelemetryClient(sock)
+        self.clients[client.fd] = client
+        self.loop.add_reader(client.fd, self.onClientReadable, client)
+
+    def onClientReadable(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error as e:
+            if e.errno == errno.EAGAIN:
+                return
+            data = ""
+        if not data:
+            self.dropClient(client)
+            return
+        client.input = client.input + data
+
+        if client.websocket is None:
+            if len(client.input) < 4:
+                return
+            client.websocket = client.input[:4] == "GET "
+            if client.websocket and not self.acceptWebSocket(client):
+                return
+        elif client.websocket and client.input[:4] == "GET ":
+            # Handshake still arriving
+            if not self.acceptWebSocket(client):
+                return
+
+        for message in self.readMessages(client):
+            try:
+                self.subscribe(client, json.loads(message))
+            except (ValueError, TypeError, AttributeError):
+                self.dropClient(client)
+                return
+
+    # Answers the WebSocket handshake once the request headers are in. Returns False until they are.
+    def acceptWebSocket(self, client):
+        end = client.input.find("\r\n\r\n")
+        if end < 0:
+            return False
+        request, client.input = client.input[:end], client.input[end + 4:]
+        key = None
+        for line in string.split(request, "\r\n")[1:]:
+            name, _, value = line.partition(":")
+            if string.lower(string.strip(name)) == "sec-websocket-key":
+                key = string.strip(value)
+        if key is None:
+            self.dropClient(client)
+            return False
+        accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+        self.send(client, "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                          "Sec-WebSocket-Accept: " + accept + "\r\n\r\n", True)
+        return True
+
+    # Returns the complete messages received from a client: lines, or WebSocket text messages
+    def readMessages(self, client):
+        messages = []
+        if not client.websocket:
+            lines = string.split(client.input, "\n")
+            client.input = lines.pop()
+            return [line for line in lines if string.strip(line) != ""]
+
+        while len(client.input) >= 2:
+            opcode = ord(client.input[0]) & 0x0F
+            length = ord(client.input[1]) & 0x7F
+            offset = 2
+            if length == 126:
+                if len(client.input) < 4:
+                    break
+                (length,) = struct.unpack(">H", client.input[2:4])
+                offset = 4
+            elif length == 127:
+                if len(client.input) < 10:
+                    break
+                (length,) = struct.unpack(">Q", client.input[2:10])
+                offset = 10
+            # Frames from a browser are always masked
+            if len(client.input) < offset + 4 + length:
+                break
+            mask = [ord(c) for c in client.input[offset:offset + 4]]
+            payload = client.input[offset + 4:offset + 4 + length]
+            client.input = client.input[offset + 4 + length:]
+            if opcode == WEBSOCKET_CLOSE:
+                self.dropClient(client)
+                return []
+            if opcode == WEBSOCKET_TEXT:
+                messages.append(string.join([chr(ord(payload[i]) ^ mask[i % 4]) for i in range(len(payload))], ""))
+        return messages
+
+    def subscribe(self, client, subscription):
+        client.channels = []
+        names = {}
+        for shortname in subscription.get("channels", []):
+            if shortname in self.ids:
+                client.channels.append(self.ids[shortname])
+                names[shortname] = self.ids[shortname]
+        rate = min(float(subscription.get("rate", DEFAULT_RATE)), MAX_RATE)
+        client.interval = 1.0 / max(rate, 0.1)
+        client.lastUpdate = None
+        client.sent = {}
+        self.sendMessage(client, json.dumps({"channels": names}, separators=(",", ":")))
+
+    # Sends the channels that changed to every client whose update is due
+    def tick(self):
+        now = time.time()
+        values = self.values
+        for client in self.clients.values():
+            if client.channels is None or client.output:
+                # Not subscribed yet, or still sending the last update
+                continue
+            if client.lastUpdate is not None and now - client.lastUpdate < client.interval:
+                continue
+            update = []
+            for channel in client.channels:
+                value = values.get(channel)
+                if value is not None and client.sent.get(channel) != value:
+                    update.append(channel)
+                    update.append(value)
+                    client.sent[channel] = value
+            if not update:
+                continue
+            if client.lastUpdate is None:
+                elapsed = 0
+            else:
+                elapsed = int((now - client.lastUpdate) * 1000)
+            client.lastUpdate = now
+            self.sendMessage(client, json.dumps([elapsed] + update, separators=(",", ":")))
+        self.loop.call_later(1.0 / MAX_RATE, self.tick)
+
+    def sendMessage(self, client, message):
+        if client.websocket:
+            if len(message) < 126:
+                header = struct.pack(">BB", 0x80 | WEBSOCKET_TEXT, len(message))
+            else:
+                header = struct.pack(">BBH", 0x80 | WEBSOCKET_TEXT, 126, len(message))
+            self.send(client, header + message)
+        else:
+            self.send(client, message + "\n")
+
+    def send(self, client, data, force=False):
+        if len(client.output) > MAX_BUFFERED and not force:
+            return
+        queued = client.output != ""
+        client.output = client.output + data
+        if not queued:
+            self.onClientWritable(client)
+
+    # Sends as much of the client's output as its socket takes, waiting for it to be writable for the rest. Only one
+    # wait is registered per client, however many updates are queued.
+    def onClientWritable(self, client):
+        try:
+            sent = client.sock.send(client.output)
+            client.output = client.output[sent:]
+        except socket.error as e:
+            if e.errno != errno.EAGAIN:
+                self.dropClient(client)
+                return
+        if client.output:
+            self.loop.add_writer(client.fd, self.onClientWritable, client)
+        else:
+            self.loop.remove_writer(client.fd)
+
+    def dropClient(self, client):
+        if self.clients.get(client.fd) is not client:
+            return
+        self.loop.remove_reader(client.fd)
+        self.loop.remove_writer(client.fd)
+        del self.clients[client.fd]
+        client.sock.close()
+
+    def start(self):
+        self.loop.call_soon(self.tick)
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.loop.call_soon(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join()
+        for client in self.clients.values():
+            self.dropClient(client)
+        for server in self.servers:
+            server.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+class TelemetrySubscriber:
+    """ Client side: subscribes to channels and keeps their latest values"""
+    def __init__(self, address, shortnames, rate=DEFAULT_RATE):
+        if ":" in address:
+            host, port = string.split(address, ":")
+            self.sock = socket.create_connection((host, int(port)))
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        self.buffer = ""
+        self.values = {}
+        self.names = {}
+        self.sock.sendall(json.dumps({"channels": shortnames, "rate": rate}) + "\n")
+
+    # Waits for the next message and applies it, returning the channels updated by it
+    def receive(self):
+        while "\n" not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise IOError("Telemetry server closed the connection")
+            self.buffer = self.buffer + data
+        line, self.buffer = string.split(self.buffer, "\n", 1)
+        message = json.loads(line)
+        if type(message) == dict:
+            self.names = dict([(channel, str(name)) for name, channel in message["channels"].items()])
+            return []
+        updated = []
+        for i in range(1, len(message), 2):
+            name = self.names.get(message[i])
+            self.values[name] = message[i + 1]
+            updated.append(name)
+        return updated
+
+    def close(self):
+        self.sock.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print "Usage: pigauge_telemetry.py <socket path | host:port> <channel> [channel]"
+        sys.exit(1)
+    subscriber = TelemetrySubscriber(sys.argv[1], sys.argv[2:])
+    try:
+        while 1:
+            subscriber.receive()
+            print string.join(["%s=%s" % (name, subscriber.values.get(name)) for name in sys.argv[2:]], " ")
+    except KeyboardInterrupt:
+        pass
+    subscriber.close()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# This file defines the thermal model, which estimates the turbo and oil temperatures from the rpm, load and coolant
+# temperature, for cars that can't report them. The turbo timer uses it to tell when the turbo has cooled enough to
+# switch off, and the coolant gauge when the oil has warmed up, rather than each waiting a fixed time.
+#
+# Both are modelled as lumps heading exponentially towards a target temperature, which rises with the power (rpm x
+# load): the turbo from its idle temperature, and the oil from the coolant temperature. Every sample moves the
+# estimates on by the time since the last sample, which takes constant time.
+
+import math
+
+import obd_sensors
+
+# rpm at which the power fraction is 1 at full load (the rpm sensor's maximum)
+RATED_RPM = [sensor.max for sensor in obd_sensors.SENSORS if sensor.shortname == "rpm"][0]
+
+# Turbo temperatures (in C) at idle and at full power, the time constant (in seconds) of its temperature, and the
+# temperature below which it is safe to switch off
+TURBO_IDLE_TEMP = 200.0
+TURBO_FULL_POWER_TEMP = 850.0
+TURBO_TAU = 60.0
+TURBO_SAFE_TEMP = 260.0
+
+# Rise of the oil temperature over the coolant temperature (in C) at full power, the time constant (in seconds) of
+# the oil temperature, and the temperature at which the oil is warm enough to drive hard
+OIL_FULL_POWER_RISE = 30.0
+OIL_TAU = 240.0
+OIL_READY_TEMP = 75.0
+
+# After a gap (in seconds) this long between samples the engine is taken to have been off, and the estimates start
+# again from the coolant temperature
+RESTART_GAP = 60.0
+
+class ThermalModel:
+    def __init__(self):
+        self.rpm = 0.0
+        self.load = 0.0
+        self.coolant = None
+        self.lastTimestamp = None
+
+        # Estimated temperatures (in C), None until the first coolant sample
+        self.turboTemp = None
+        self.oilTemp = None
+
+    # Adds a sample, moving the estimates on to its time
+    def add(self, shortname, timestamp, value):
+        if shortname == "rpm":
+            self.rpm = value
+        elif shortname == "load":
+            self.load = value
+        elif shortname == "temp":
+            self.coolant = value
+        else:
+            return
+
+        if self.lastTimestamp is not None and timestamp - self.lastTimestamp > RESTART_GAP:
+            self.turboTemp = None
+            self.oilTemp = None
+        if self.turboTemp is None:
+            if self.coolant is not None:
+                self.turboTemp = self.coolant
+                self.oilTemp = self.coolant
+        elif timestamp > self.lastTimestamp:
+            dt = timestamp - self.lastTimestamp
+            power = self.getPower()
+            turboTarget = TURBO_IDLE_TEMP + (TURBO_FULL_POWER_TEMP - TURBO_IDLE_TEMP) * power
+            self.turboTemp += (turboTarget - self.turboTemp) * (1.0 - math.exp(-dt / TURBO_TAU))
+            oilTarget = self.coolant + OIL_FULL_POWER_RISE * power
+            self.oilTemp += (oilTarget - self.oilTemp) * (1.0 - math.exp(-dt / OIL_TAU))
+        self.lastTimestamp = timestamp
+
+    # Fraction of full power, from rpm x load
+    def getPower(self):
+        return min(max(float(self.rpm) / RATED_RPM * self.load / 100.0, 0.0), 1.0)
+
+    def getTurboTemp(self):
+        return self.turboTemp
+
+    def getOilTemp(self):
+        return self.oilTemp
+
+    def isOilReady(self):
+        return self.oilTemp is not None and self.oilTemp >= OIL_READY_TEMP
+
+    # Estimated seconds until the oil is ready at the current coolant temperature and power, or None if it won't be
+    def getOilReadyTime(self):
+        if self.oilTemp is None:
+            return None
+        if self.oilTemp >= OIL_READY_TEMP:
+            return 0.0
+        oilTarget = self.coolant + OIL_FULL_POWER_RISE * self.getPower()
+        if oilTarget <= OIL_READY_TEMP:
+            return None
+        return OIL_TAU * math.log((oilTarget - self.oilTemp) / (oilTarget - OIL_READY_TEMP))
+
+    def isTurboCool(self):
+        return self.turboTemp is not None and self.turboTemp <= TURBO_SAFE_TEMP
+
+    # Estimated seconds of idling until the turbo is safe to switch off, or None before the first coolant sample
+    def getTurboCooldown(self):
+        if self.turboTemp is None:
+            return None
+        if self.turboTemp <= TURBO_SAFE_TEMP:
+            return 0.0
+        return TURBO_TAU * math.log((self.turboTemp - TURBO_IDLE_TEMP) / (TURBO_SAFE_TEMP - TURBO_IDLE_TEMP))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# This file defines the trigger engine, which captures what led up to a problem. The last PRE_TRIGGER_SECONDS of
+# every channel are kept in a buffer. When fire() is called (by an alert rule that captures, see pigauge_rules, or e.g.
+# for a new DTC), the buffer and the next POST_TRIGGER_SECONDS of samples are written to an event file in the binary
+# log format (see obd_binlog).
+#
+# While nothing is being captured, a sample costs a buffer append, and the buffer holds at most PRE_TRIGGER_SAMPLES
+# samples.
+
+import os
+import collections
+import time
+
+import obd_sensors
+from obd_binlog import BinLogWriter
+from obd_utils import DATA_DIR
+
+EVENT_DIR = os.path.join(DATA_DIR, "events")
+
+PRE_TRIGGER_SECONDS = 30.0
+POST_TRIGGER_SECONDS = 10.0
+
+# Most samples kept in the pre-trigger buffer, which bounds its memory whatever the sample rate
+PRE_TRIGGER_SAMPLES = 8192
+
+class TriggerEngine:
+    def __init__(self, vehicleId=None, directory=EVENT_DIR, preSeconds=PRE_TRIGGER_SECONDS,
+                 postSeconds=POST_TRIGGER_SECONDS):
+        self.vehicleId = vehicleId
+        self.directory = directory
+        self.preSeconds = preSeconds
+        self.postSeconds = postSeconds
+
+        # Channel indexes in obd_sensors.SENSORS by short name, as used in the event files
+        self.indexes = {}
+        self.channels = {}
+        for i in range(len(obd_sensors.SENSORS)):
+            self.indexes[obd_sensors.SENSORS[i].shortname] = i
+            self.channels[i] = obd_sensors.SENSORS[i].shortname
+
+        # (timestamp, channel index, value) of recent samples
+        self.buffer = collections.deque(maxlen=PRE_TRIGGER_SAMPLES)
+
+        # Event file being written and the time its capture ends
+        self.writer = None
+        self.captureEnd = None
+        self.eventCount = 0
+
+    # Adds a sample, writing it to the event file if one is being captured
+    def add(self, shortname, timestamp, value):
+        index = self.indexes[shortname]
+        if self.writer is not None:
+            if timestamp > self.captureEnd:
+                self.finishCapture()
+            else:
+                self.writer.write(timestamp, index, value)
+        self.buffer.append((timestamp, index, value))
+
+    # Starts capturing an event, unless one is being captured already
+    def fire(self, name, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if self.writer is not None:
+            print "Trigger %s fired during a capture" % name
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        filename = os.path.join(self.directory, "%s-%s.pglog" % (
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(timestamp)), name))
+        self.writer = BinLogWriter(filename + ".part", self.channels, self.vehicleId,
+                                   {"mode": "event", "trigger": name, "triggerTime": timestamp,
+                                    "pre": self.preSeconds, "post": self.postSeconds})
+        self.captureEnd = timestamp + self.postSeconds
+        for sample in self.buffer:
+            if sample[0] >= timestamp - self.preSeconds:
+                self.writer.write(*sample)
+        print "Trigger %s fired, capturing to %s" % (name, filename)
+
+    # Completes the event file being written
+    def finishCapture(self):
+        self.writer.close()
+        os.rename(self.writer.filename, self.writer.filename[:-len(".part")])
+        self.writer = None
+        self.captureEnd = None
+        self.eventCount += 1
+
+    # Completes a capture cut short, e.g. on shutdown
+    def close(self):
+        if self.writer is not None:
+            self.finishCapture()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# This file defines the trip store, an SQLite database of what happened on every trip, so questions like "every
+# overheat in the last month" are answered from an index instead of by reading every log again:
+#
+#   python pigauge_tripstore.py ingest <log directory> [processes]
+#   python pigauge_tripstore.py trips [vehicle]
+#   python pigauge_tripstore.py events [type] [days]
+#
+# Logs are ingested once each (they are identified by their SHA-1). Every log is analysed (see pigauge_analytics) into
+# its trip's summary, its events (readings over a sensor's upper safe limit) and rollups of every channel at
+# ROLLUP_INTERVALS (the count, min, max, mean and last value over each interval). Logs of a vehicle less than TRIP_GAP
+# apart are merged into one trip. DTCs and turbo timer cycles, which aren't in the logs, are added with addEvent.
+
+import os
+import json
+import multiprocessing
+import sqlite3
+import sys
+import time
+
+import numpy
+
+import obd_sensors
+import pigauge_analytics
+from obd_binlog import BinLogReader
+from obd_utils import DATA_DIR
+
+TRIPSTORE_FILE = os.path.join(DATA_DIR, "trips.db")
+
+# Event types
+EVENT_OVERHEAT = "overheat"
+EVENT_LIMIT = "limit"
+EVENT_DTC = "dtc"
+EVENT_TURBO_TIMER = "turbo_timer"
+
+# Intervals (in seconds) channels are rolled up at. Daily rollups are made from the last of these by addDailyRollups.
+ROLLUP_INTERVALS = [1.0, 60.0]
+DAILY_INTERVAL = 86400.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trips (
+    id INTEGER PRIMARY KEY, vehicle TEXT, start REAL, end REAL, logs INTEGER, samples INTEGER,
+    miles REAL, gallons REAL, max_temp REAL, overheats INTEGER, partial TEXT);
+CREATE INDEX IF NOT EXISTS trips_vehicle ON trips (vehicle, start);
+CREATE INDEX IF NOT EXISTS trips_start ON trips (start);
+
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY, trip INTEGER, vehicle TEXT, type TEXT, channel TEXT, start REAL, end REAL, peak REAL,
+    detail TEXT);
+CREATE INDEX IF NOT EXISTS events_type ON events (type, start);
+CREATE INDEX IF NOT EXISTS events_vehicle ON events (vehicle, start);
+CREATE INDEX IF NOT EXISTS events_trip ON events (trip);
+
+CREATE TABLE IF NOT EXISTS rollups (
+    vehicle TEXT, channel TEXT, interval REAL, timestamp REAL, count INTEGER, min REAL, max REAL, mean REAL,
+    last REAL);
+CREATE UNIQUE INDEX IF NOT EXISTS rollups_channel ON rollups (vehicle, channel, interval, timestamp);
+CREATE INDEX IF NOT EXISTS rollups_interval ON rollups (interval, timestamp);
+
+CREATE TABLE IF NOT EXISTS logs (
+    hash TEXT PRIMARY KEY, filename TEXT, vehicle TEXT, start REAL, end REAL, trip INTEGER);
+"""
+
+# Pool worker: analyses a log into (hash, filename, partial result, events, rollup rows), or None if it isn't a log.
+# Events are (type, channel, start, end, peak), rollup rows (channel, interval, timestamp, count, min, max, mean, last).
+def prepareLog(job):
+    filename, fileHash = job
+    try:
+        partial = pigauge_analytics.analyseLog(filename)
+        reader = BinLogReader(filename)
+    except (ValueError, IOError) as e:
+        print "Skipping %s: %s" % (filename, e)
+        return None
+    try:
+        records = list(pigauge_analytics.readRecordArrays(reader))
+    finally:
+        reader.close()
+    if partial["start"] is None:
+        return None
+    records = numpy.concatenate(records)
+
+    events = []
+    rollups = []
+    for channel, shortname in reader.channels.items():
+        mask = records["channel"] == channel
+        timestamps = records["timestamp"][mask]
+        values = records["value"][mask]
+        if len(values) == 0:
+            continue
+
+        sensor = obd_sensors.SENSORS[channel]
+        if isinstance(sensor, obd_sensors.SensorLimits):
+            eventType = EVENT_LIMIT
+            if shortname == "temp":
+                eventType = EVENT_OVERHEAT
+            for start, end, peak in pigauge_analytics.findRuns(timestamps, values, values > sensor.upperSafeLimit):
+                events.append((eventType, shortname, start, end, peak))
+
+        for interval in ROLLUP_INTERVALS:
+            for row in zip(*pigauge_analytics.rollup(timestamps, values, interval)):
+                rollups.append((shortname, interval, float(row[0]), int(row[1])) + tuple([float(v) for v in row[2:]]))
+    return fileHash, filename, partial, events, rollups
+
+class TripStore:
+    def __init__(self, path=TRIPSTORE_FILE):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        # The write-ahead log lets the gauges read while a batch is written, and needs fewer syncs on the SD card
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def isIngested(self, fileHash):
+        return self.db.execute("SELECT 1 FROM logs WHERE hash = ?", (fileHash,)).fetchone() is not None
+
+    # Ingests every new log in a directory, analysing them across processes. Returns the number ingested.
+    def ingestDirectory(self, directory, processes=None):
+        jobs = []
+        for root, dirs, files in os.walk(directory):
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+                fileHash = pigauge_analytics.hashFile(filename)
+                if not self.isIngested(fileHash):
+                    jobs.append((filename, fileHash))
+        if not jobs:
+            return 0
+
+        pool = multiprocessing.Pool(processes)
+        prepared = []
+        try:
+            prepared = [result for result in pool.imap_unordered(prepareLog, jobs) if result is not None]
+        finally:
+            pool.close()
+            pool.join()
+
+        # In order, so each log can follow on from the trip before it
+        prepared.sort(key=lambda result: result[2]["start"])
+        for result in prepared:
+            self.ingestPrepared(*result)
+        return len(prepared)
+
+    def isFileIngested(self, filename):
+        return self.db.execute("SELECT 1 FROM logs WHERE filename = ?", (filename,)).fetchone() is not None
+
+    # Ingests one log. Returns False if it was already ingested or isn't a log.
+    def ingestLog(self, filename):
+        fileHash = pigauge_analytics.hashFile(filename)
+        if self.isIngested(fileHash):
+            return False
+        result = prepareLog((filename, fileHash))
+        if result is None:
+            return False
+        self.ingestPrepared(*result)
+        return True
+
+    # Writes an analysed log in one transaction
+    def ingestPrepared(self, fileHash, filename, partial, events, rollups):
+        vehicle = partial["vehicle"] or "unknown"
+        gap = pigauge_analytics.TRIP_GAP
+        with self.db:
+            # Merge into the trip this log follows on from, or that follows on from it
+            row = self.db.execute("SELECT id, partial FROM trips WHERE vehicle = ? AND start <= ? AND end >= ? "
+                                  "ORDER BY start LIMIT 1", (vehicle, partial["end"] + gap, partial["start"] - gap)
+                                  ).fetchone()
+            if row is None:
+                trip = self.db.execute("INSERT INTO trips (vehicle) VALUES (?)", (vehicle,)).lastrowid
+                tripPartial = pigauge_analytics.mergePartials(pigauge_analytics.newPartial(), partial)
+            else:
+                trip = row["id"]
+                tripPartial = pigauge_analytics.mergePartials(json.loads(row["partial"]), partial)
+            self.updateTrip(trip, tripPartial)
+
+            for event in events:
+                self.insertEvent(trip, vehicle, *event)
+
+            # Intervals on the boundary with another log may already have a row
+            merged = self.mergeBoundaryRollups(vehicle, rollups)
+            self.db.executemany("INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(vehicle,) + row for row in rollups if (row[0], row[1], row[2]) not in merged])
+
+            self.db.execute("INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?)",
+                            (fileHash, filename, vehicle, partial["start"], partial["end"], trip))
+
+    def updateTrip(self, trip, partial):
+        summary = pigauge_analytics.summarise(partial)
+        self.db.execute("UPDATE trips SET start = ?, end = ?, logs = ?, samples = ?, miles = ?, gallons = ?, "
+                        "max_temp = ?, overheats = ?, partial = ? WHERE id = ?",
+                        (partial["start"], partial["end"], partial["logs"], partial["samples"], partial["miles"],
+                         partial["gallons"], partial["maxTemp"], summary["overheats"], json.dumps(partial), trip))
+
+    # Adds an event, or extends the same kind of event if this one runs on from it
+    def insertEvent(self, trip, vehicle, eventType, channel, start, end, peak, detail=None):
+        row = self.db.execute("SELECT id, peak FROM events WHERE vehicle = ? AND type = ? AND channel = ? AND "
+                              "start <= ? AND end >= ?", (vehicle, eventType, channel, end,
+                                                          start - pigauge_analytics.MAX_GAP)).fetchone()
+        if row is not None and detail is None:
+            self.db.execute("UPDATE events SET start = MIN(start, ?), end = MAX(end, ?), peak = MAX(peak, ?) "
+                            "WHERE id = ?", (start, end, peak, row["id"]))
+            return
+        self.db.execute("INSERT INTO events (trip, vehicle, type, channel, start, end, peak, detail) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (trip, vehicle, eventType, channel, start, end, peak, detail))
+
+    # Merges the first and last interval of each channel into the row another log already wrote for it. Returns the
+    # (channel, interval, timestamp) of the rows merged.
+    def mergeBoundaryRollups(self, vehicle, rollups):
+        boundaries = {}
+        for row in rollups:
+            key = (row[0], row[1])
+            if key not in boundaries:
+                boundaries[key] = [row, row]
+            boundaries[key][1] = row
+
+        merged = set()
+        for first, last in boundaries.values():
+            for row in set([first, last]):
+                shortname, interval, timestamp, count, low, high, mean, lastValue = row
+                existing = self.db.execute("SELECT count, min, max, mean, last FROM rollups WHERE vehicle = ? AND "
+                                           "channel = ? AND interval = ? AND timestamp = ?",
+                                           (vehicle, shortname, interval, timestamp)).fetchone()
+                if existing is None:
+                    continue
+                # The last value is from the later log, which is this one if the interval is its first
+                if row is not first:
+                    lastValue = existing["last"]
+                total = existing["count"] + count
+                self.db.execute("UPDATE rollups SET count = ?, min = ?, max = ?, mean = ?, last = ? WHERE vehicle = ? "
+                                "AND channel = ? AND interval = ? AND timestamp = ?",
+                                (total, min(existing["min"], low), max(existing["max"], high),
+                                 (existing["mean"] * existing["count"] + mean * count) / total, lastValue,
+                                 vehicle, shortname, interval, timestamp))
+                merged.add((shortname, interval, timestamp))
+        return merged
+
+    # Adds an event that isn't in the logs, e.g. a DTC (with the code as detail) or a turbo timer cycle
+    def addEvent(self, vehicle, eventType, start, end=None, peak=None, channel=None, detail=None):
+        if end is None:
+            end = start
+        with self.db:
+            row = self.db.execute("SELECT id FROM trips WHERE vehicle = ? AND start <= ? AND end >= ?",
+                                  (vehicle, end, start - pigauge_analytics.TRIP_GAP)).fetchone()
+            trip = None
+            if row is not None:
+                trip = row["id"]
+            self.db.execute("INSERT INTO events (trip, vehicle, type, channel, start, end, peak, detail) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (trip, vehicle, eventType, channel, start, end, peak, detail))
+
+    # Adds a DTC event for each code the vehicle hasn't reported before, returning the new codes
+    def recordDtcs(self, vehicle, codes, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        known = set([row["detail"] for row in self.db.execute(
+            "SELECT detail FROM events WHERE vehicle = ? AND type = ?", (vehicle, EVENT_DTC))])
+        newCodes = []
+        for code in codes:
+            if code not in known:
+                self.addEvent(vehicle, EVENT_DTC, timestamp, detail=code)
+                known.add(code)
+                newCodes.append(code)
+        return newCodes
+
+    def getTrips(self, vehicle=None, since=None, until=None):
+        return self.query("SELECT id, vehicle, start, end, logs, samples, miles, gallons, max_temp, overheats "
+                          "FROM trips", vehicle, since, until)
+
+    def getEvents(self, eventType=None, vehicle=None, since=None, until=None):
+        if eventType is None:
+            return self.query("SELECT * FROM events", vehicle, since, until)
+        return self.query("SELECT * FROM events WHERE type = ?", vehicle, since, until, [eventType])
+
+    def getRollups(self, vehicle, channel, interval, since=None, until=None):
+        return self.db.execute("SELECT timestamp, count, min, max, mean, last FROM rollups WHERE vehicle = ? AND "
+                               "channel = ? AND interval = ? AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp",
+                               (vehicle, channel, interval, since or 0, until or sys.float_info.max)).fetchall()
+
+    # Rolls the rollups at the longest of ROLLUP_INTERVALS up into daily rollups (UTC days), for the days from the one
+    # holding since up to the one before until
+    def addDailyRollups(self, since, until):
+        interval = ROLLUP_INTERVALS[-1]
+        since = int(since / DAILY_INTERVAL) * DAILY_INTERVAL
+        until = int(until / DAILY_INTERVAL) * DAILY_INTERVAL
+        with self.db:
+            # The last value is looked up from the day's latest rollup, as a bare column next to several aggregates
+            # comes from an arbitrary row
+            self.db.execute("INSERT OR REPLACE INTO rollups SELECT vehicle, channel, ?, day, count, min, max, mean, "
+                            "(SELECT last FROM rollups AS latest WHERE latest.vehicle = days.vehicle AND "
+                            "latest.channel = days.channel AND latest.interval = ? AND latest.timestamp = days.latest) "
+                            "FROM (SELECT vehicle, channel, CAST(timestamp / ? AS INTEGER) * ? AS day, "
+                            "SUM(count) AS count, MIN(min) AS min, MAX(max) AS max, SUM(mean * count) / SUM(count) AS mean, "
+                            "MAX(timestamp) AS latest FROM rollups "
+                            "WHERE interval = ? AND timestamp >= ? AND timestamp < ? GROUP BY vehicle, channel, day) AS days",
+                            (DAILY_INTERVAL, interval, DAILY_INTERVAL, DAILY_INTERVAL, interval, since, until))
+
+    # Deletes the rollups at an interval from before a time
+    def deleteRollups(self, interval, before):
+        with self.db:
+            return self.db.execute("DELETE FROM rollups WHERE interval = ? AND timestamp < ?", (interval, before)).rowcount
+
+    # Time of the oldest rollup at an interval, or None if there are none
+    def getOldestRollup(self, interval):
+        return self.db.execute("SELECT MIN(timestamp) FROM rollups WHERE interval = ?", (interval,)).fetchone()[0]
+
+    # Bytes used by the database, not counting pages freed for reuse
+    def getUsedSize(self):
+        pageSize = self.db.execute("PRAGMA page_size").fetchone()[0]
+        pages = self.db.execute("PRAGMA page_count").fetchone()[0] - self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        return pages * pageSize
+
+    # Runs a query on trips or events, restricted to a vehicle and a time range if given, in time order
+    def query(self, sql, vehicle, since, until, parameters=None):
+        parameters = list(parameters or [])
+        conditions = []
+        if vehicle is not None:
+            conditions.append("vehicle = ?")
+            parameters.append(vehicle)
+        if since is not None:
+            conditions.append("start >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("start <= ?")
+            parameters.append(until)
+        if conditions:
+            sql = sql + (" AND " if " WHERE " in sql else " WHERE ") + " AND ".join(conditions)
+        return self.db.execute(sql + " ORDER BY start", parameters).fetchall()
+
+def formatTime(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("ingest", "trips", "events"):
+        print "Usage: pigauge_tripstore.py ingest <log directory> [processes]"
+        print "       pigauge_tripstore.py trips [vehicle]"
+        print "       pigauge_tripstore.py events [type] [days]"
+        sys.exit(1)
+
+    store = TripStore()
+    if sys.argv[1] == "ingest":
+        processes = None
+        if len(sys.argv) > 3:
+            processes = int(sys.argv[3])
+        print "Ingested %d logs" % store.ingestDirectory(sys.argv[2], processes)
+    elif sys.argv[1] == "trips":
+        vehicle = None
+        if len(sys.argv) > 2:
+            vehicle = sys.argv[2]
+        for trip in store.getTrips(vehicle):
+            print "%4d %-18s %s %6.1f min %6.1f miles %d overheats" % (
+                trip["id"], trip["vehicle"], formatTime(trip["start"]), (trip["end"] - trip["start"]) / 60.0,
+                trip["miles"], trip["overheats"])
+    else:
+        eventType = None
+        since = None
+        if len(sys.argv) > 2:
+            eventType = sys.argv[2]
+        if len(sys.argv) > 3:
+            since = time.time() - float(sys.argv[3]) * 86400
+        for event in store.getEvents(eventType, since=since):
+            print "%-18s %s %-12s %-10s %6.1f s peak %s %s" % (
+                event["vehicle"], formatTime(event["start"]), event["type"], event["channel"] or "",
+                event["end"] - event["start"], event["peak"], event["detail"] or "")
+    store.close()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# Store-and-forward uploader. Complete log chunks written by the daemon (see pigauge_daemon) wait on the SD card until
+# the fleet server is reachable, e.g. when the vehicle is back at the depot, and are then uploaded:
+#
+#   python pigauge_uploader.py http://fleet-server:8080
+#
+# Each chunk is zlib compressed and sent in pieces over one connection. Chunks are identified by the SHA-1 of their
+# contents, so a chunk the server already has is skipped, and an upload cut off part way resumes from the last piece
+# the server received (see pigauge_receiver for the protocol).
+#
+# The uploader runs at the lowest CPU priority and limits its rate, so it never disturbs acquisition.
+
+import os
+import hashlib
+import httplib
+import json
+import socket
+import sys
+import time
+import zlib
+from urlparse import urlparse
+
+from obd_binlog import BinLogReader
+from obd_utils import loadState, saveState
+from pigauge_daemon import LOG_DIR, LOG_EXTENSION
+
+# Hashes of the uploaded chunks by file name
+UPLOAD_STATE_FILE = "uploads.json"
+
+# Size of the pieces a chunk is sent in, and the most bytes sent per second
+PIECE_SIZE = 65536
+UPLOAD_RATE = 256 * 1024
+
+# Times an upload is put back in step with the server (after a 409) before it is given up until the next check
+MAX_RESYNCS = 3
+
+# Time (in seconds) between checks for the server and new chunks
+RETRY_INTERVAL = 60
+
+# Timeout (in seconds) for connecting to and hearing from the server
+CONNECT_TIMEOUT = 10
+
+# Niceness added to the uploader process (19 is the lowest priority)
+UPLOAD_NICE = 19
+
+class ChunkUploader:
+    def __init__(self, url, logDir=LOG_DIR):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.logDir = logDir
+        self.connection = None
+        self.uploaded = loadState(UPLOAD_STATE_FILE, {})
+
+    # Returns the paths of the complete chunks not uploaded yet, oldest first
+    def getPendingChunks(self):
+        if not os.path.isdir(self.logDir):
+            return []
+        names = [name for name in os.listdir(self.logDir) if name.endswith(LOG_EXTENSION)]
+        return [os.path.join(self.logDir, name) for name in sorted(names) if name not in self.uploaded]
+
+    def connect(self):
+        self.connection = httplib.HTTPConnection(self.host, self.port, timeout=CONNECT_TIMEOUT)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    # Sends a request on the open connection, returning the status code and the decoded JSON answer
+    def request(self, method, path, body=None, headers={}):
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        try:
+            return response.status, json.loads(data)
+        except ValueError:
+            return response.status, {}
+
+    def isReachable(self):
+        try:
+            self.connect()
+            status, answer = self.request("GET", "/")
+            return status == 200
+        except (socket.error, httplib.HTTPException):
+            self.close()
+            return False
+
+    # Uploads one chunk, returning True once the server has it
+    def uploadChunk(self, path):
+        f = open(path, "rb")
+        contents = f.read()
+        f.close()
+        chunkHash = hashlib.sha1(contents).hexdigest()
+        try:
+            reader = BinLogReader(path)
+            vehicle = reader.header.get("vehicle")
+            reader.close()
+        except ValueError:
+            vehicle = None
+
+        status, answer = self.request("GET", "/chunks/" + chunkHash)
+        if answer.get("complete"):
+            # Already uploaded, e.g. before the state file was lost
+            return True
+
+        # Compression is deterministic, so the bytes match the ones a cut off upload already sent
+        compressed = zlib.compress(contents)
+        offset = answer.get("received", 0)
+        if offset > len(compressed):
+            offset = 0
+        headers = {"X-Chunk-Name": os.path.basename(path), "X-Vehicle": vehicle or "unknown",
+                   "Content-Type": "application/octet-stream"}
+        resyncs = 0
+        while 1:
+            piece = compressed[offset:offset + PIECE_SIZE]
+            final = offset + len(piece) >= len(compressed)
+            url = "/chunks/%s?offset=%d" % (chunkHash, offset)
+            if final:
+                url = url + "&final=1"
+            start = time.time()
+            status, answer = self.request("PUT", url, piece, headers)
+            if status == 409:
+                # Out of step with the server, carry on from what it has, or start again if it has more than the chunk
+                resyncs += 1
+                if resyncs > MAX_RESYNCS:
+                    print "Upload of %s out of step with the server" % path
+                    return False
+                offset = answer.get("received", 0)
+                if offset > len(compressed):
+                    offset = 0
+                continue
+            if status != 200:
+                print "Upload of %s refused (%d)" % (path, status)
+                return False
+            if final:
+                return answer.get("complete", False)
+            offset += len(piece)
+
+            # Keep to the upload rate
+            delay = float(len(piece)) / UPLOAD_RATE - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+    # Forgets the uploaded chunks that have since been deleted (see pigauge_retention), so the state doesn't grow forever
+    def pruneUploaded(self):
+        names = set()
+        if os.path.isdir(self.logDir):
+            names = set(os.listdir(self.logDir))
+        deleted = [name for name in self.uploaded if name not in names]
+        for name in deleted:
+            del self.uploaded[name]
+        if deleted:
+            saveState(UPLOAD_STATE_FILE, self.uploaded)
+
+    # Uploads every pending chunk while the server is reachable. Returns the number uploaded.
+    def uploadPending(self):
+        self.pruneUploaded()
+        chunks = self.getPendingChunks()
+        if len(chunks) == 0 or not self.isReachable():
+            return 0
+        count = 0
+        try:
+            for path in chunks:
+                if self.uploadChunk(path):
+                    self.uploaded[os.path.basename(path)] = True
+                    saveState(UPLOAD_STATE_FILE, self.uploaded)
+                    count += 1
+                    print "Uploaded " + path
+        except (socket.error, httplib.HTTPException) as e:
+            # Out of range again, the rest waits for the next pass
+            print "Upload interrupted: " + str(e)
+        self.close()
+        return count
+
+    def run(self):
+        while 1:
+            self.uploadPending()
+            time.sleep(RETRY_INTERVAL)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Usage: pigauge_uploader.py <server url> [log directory]"
+        sys.exit(1)
+    os.nice(UPLOAD_NICE)
+    if len(sys.argv) > 2:
+        uploader = ChunkUploader(sys.argv[1], sys.argv[2])
+    else:
+        uploader = ChunkUploader(sys.argv[1])
+    try:
+        uploader.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Runs the acquisition daemon against the simulated adapter (see obd_elmsim):
+#
+#   python tests/test_daemon.py
+#
+# The daemon's files go to a temporary home directory, which is set before the modules work out DATA_DIR.
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+HOME = tempfile.mkdtemp()
+os.environ["HOME"] = HOME
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import obd_elmsim
+import obd_io
+import pigauge_daemon
+from pigauge_tripstore import TripStore, EVENT_DTC, TRIPSTORE_FILE
+
+# Time (in seconds) the daemon is left running
+RUN_SECONDS = 2.0
+
+# Stands in for the TriggerEngine, keeping the names of the triggers fired
+class FiredTriggers:
+    def __init__(self):
+        self.names = []
+
+    def fire(self, name, timestamp=None):
+        self.names.append(name)
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        # Every test starts with no DTCs recorded
+        if os.path.exists(TRIPSTORE_FILE):
+            os.unlink(TRIPSTORE_FILE)
+        self.elm = obd_elmsim.SimulatedELM(obd_elmsim.SimulatedCar())
+        self.elmThread = self.elm.start()
+        self.logDir = os.path.join(HOME, "logs")
+        self.daemon = pigauge_daemon.PiGaugeDaemon(self.logDir)
+        # The live value bus is in /dev/shm, outside the temporary home directory
+        pigauge_daemon.PUBLISH_LIVE_VALUES = False
+        port = obd_io.OBDPort(self.elm.name, None, 2, 2)
+        self.assertEqual(port.State, 1)
+        self.daemon.ports.append(port)
+
+    def tearDown(self):
+        self.elm.stop()
+        self.elmThread.join()
+
+    def testStart(self):
+        self.daemon.start()
+        self.assertTrue(self.daemon.acquisition is not None)
+
+        thread = threading.Thread(target=self.daemon.run)
+        thread.start()
+        time.sleep(RUN_SECONDS)
+        self.daemon.stop()
+        thread.join()
+
+        self.assertTrue(self.daemon.sampleCount > 0)
+        logs = [name for name in os.listdir(self.logDir) if name.endswith(pigauge_daemon.LOG_EXTENSION)]
+        self.assertEqual(len(logs), 1)
+
+        # The simulated car has one stored DTC
+        tripStore = TripStore()
+        try:
+            codes = [row["detail"] for row in tripStore.getEvents(EVENT_DTC)]
+        finally:
+            tripStore.close()
+        self.assertEqual(codes, ["P0133"])
+
+    # A DTC the car hasn't reported before fires a trigger once, the next read finding it in the trip store
+    def testNewDtcTrigger(self):
+        self.daemon.triggers = FiredTriggers()
+        self.daemon.readDtcs()
+        self.daemon.readDtcs()
+        self.assertEqual(self.daemon.triggers.names, ["dtc_P0133"])
+        self.daemon.ports[0].close()
+
+if __name__ == "__main__":
+    try:
+        unittest.main()
+    finally:
+        shutil.rmtree(HOME, ignore_errors=True)